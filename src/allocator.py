@@ -0,0 +1,106 @@
+from boto3.dynamodb.conditions import Key
+
+# マッチIDとVC番号の払い出し
+#
+# マッチID: #META# の LatestMatchID を ADD でまとめて進め、返ってきた値から必要数のIDを予約する。
+#           読み取り→書き戻しをしないので、複数のマッチメイク処理が同時に予約しても重複しない。
+# VC番号  : VCごとに #VC#<番号> アイテムを持ち、match_id（0 なら空き）で使用中のマッチを表す。
+#           確保はマッチ確定のトランザクションに vc_claim_item を含めて行い、
+#           同じVCを同時に確保しようとした場合は片方のトランザクションだけが成功する。
+# #VC# アイテムも rate 属性を持たないため rate_index には現れない。
+
+VC_PREFIX = "#VC#"
+# チームAに割り当てるVC番号（チームBは +1 を使う）
+VC_NUMBERS = list(range(1, 100, 2))
+# 旧形式（#META# の UnusedVC）から移行した時点で使用中だったVCの match_id
+LEGACY_MATCH_ID = -1
+
+
+def vc_key(vc):
+    return f"{VC_PREFIX}{int(vc):03d}"
+
+
+def reserve_match_ids(queue, count):
+    """連続した count 個のマッチIDを予約して返す"""
+    if count <= 0:
+        return []
+    response = queue.update_item(
+        Key={"namespace": "default", "user_id": "#META#"},
+        UpdateExpression="ADD LatestMatchID :n",
+        ExpressionAttributeValues={":n": count},
+        ReturnValues="UPDATED_NEW",
+    )
+    latest = int(response["Attributes"]["LatestMatchID"])
+    return list(range(latest - count + 1, latest + 1))
+
+
+def ensure_vc_pool(queue):
+    """
+    #VC# アイテムが無ければ作成する。
+    #META# の UnusedVC に無いVCは、移行時点で試合に使われているものとして LEGACY_MATCH_ID で確保済みにする。
+    """
+    meta = queue.get_item(Key={"namespace": "default", "user_id": "#META#"}).get("Item", {})
+    unused = {int(vc) for vc in meta.get("UnusedVC", VC_NUMBERS)}
+    for vc in VC_NUMBERS:
+        try:
+            queue.put_item(
+                Item={
+                    "namespace": "default",
+                    "user_id": vc_key(vc),
+                    "vc": vc,
+                    "match_id": 0 if vc in unused else LEGACY_MATCH_ID,
+                },
+                ConditionExpression="attribute_not_exists(user_id)",
+            )
+        except queue.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+
+def list_free_vcs(queue):
+    """空いているVC番号（チームA側）を昇順で返す"""
+    kwargs = {
+        "KeyConditionExpression": Key("namespace").eq("default") & Key("user_id").begins_with(VC_PREFIX),
+        "ProjectionExpression": "vc, match_id",
+    }
+    items = []
+    while True:
+        response = queue.query(**kwargs)
+        items.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    if not items:
+        ensure_vc_pool(queue)
+        return list_free_vcs(queue)
+    return sorted(int(item["vc"]) for item in items if int(item["match_id"]) == 0)
+
+
+def vc_claim_item(queue, vc, match_id):
+    """マッチ確定のトランザクションに含める、VCを match_id で確保する Update"""
+    return {
+        "Update": {
+            "TableName": queue.name,
+            "Key": {"namespace": "default", "user_id": vc_key(vc)},
+            "UpdateExpression": "SET match_id = :m",
+            "ConditionExpression": "match_id = :free",
+            "ExpressionAttributeValues": {":m": int(match_id), ":free": 0},
+        }
+    }
+
+
+def release_vc(queue, vc, match_id):
+    """
+    match_id が確保しているVCを空きに戻す。
+    既に解放済み・他のマッチが確保し直している場合は何もしない（二重に呼ばれても安全）。
+    """
+    try:
+        queue.update_item(
+            Key={"namespace": "default", "user_id": vc_key(vc)},
+            UpdateExpression="SET match_id = :free",
+            ConditionExpression="match_id IN (:m, :legacy)",
+            ExpressionAttributeValues={":free": 0, ":m": int(match_id), ":legacy": LEGACY_MATCH_ID},
+        )
+        return True
+    except queue.meta.client.exceptions.ConditionalCheckFailedException:
+        print(f"VC {vc} is not held by match {match_id}")
+        return False
@@ -1,6 +1,8 @@
 import sys
 import csv
 
+from .match_engine import find_valid_groups
+
 def main():
     csv_file_path = "dynamodb_export.csv"
     count = 0
@@ -24,72 +26,6 @@ def main():
     
     print(count//2)
 
-import math
-
-def dfs_group(players, start_index, current_group, current_min, current_max):
-    """
-    深さ優先探索／バックトラッキングで、現在の共通許容レンジ [current_min, current_max]
-    を満たしながら、候補プレイヤーを追加して10人グループを構築する。
-    
-    :param players: 各要素が辞書 {"user_id", "rate", "min_rating", "max_rating", ...} のリスト
-    :param start_index: この段階での探索開始インデックス
-    :param current_group: これまでに選ばれたプレイヤーのリスト
-    :param current_min: 現在の共通許容レンジの下限
-    :param current_max: 現在の共通許容レンジの上限
-    :return: もし有効な10人グループが見つかればそのリストを返す。見つからなければ None
-    """
-    if len(current_group) == 10:
-        return current_group
-
-    for i in range(start_index, len(players)):
-        candidate = players[i]
-        # 候補プレイヤーの実際のレートが、現在の共通許容レンジに含まれているかチェック
-        if not (current_min <= candidate["rate"] <= current_max):
-            continue
-
-        # 候補の許容レンジとの交差を計算
-        new_min = max(current_min, candidate["min_rating"])
-        new_max = min(current_max, candidate["max_rating"])
-        if new_min > new_max:
-            continue
-
-        # 候補をグループに追加して再帰的に探索
-        new_group = current_group + [candidate]
-        result = dfs_group(players, i + 1, new_group, new_min, new_max)
-        if result is not None:
-            return result
-
-    return None
-
-def find_valid_groups(players):
-    """
-    プレイヤーリストからDFS／バックトラッキングで条件を満たす10人グループを
-    重複なく全て見つける。例えば、30人の候補から3グループが見つかれば、
-    [group1, group2, group3] のリストを返す。
-    
-    :param players: 各要素が辞書 {"user_id", "rate", "min_rating", "max_rating", ...} のリスト
-    :return: 有効なグループ（各グループは10人のリスト）のリスト。グループが見つからなければ空リスト
-    """
-    groups = []
-    # candidates をコピー。なお、プレイヤーリストはあらかじめ希望の順（例えば、降順やインキュー順）にソートしておく
-    remaining_players = players[:]
-    
-    while len(remaining_players) >= 10:
-        # 初期の共通レンジは (-∞, +∞)
-        group = dfs_group(remaining_players, 0, [], -math.inf, math.inf)
-        if group is None:
-            break  # 残りからは10人グループが作れない
-        
-        groups.append(group)
-        # グループに含まれるプレイヤーの user_id を除外
-        used_ids = set(p["user_id"] for p in group)
-        remaining_players = [p for p in remaining_players if p["user_id"] not in used_ids]
-        print(remaining_players)
-        print()
-    
-    return groups
-
-
 # --- 使用例 ---
 if __name__ == "__main__":
     # サンプルデータ（例）
@@ -0,0 +1,71 @@
+import asyncio
+
+import aiohttp
+
+# コンテナ内で共有する外部HTTPクライアント（Bubble / Discord への通知用）
+# asyncio.run はループを毎回閉じるため、セッション（コネクションプール）を使い回せない。
+# そこでコンテナ毎に１つのイベントループとセッションを保持し、keep-alive で TLS 接続を再利用する。
+
+# 同時に送信するリクエスト数の上限
+MAX_CONCURRENCY = 10
+# 接続・全体のタイムアウト（秒）
+CONNECT_TIMEOUT = 3
+TOTAL_TIMEOUT = 10
+# アイドル接続を保持する秒数
+KEEPALIVE_TIMEOUT = 60
+
+_loop = None
+_session = None
+_semaphore = None
+
+
+def get_loop():
+    """コンテナ内で使い回すイベントループを返す"""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+    return _loop
+
+
+async def get_session():
+    """共有の ClientSession を返す（未作成・クローズ済みなら作り直す）"""
+    global _session, _semaphore
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=MAX_CONCURRENCY, keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        timeout = aiohttp.ClientTimeout(total=TOTAL_TIMEOUT, connect=CONNECT_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    return _session
+
+
+async def post_json(url, payload, headers=None):
+    """
+    JSON を POST し、(ステータスコード, レスポンス本文) を返す。
+    通信エラーやタイムアウトは呼び出し側で扱えるよう例外のまま送出する。
+    """
+    session = await get_session()
+    async with _semaphore:
+        async with session.post(url, json=payload, headers=headers) as response:
+            return response.status, await response.text()
+
+
+async def _gather(coros):
+    return await asyncio.gather(*coros, return_exceptions=True)
+
+
+def run(coro):
+    """共有ループ上でコルーチンを実行して結果を返す（asyncio.run の代わりに使う）"""
+    return get_loop().run_until_complete(coro)
+
+
+def run_all(coros):
+    """
+    複数のコルーチンを共有ループ上でまとめて並行実行する。
+    個々の失敗で他の送信が止まらないよう、例外は結果リストにそのまま入れて返す。
+    """
+    coros = list(coros)
+    if not coros:
+        return []
+    return run(_gather(coros))
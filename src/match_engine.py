@@ -0,0 +1,1342 @@
+"""
+マッチメイクのグループ形成エンジン。
+
+DynamoDB等の外部リソースには依存せず、match_make.handle が組み立てた
+プレイヤー辞書 {"user_id", "rate", "min_rating", "max_rating", ...} のリストだけを扱う。
+"""
+import heapq
+import math
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from functools import lru_cache
+from itertools import combinations
+import random
+import re
+import time
+
+GROUP_SIZE = 10
+TEAM_SIZE = GROUP_SIZE // 2
+
+# 許容レンジ: BASE_RANGE + range_spread_speed * range_spread_count。
+# range_spread_count はインキューからの経過時間をマッチメイクの実行間隔で割った値で、
+# RANGE_SPREAD_LIMIT 以上になると許容レンジは無制限になる
+BASE_RANGE = 50
+RANGE_SPREAD_INTERVAL = 20
+RANGE_SPREAD_LIMIT = 5
+
+# 10人を5対5に分ける全パターン（先頭のプレイヤーをチームAに固定した C(9,4)=126 通り）
+TEAM_SPLITS = [
+    ((0,) + rest, tuple(i for i in range(1, GROUP_SIZE) if i not in rest))
+    for rest in combinations(range(1, GROUP_SIZE), TEAM_SIZE - 1)
+]
+# TEAM_SPLITS の各チームを、メンバーのインデックスのビットマスクで表したもの
+TEAM_SPLIT_BITS = [
+    tuple(sum(1 << i for i in team) for team in split) for split in TEAM_SPLITS
+]
+
+# 1チームで埋める5つのロール（recommend_route.Recommendation と同じ並び）
+ROLES = ("top", "top_exp_share", "jungle", "bottom", "bottom_exp_share")
+ALL_ROLES = (1 << len(ROLES)) - 1
+
+
+def range_spread_count(inqueued_unixtime, tick_unixtime):
+    """インキュー時刻から tick_unixtime までに経過したマッチメイクの回数（許容レンジの拡大回数）"""
+    return max(0, int(tick_unixtime - inqueued_unixtime) // RANGE_SPREAD_INTERVAL)
+
+
+def range_width(spread_speed, spread_count):
+    """許容レンジの片側の幅。拡大回数が RANGE_SPREAD_LIMIT に達していれば無制限"""
+    if spread_count >= RANGE_SPREAD_LIMIT:
+        return math.inf
+    return BASE_RANGE + spread_speed * spread_count
+
+
+# 密度に応じた許容レンジの計算で使うヒストグラムの1区間の幅
+DENSITY_BUCKET_WIDTH = 10
+# 許容レンジ内に入れたい（自分を含む）プレイヤー数
+DENSITY_TARGET = GROUP_SIZE
+
+
+def density_adaptive_ranges(players, bucket_width=DENSITY_BUCKET_WIDTH, target=DENSITY_TARGET):
+    """
+    プール内のレートのヒストグラムから、各プレイヤーの許容レンジを「周囲に target 人入る幅」までに抑える。
+
+    待ち時間で決まる幅（min_rating / max_rating）は上限として扱い、
+    レート rate から ±r の区間に target 人以上いる最小の r（区間単位）がそれより狭ければ、そちらに縮める。
+    人の多いレート帯では狭いレンジで早くマッチし、人の少ないレート帯でも無制限まで広げずに済む。
+
+    ヒストグラムの累積和で区間の人数を O(1) で求め、半径は区間ごとに1回だけ二分探索するので、
+    全体で O(n + 区間数 log 区間数)。players の min_rating / max_rating を書き換えて返す。
+    """
+    if not players:
+        return players
+    low = min(int(p["rate"]) for p in players) // bucket_width
+    buckets = [int(p["rate"]) // bucket_width - low for p in players]
+    size = max(buckets) + 1
+    prefix = [0] * (size + 1)
+    for b in buckets:
+        prefix[b + 1] += 1
+    for b in range(size):
+        prefix[b + 1] += prefix[b]
+
+    def count(b, r):
+        return prefix[min(size, b + r + 1)] - prefix[max(0, b - r)]
+
+    radius = {}
+    for b in set(buckets):
+        lo, hi = 0, size
+        if count(b, hi) < target:
+            radius[b] = math.inf
+            continue
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if count(b, mid) >= target:
+                hi = mid
+            else:
+                lo = mid + 1
+        # 区間の端にいるプレイヤーまで確実に含むよう、1区間分の余裕を持たせる
+        radius[b] = (lo + 1) * bucket_width
+
+    for p, b in zip(players, buckets):
+        width = radius[b]
+        p["min_rating"] = max(p["min_rating"], p["rate"] - width)
+        p["max_rating"] = min(p["max_rating"], p["rate"] + width)
+    return players
+
+
+def parse_role_mask(desired_role):
+    """
+    desired_role（"top,jungle" のようなロール名の列）を、担当可能なロールのビットマスクに変換する。
+    指定なし、または既知のロールが1つも含まれない場合は全ロール可とみなす。
+    """
+    mask = 0
+    for name in re.findall(r"[a-z_]+", str(desired_role or "").lower()):
+        if name in ROLES:
+            mask |= 1 << ROLES.index(name)
+    return mask or ALL_ROLES
+
+
+def _supersets(mask):
+    """ロール集合 mask を含むロール集合を全て列挙する"""
+    superset = mask
+    while True:
+        yield superset
+        if superset == ALL_ROLES:
+            return
+        superset = (superset + 1) | mask
+
+
+@lru_cache(maxsize=None)
+def _assign_roles(masks):
+    """masks の各プレイヤーに重複なくロールを割り当てる。割り当てられなければ None"""
+    def assign(index, taken):
+        if index == len(masks):
+            return ()
+        for role in range(len(ROLES)):
+            bit = 1 << role
+            if masks[index] & bit and not taken & bit:
+                rest = assign(index + 1, taken | bit)
+                if rest is not None:
+                    return (role,) + rest
+        return None
+
+    return assign(0, 0)
+
+
+def assign_roles(team):
+    """
+    5人のチームの各プレイヤーに desired_role を満たすロールを割り当て、ロール名のリストで返す。
+    割り当てられない場合は None
+    """
+    roles = _assign_roles(tuple(p.get("role_mask", ALL_ROLES) for p in team))
+    if roles is None:
+        return None
+    return [ROLES[r] for r in roles]
+
+
+def build_conflict_masks(players):
+    """
+    各プレイヤーの blocking（ブロックしている user_id の列）を1ティックに1回だけ解析し、
+    プレイヤー辞書に以下を設定する。
+      block_bit: プール内インデックスのビット (1 << i)
+      conflict_mask: 同じグループに入れてはいけないプレイヤーの block_bit の論理和（ブロックは双方向に扱う）
+    """
+    index = {p["user_id"]: i for i, p in enumerate(players)}
+    conflicts = [0] * len(players)
+    for i, p in enumerate(players):
+        for blocked_id in re.split(r"[\s,]+", str(p.get("blocking") or "")):
+            j = index.get(blocked_id)
+            if j is None or j == i:
+                continue
+            conflicts[i] |= 1 << j
+            conflicts[j] |= 1 << i
+    for i, p in enumerate(players):
+        p["block_bit"] = 1 << i
+        p["conflict_mask"] = conflicts[i]
+    return players
+
+
+class GroupBuilder:
+    """
+    形成中のグループのメンバーと、グループが満たすべき制約を管理する。
+
+    ロール制約: 10人で各ロールを2人ずつ担当できれば、各ロールの2人をA/Bに分けることで
+    両チームとも5ロールが揃う。これはホールの定理より「任意のロール集合 R について、
+    担当可能ロールが R に収まるメンバーが 2|R| 人以下」と同値なので、
+    ロール集合ごとの人数（32通り）を保持し、候補1人の追加可否をビットマスク演算だけで判定する。
+
+    ブロック制約: メンバーの conflict_mask の論理和を保持し、候補の block_bit との AND 1回で判定する
+    （build_conflict_masks を通していないプレイヤーは制約なしとして扱う）。
+    """
+
+    def __init__(self):
+        self.members = []
+        self.role_counts = [0] * (ALL_ROLES + 1)
+        self.conflicts = 0
+        self.conflict_stack = []
+
+    def __len__(self):
+        return len(self.members)
+
+    def can_add(self, player):
+        if player.get("block_bit", 0) & self.conflicts:
+            return False
+        return self.accepts_roles(player.get("role_mask", ALL_ROLES))
+
+    def accepts_roles(self, mask):
+        """担当可能ロールが mask のプレイヤーを、ロール制約の上で追加できるか"""
+        for roles in _supersets(mask):
+            if self.role_counts[roles] >= 2 * _ROLE_COUNT[roles]:
+                return False
+        return True
+
+    def can_complete(self, candidate_masks, need):
+        """
+        担当可能ロールごとの候補の人数 candidate_masks（{role_mask: 人数}）から need 人を加えて、
+        ロール制約を満たす10人にできる見込みがあるか（必要条件）。
+        10人が各ロールを2人ずつ担当できるには、任意のロール集合 T について T のどれかを担当できる人が 2|T| 人以上必要。
+        メンバーのうち T を担当できる人は「担当可能ロールが T の補集合に収まる人」以外なので role_counts から求まる。
+        """
+        for roles in range(1, ALL_ROLES + 1):
+            covered = len(self.members) - self.role_counts[ALL_ROLES ^ roles]
+            available = sum(count for mask, count in candidate_masks.items() if mask & roles)
+            if covered + min(need, available) < 2 * _ROLE_COUNT[roles]:
+                return False
+        return True
+
+    def add(self, player):
+        self.members.append(player)
+        self.conflict_stack.append(self.conflicts)
+        self.conflicts |= player.get("conflict_mask", 0)
+        for roles in _supersets(player.get("role_mask", ALL_ROLES)):
+            self.role_counts[roles] += 1
+
+    def try_add(self, player):
+        if not self.can_add(player):
+            return False
+        self.add(player)
+        return True
+
+    def pop(self):
+        player = self.members.pop()
+        self.conflicts = self.conflict_stack.pop()
+        for roles in _supersets(player.get("role_mask", ALL_ROLES)):
+            self.role_counts[roles] -= 1
+        return player
+
+    def state_key(self):
+        """探索のメモ化キーに含める、制約上のグループの状態（ロール集合ごとの人数とブロック）"""
+        return tuple(self.role_counts), self.conflicts
+
+
+_ROLE_COUNT = [bin(roles).count("1") for roles in range(ALL_ROLES + 1)]
+
+
+def form_matches_from_pool(pool):
+    """
+    pool: 降順（レートが高い順）にソートされたプレイヤーのリスト
+    戻り値: マッチ成立したグループのリスト（各グループは10人のリスト）
+    
+    各アンカーからグループ形成を試み、グループ形成が成功したら
+    そのメンバーをpoolから除外して、以降は未マッチのプレイヤーのみで再試行する。
+    """
+    matched_groups = []
+    used_ids = set()  # すでにマッチに採用されたプレイヤーのID
+    
+    # pool内の各プレイヤーについて、未マッチならアンカーとしてグループ形成を試行
+    for player in pool:
+        if player["user_id"] in used_ids:
+            continue
+        group = try_form_group(player, pool, used_ids)
+        if group and len(group) == 10:
+            matched_groups.append(group)
+            # マッチに採用されたプレイヤーのIDを記録
+            for p in group:
+                used_ids.add(p["user_id"])
+    return matched_groups
+
+def try_form_group(anchor, pool, used_ids):
+    """
+    アンカーからグループ形成をグリーディに試みる。
+    ・初期グループは [anchor] とし、交差区間 I を anchor の許容レンジで初期化する。
+    ・pool内（かつ未採用のプレイヤー）を降順で走査し、各候補について
+      新たな交差区間 I' = intersection(I, candidateのレンジ) を計算する。
+      もし I' が空でなければ、候補をグループに追加し、I を I' に更新する。
+    ・グループのサイズが10になれば成功とする。
+    戻り値: 形成されたグループ（サイズ10のリスト）または None
+    """
+    group = [anchor]
+    # 現在の交差区間 I = [current_min, current_max]
+    current_min = anchor["min_rating"]
+    current_max = anchor["max_rating"]
+    
+    # pool内で、かつ既にマッチに採用されていないプレイヤーを対象に（アンカーを除く）
+    # ※すでに採用済みのものは除外
+    for candidate in pool:
+        if candidate["user_id"] in used_ids:
+            continue
+        if candidate["user_id"] == anchor["user_id"]:
+            continue
+        # 新たな交差区間を計算
+        new_min = max(current_min, candidate["min_rating"])
+        new_max = min(current_max, candidate["max_rating"])
+        if new_min <= new_max:
+            # candidateをグループに追加できる
+            group.append(candidate)
+            current_min, current_max = new_min, new_max
+            if len(group) == 10:
+                return group
+    # 10人に満たなければ失敗
+    return None
+
+
+def sweep_form_groups(players):
+    """
+    許容レンジの端点をスイープして10人グループを形成する。
+
+    スイープ位置 x を未マッチプレイヤーの max_rating の小さい順に進め、min_rating <= x のプレイヤーを候補に加える。
+    候補のうち max_rating < x となったプレイヤーは以降どのグループにも入れないので捨てる。
+    候補の全員は x を含むため、どの10人を選んでも共通許容レンジは空にならない。
+    候補が10人以上いれば、max_rating の最も小さい（次に捨てられる）プレイヤーをアンカーとし、
+    アンカーにレートの近い順に9人を加えてグループとする。
+    同じスイープをレート軸を反転させて（min_rating の大きい順に）も行い、(成立数, -レート幅の合計) の良い方を
+    refine_groups でレートの近いグループ同士に組み直して返す。
+
+    各アンカーからプール全体を走査する form_matches_from_pool と異なり O(n log n) で、
+    成立するグループ数は同等以上、グループのレート幅も同程度になる。
+
+    :param players: プレイヤー辞書のリスト（並び順は問わない）
+    :return: マッチ成立したグループのリスト（各グループは10人のリスト、レート降順）
+    """
+    lower = [p["min_rating"] for p in players]
+    upper = [p["max_rating"] for p in players]
+    forward = _sweep(players, lower, upper)
+    backward = _sweep(players, [-x for x in upper], [-x for x in lower])
+    return refine_groups(max(forward, backward, key=lambda groups: (len(groups), -total_rating_spread(groups))))
+
+
+def _sweep(players, lower, upper):
+    """
+    sweep_form_groups の本体。lower/upper は各プレイヤーの許容レンジの下端・上端。
+    候補は担当可能ロール（role_mask）ごとにレート順のリストで持ち、グループに加えられるロールのリストだけを
+    アンカーのレートから左右に辿る。ロール制約で入れられない人は見ないので、1グループの形成は
+    (10 + ブロックで見送った人数) × ロールの種類数 で済む。
+    """
+    by_lower = sorted(range(len(players)), key=lambda i: lower[i])
+    by_upper = sorted(range(len(players)), key=lambda i: upper[i])
+    rates = [p["rate"] for p in players]
+    masks = [p.get("role_mask", ALL_ROLES) for p in players]
+
+    matched_groups = []
+    used = [False] * len(players)
+    active = {}  # role_mask -> (rate, index) の昇順リスト
+    expiry = []  # 候補の (upper, index) のヒープ
+    size = 0
+    next_lower = 0
+
+    def discard(j):
+        candidates = active[masks[j]]
+        del candidates[bisect_left(candidates, (rates[j], j))]
+
+    for i in by_upper:
+        if used[i]:
+            continue
+        x = upper[i]
+        # スイープ位置 x を許容レンジに含みうるプレイヤーを追加
+        while next_lower < len(by_lower) and lower[by_lower[next_lower]] <= x:
+            j = by_lower[next_lower]
+            insort(active.setdefault(masks[j], []), (rates[j], j))
+            heapq.heappush(expiry, (upper[j], j))
+            size += 1
+            next_lower += 1
+        # x より手前で許容レンジが終わったプレイヤーは以降どのグループにも入れない
+        while expiry and (expiry[0][0] < x or used[expiry[0][1]]):
+            _, j = heapq.heappop(expiry)
+            if not used[j]:
+                discard(j)
+                size -= 1
+
+        while size >= GROUP_SIZE:
+            anchor = expiry[0][1]
+            group = _nearest_group(players, anchor, active, rates)
+            if group is None:
+                break
+            for j in group:
+                used[j] = True
+                discard(j)
+            size -= GROUP_SIZE
+            while expiry and used[expiry[0][1]]:
+                heapq.heappop(expiry)
+            matched_groups.append(sorted((players[j] for j in group), key=lambda p: p["rate"], reverse=True))
+
+    return matched_groups
+
+
+def _nearest_group(players, anchor, active, rates):
+    """
+    anchor と、ロール別の候補リスト active からアンカーにレートの近い順に、ロール制約・ブロックを満たす9人を選ぶ。
+    各ロールのリストをアンカーのレートの位置から左右に辿り、両端の先頭をレート差のヒープで比べる。
+    ロール制約で一度入れられなくなったロールは以降も入れられないので、そのリストは捨てる。
+    :return: 10人のインデックスのリスト。揃わなければ None
+    """
+    builder = GroupBuilder()
+    builder.add(players[anchor])
+    chosen = [anchor]
+    rate = rates[anchor]
+    frontier = []  # (レート差, role_mask, 向き, リスト上の位置)
+
+    def push(mask, step, k):
+        candidates = active[mask]
+        if 0 <= k < len(candidates) and candidates[k][1] == anchor:
+            k += step
+        if 0 <= k < len(candidates):
+            heapq.heappush(frontier, (abs(candidates[k][0] - rate), mask, step, k))
+
+    for mask, candidates in active.items():
+        position = bisect_left(candidates, (rate, anchor))
+        push(mask, -1, position - 1)
+        push(mask, 1, position)
+
+    while len(chosen) < GROUP_SIZE:
+        if not frontier:
+            return None
+        _, mask, step, k = heapq.heappop(frontier)
+        if not builder.accepts_roles(mask):
+            continue
+        push(mask, step, k + step)
+        j = active[mask][k][1]
+        if builder.try_add(players[j]):
+            chosen.append(j)
+    return chosen
+
+
+REFINE_PASSES = 32
+
+
+def group_valid(group):
+    """10人が共通許容レンジ・ロール制約・ブロック制約を満たすか"""
+    if max(p["min_rating"] for p in group) > min(p["max_rating"] for p in group):
+        return False
+    builder = GroupBuilder()
+    return all(builder.try_add(p) for p in group)
+
+
+def refine_groups(groups, passes=REFINE_PASSES):
+    """
+    成立数を変えずにグループのレート幅を縮める局所改善。
+    平均レート順に並べたグループの隣り合う2組について、20人をレート順に下位10人・上位10人に分け直し、
+    両方が制約を満たしてレート幅の合計が縮むなら入れ替える。これを変化がなくなるか passes 回まで繰り返す
+    （1回 O(グループ数)、一度調べて変化のなかった組は再び調べない）。
+    スイープはマッチが成立する組み合わせを優先するため、レートの遠いプレイヤーが同じグループに入りやすいのをここで均す。
+    :return: 改善後のグループのリスト（各グループはレート降順）
+    """
+    # (レート合計, グループID, レート昇順のメンバー)
+    entries = []
+    for group in groups:
+        members = sorted(group, key=lambda p: p["rate"])
+        entries.append((sum(p["rate"] for p in members), len(entries), members))
+    next_id = len(entries)
+    checked = set()
+    for _ in range(passes):
+        entries.sort()
+        changed = False
+        for k in range(len(entries) - 1):
+            (_, a_id, a), (_, b_id, b) = entries[k], entries[k + 1]
+            if (a_id, b_id) in checked:
+                continue
+            checked.add((a_id, b_id))
+            merged = sorted(a + b, key=lambda p: p["rate"])
+            low, high = merged[:GROUP_SIZE], merged[GROUP_SIZE:]
+            before = a[-1]["rate"] - a[0]["rate"] + b[-1]["rate"] - b[0]["rate"]
+            after = low[-1]["rate"] - low[0]["rate"] + high[-1]["rate"] - high[0]["rate"]
+            if after >= before or not (group_valid(low) and group_valid(high)):
+                continue
+            entries[k] = (sum(p["rate"] for p in low), next_id, low)
+            entries[k + 1] = (sum(p["rate"] for p in high), next_id + 1, high)
+            next_id += 2
+            changed = True
+        if not changed:
+            break
+    return [members[::-1] for _, _, members in entries]
+
+
+# swap_refine_groups で1グループあたりに試す、未マッチのプレイヤーの候補数
+SWAP_CANDIDATES = 8
+
+
+def swap_refine_groups(groups, unmatched, passes=REFINE_PASSES):
+    """
+    refine_groups より細かい、1人単位の入れ替えによる局所改善。成立数は変えない。
+      ・未マッチのプレイヤーのうちグループのレート範囲の内側にいる人（中央に近い順に SWAP_CANDIDATES 人）と、
+        グループの最高・最低レートのメンバーを入れ替える
+      ・平均レート順で隣り合う2組の、レート範囲が重なっている部分のメンバー同士を入れ替える
+    いずれも制約を満たしたままレート幅の合計が最も縮む入れ替えを採用し、変化がなくなるか passes 回まで繰り返す。
+    ロール・ブロック制約で20人の分け直し（refine_groups）ができない組でも幅を詰められる。
+    グループ数 G・未マッチ人数 u として、1パスはグループの並べ直しの O(G log G) と、候補探しの O(G log u)、
+    入れ替えたプレイヤーの未マッチ一覧（リスト）への出し入れの O(G u) で、全体で O(passes * G (log G + u))。
+    :return: 改善後のグループのリスト（各グループはレート降順）
+    """
+    def spread(group):
+        return group[-1]["rate"] - group[0]["rate"]
+
+    def replaced(group, k, player):
+        return sorted(group[:k] + group[k + 1:] + [player], key=lambda p: p["rate"])
+
+    groups = [sorted(g, key=lambda p: p["rate"]) for g in groups]
+    pool = sorted(((p["rate"], k, p) for k, p in enumerate(unmatched)), key=lambda x: x[:2])
+    next_key = len(pool)
+    for _ in range(passes):
+        changed = False
+        for g, group in enumerate(groups):
+            low = bisect_right(pool, (group[0]["rate"], math.inf))
+            high = bisect_left(pool, (group[-1]["rate"], -1))
+            middle = (group[0]["rate"] + group[-1]["rate"]) / 2
+            # 範囲内を中央から外側へたどり、中央に近い順に SWAP_CANDIDATES 人を取る（範囲全体はソートしない）
+            right = min(max(bisect_left(pool, (middle, -1)), low), high)
+            left = right - 1
+            inside = []
+            while len(inside) < SWAP_CANDIDATES and (left >= low or right < high):
+                if right >= high or (left >= low and middle - pool[left][0] <= pool[right][0] - middle):
+                    inside.append(left)
+                    left -= 1
+                else:
+                    inside.append(right)
+                    right += 1
+            best = None
+            for u in inside:
+                for k in (0, GROUP_SIZE - 1):
+                    candidate = replaced(group, k, pool[u][2])
+                    gain = spread(group) - spread(candidate)
+                    if gain > 0 and (best is None or gain > best[0]) and group_valid(candidate):
+                        best = (gain, u, k, candidate)
+            if best is not None:
+                _, u, k, candidate = best
+                del pool[u]
+                insort(pool, (group[k]["rate"], next_key, group[k]))
+                next_key += 1
+                groups[g] = candidate
+                changed = True
+
+        groups.sort(key=lambda g: sum(p["rate"] for p in g))
+        for g in range(len(groups) - 1):
+            a, b = groups[g], groups[g + 1]
+            best = None
+            for i in range(GROUP_SIZE - 1, -1, -1):
+                if a[i]["rate"] <= b[0]["rate"]:
+                    break
+                for j in range(GROUP_SIZE):
+                    if b[j]["rate"] >= a[-1]["rate"]:
+                        break
+                    new_a, new_b = replaced(a, i, b[j]), replaced(b, j, a[i])
+                    gain = spread(a) + spread(b) - spread(new_a) - spread(new_b)
+                    if gain > 0 and (best is None or gain > best[0]) and group_valid(new_a) and group_valid(new_b):
+                        best = (gain, new_a, new_b)
+            if best is not None:
+                groups[g], groups[g + 1] = best[1], best[2]
+                changed = True
+        if not changed:
+            break
+    return [g[::-1] for g in groups]
+
+
+def optimal_form_groups(players):
+    """
+    成立グループ数を優先し、次に各グループのレート幅（最高-最低）の合計を小さくするヒューリスティック。
+    名前（MATCHER=optimal）に反して最適解は保証しない。
+
+    レート降順に並べたプールに対して、連続する10人のブロックをグループとする分割を
+    動的計画法で求める。dp[i] は先頭 i 人で作れる (グループ数, -レート幅合計) の最良値で、
+    i 人目を見送る dp[i-1] と、i-10..i-1 の10人をグループにする dp[i-10] + 1 の良い方をとる。
+    ブロックの共通許容レンジは単調デックによるスライディングウィンドウで O(1) に判定し、
+    ロール制約は GroupBuilder で判定する。
+
+    DP はレート連続の分割の中での最良でしかなく、sweep_form_groups の方が多く成立させる場合があるため、
+    両者のうち (グループ数, -レート幅合計) の良い方をとる。ロール・ブロック制約があると多くはスイープの結果になるので、
+    最後に swap_refine_groups で未マッチのプレイヤーや隣のグループとの1人単位の入れ替えを行い、レート幅をさらに詰める。
+    2つの候補のどちらもグループ数を最大化するわけではないため、レート降順のグリーディ（form_matches_from_pool）より
+    成立数が少ないプールもある（ロール・ブロック制約なしの60人のプールで 1000 件中 57 件）。
+
+    計算量はソートと DP・スイープの O(n log n) に、swap_refine_groups の O(passes * G (log G + u))
+    （G: グループ数, u: 未マッチ人数）を足したもの。
+
+    :param players: プレイヤー辞書のリスト（並び順は問わない）
+    :return: マッチ成立したグループのリスト（各グループは10人のリスト、レート降順）
+    """
+    pool = sorted(players, key=lambda p: p["rate"], reverse=True)
+    n = len(pool)
+
+    # valid[i]: pool[i-10:i] の10人の共通許容レンジが空でなければ True
+    valid = [False] * (n + 1)
+    max_lower = deque()  # min_rating が単調減少となるインデックス列
+    min_upper = deque()  # max_rating が単調増加となるインデックス列
+    for j, p in enumerate(pool):
+        while max_lower and pool[max_lower[-1]]["min_rating"] <= p["min_rating"]:
+            max_lower.pop()
+        max_lower.append(j)
+        while min_upper and pool[min_upper[-1]]["max_rating"] >= p["max_rating"]:
+            min_upper.pop()
+        min_upper.append(j)
+        if max_lower[0] <= j - GROUP_SIZE:
+            max_lower.popleft()
+        if min_upper[0] <= j - GROUP_SIZE:
+            min_upper.popleft()
+        if j >= GROUP_SIZE - 1:
+            valid[j + 1] = pool[max_lower[0]]["min_rating"] <= pool[min_upper[0]]["max_rating"]
+
+    # ロール制約を満たさないブロックは除外
+    for i in range(GROUP_SIZE, n + 1):
+        if valid[i]:
+            builder = GroupBuilder()
+            valid[i] = all(builder.try_add(p) for p in pool[i - GROUP_SIZE:i])
+
+    dp = [(0, 0)] * (n + 1)
+    take = [False] * (n + 1)
+    for i in range(1, n + 1):
+        dp[i] = dp[i - 1]
+        if valid[i]:
+            count, neg_spread = dp[i - GROUP_SIZE]
+            candidate = (count + 1, neg_spread - (pool[i - GROUP_SIZE]["rate"] - pool[i - 1]["rate"]))
+            if candidate > dp[i]:
+                dp[i] = candidate
+                take[i] = True
+
+    contiguous = []
+    i = n
+    while i > 0:
+        if take[i]:
+            contiguous.append(pool[i - GROUP_SIZE:i])
+            i -= GROUP_SIZE
+        else:
+            i -= 1
+    contiguous.reverse()
+
+    swept = sweep_form_groups(players)
+    best = max(contiguous, swept, key=lambda groups: (len(groups), -total_rating_spread(groups)))
+    # レート連続の分割が勝たない（ロール・ブロック制約がある）場合も、1人単位の入れ替えでレート幅を詰める
+    used = {id(p) for group in best for p in group}
+    return swap_refine_groups(best, [p for p in players if id(p) not in used])
+
+
+class GroupSearch:
+    """
+    深さ優先探索／バックトラッキングで、共通許容レンジ [current_min, current_max]
+    を満たしながら候補プレイヤーを追加して10人グループを構築する。
+
+    ・旧実装と同じくレート降順（同レートは渡された順）にアンカー・候補をたどる。
+      players はその逆順（レート昇順）で持ち、レートが現在の共通許容レンジに入る候補の範囲を bisect で求める。
+      範囲内の未使用人数（Fenwick木で管理）が必要人数に満たない枝はその場で打ち切る。
+    ・ロールを絞っているプレイヤーがいる場合は、担当可能ロールごとの未使用人数も Fenwick木で持ち、
+      範囲内の候補ではロール制約を満たす10人にできない枝（GroupBuilder.can_complete）も打ち切る。
+    ・探索失敗した (候補範囲の上端, 共通許容レンジ, 必要人数, GroupBuilder の状態) をメモし、同じ状態を再探索しない。
+      プレイヤーは使用済みになるだけで増えないため、メモはグループを取り出した後も有効。
+    ・グループは1つの GroupBuilder への add/pop で組み立て、階層ごとのリストのコピーは行わない。
+    """
+
+    def __init__(self, players):
+        # 後ろからたどるとレート降順・同レートは渡された順になるよう、安定ソートの降順を反転して持つ
+        self.players = sorted(players, key=lambda p: p["rate"], reverse=True)[::-1]
+        self.rates = [p["rate"] for p in self.players]
+        self.masks = [p.get("role_mask", ALL_ROLES) for p in self.players]
+        self.used = [False] * len(self.players)
+        self.tree = [0] * (len(self.players) + 1)
+        # 全員が全ロール可ならロールで打ち切ることはない
+        self.mask_trees = {
+            mask: [0] * (len(self.players) + 1) for mask in set(self.masks)
+        } if set(self.masks) != {ALL_ROLES} else None
+        for i in range(len(self.players)):
+            self._add(i, 1)
+        self.failed = set()
+        self.builder = GroupBuilder()
+        self.anchor = len(self.players) - 1  # これよりレートの高いアンカーからはグループが作れないことが確定している
+
+    def _add(self, index, delta):
+        trees = [self.tree]
+        if self.mask_trees is not None:
+            trees.append(self.mask_trees[self.masks[index]])
+        index += 1
+        for tree in trees:
+            i = index
+            while i < len(tree):
+                tree[i] += delta
+                i += i & -i
+
+    @staticmethod
+    def _prefix(index, tree):
+        total = 0
+        while index > 0:
+            total += tree[index]
+            index -= index & -index
+        return total
+
+    def find(self):
+        """未使用プレイヤーから10人グループを1つ見つけ、使用済みにして返す。見つからなければ None"""
+        while self.anchor >= 0:
+            i = self.anchor
+            if not self.used[i] and self._try(i, -math.inf, math.inf):
+                group = self.builder.members
+                self.builder = GroupBuilder()
+                return group
+            self.anchor -= 1
+        return None
+
+    def _try(self, i, current_min, current_max):
+        candidate = self.players[i]
+        # 候補の許容レンジとの交差を計算
+        new_min = max(current_min, candidate["min_rating"])
+        new_max = min(current_max, candidate["max_rating"])
+        if new_min > new_max or not self.builder.can_add(candidate):
+            return False
+        self.builder.add(candidate)
+        self.used[i] = True
+        self._add(i, -1)
+        if self._search(i, new_min, new_max):
+            return True
+        self.builder.pop()
+        self.used[i] = False
+        self._add(i, 1)
+        return False
+
+    def _search(self, end_index, current_min, current_max):
+        need = GROUP_SIZE - len(self.builder)
+        if need == 0:
+            return True
+        # 直前に加えたプレイヤー（players[end_index]）より後にたどる、レートが共通許容レンジ内の候補は players[first:last]
+        first = bisect_left(self.rates, current_min)
+        last = min(end_index, bisect_right(self.rates, current_max))
+        if self._prefix(last, self.tree) - self._prefix(first, self.tree) < need:
+            return False
+        if self.mask_trees is None:
+            # 全員が全ロール可ならロールの状態は区別しない
+            state = (last, current_min, current_max, need, self.builder.conflicts)
+        else:
+            state = (last, current_min, current_max, need, self.builder.state_key())
+        if state in self.failed:
+            return False
+        if self.mask_trees is not None and not self._roles_completable(first, last, need):
+            self.failed.add(state)
+            return False
+
+        for i in range(last - 1, first - 1, -1):
+            if not self.used[i] and self._try(i, current_min, current_max):
+                return True
+
+        self.failed.add(state)
+        return False
+
+    def _roles_completable(self, first, last, need):
+        """players[first:last] の未使用プレイヤーから need 人を加えて、ロール制約を満たせる見込みがあるか"""
+        def available(mask):
+            tree = self.mask_trees[mask]
+            return self._prefix(last, tree) - self._prefix(first, tree)
+
+        # 全ロール可の候補が need 人いれば、今のメンバーに何人加えてもロール制約には掛からない
+        if ALL_ROLES in self.mask_trees and available(ALL_ROLES) >= need:
+            return True
+        return self.builder.can_complete({mask: available(mask) for mask in self.mask_trees}, need)
+
+
+def dfs_group(players):
+    """
+    players から条件を満たす10人グループを1つ見つける（GroupSearch を参照）。
+
+    :param players: 各要素が辞書 {"user_id", "rate", "min_rating", "max_rating", ...} のリスト
+    :return: もし有効な10人グループが見つかればそのリストを返す。見つからなければ None
+    """
+    return GroupSearch(players).find()
+
+
+def find_valid_groups(players):
+    """
+    プレイヤーリストからDFS／バックトラッキングで条件を満たす10人グループを
+    重複なく全て見つける。例えば、30人の候補から3グループが見つかれば、
+    [group1, group2, group3] のリストを返す。
+
+    :param players: 各要素が辞書 {"user_id", "rate", "min_rating", "max_rating", ...} のリスト
+    :return: 有効なグループ（各グループは10人のリスト、レート降順）のリスト。グループが見つからなければ空リスト
+    """
+    groups = []
+    search = GroupSearch(players)
+    while True:
+        group = search.find()
+        if group is None:
+            break  # 残りからは10人グループが作れない
+        group.sort(key=lambda p: p["rate"], reverse=True)
+        groups.append(group)
+    return groups
+
+
+# 優先度スコアで、レートの中央値から1離れるごとに加算する秒数
+# （人の少ないレート帯ほど待ち時間が伸びやすいため、中央値から遠いプレイヤーを先にアンカーにする）
+PRIORITY_RATE_WEIGHT = 0.1
+# アンカーのグループ候補にする、レートの近いプレイヤーの数（片側）
+PRIORITY_CANDIDATES = 20
+
+
+def priority_score(player, now, median_rate):
+    """アンカーを選ぶ優先度。待ち時間（秒）に、レートの中央値からの距離を重み付けして加える"""
+    return (now - player["inqueued_unixtime"]) + PRIORITY_RATE_WEIGHT * abs(player["rate"] - median_rate)
+
+
+def priority_form_groups(players, now=None):
+    """
+    優先度（priority_score）の高いプレイヤーから順にアンカーとしてグループを形成する。
+
+    アンカーは優先度をキーにしたヒープから取り出す。レートの近い未使用プレイヤー（左右 PRIORITY_CANDIDATES 人）を、
+    共通許容レンジが空にならない限り、優先度の高い順に（成立しなければレートの近い順に）GroupBuilder に追加する。
+    10人に満たないアンカーは今回は見送り、次のアンカーを試す。
+
+    :param players: プレイヤー辞書のリスト（inqueued_unixtime を含むこと）
+    :param now: 待ち時間の基準時刻（省略時は現在時刻）
+    :return: マッチ成立したグループのリスト（各グループは10人のリスト、レート降順）
+    """
+    if now is None:
+        now = time.time()
+    if not players:
+        return []
+    # 未使用プレイヤーの (レート, インデックス) をレート昇順に保持する
+    remaining = sorted((p["rate"], i) for i, p in enumerate(players))
+    median_rate = remaining[len(remaining) // 2][0]
+    scores = [priority_score(p, now, median_rate) for p in players]
+
+    def build(anchor, candidates):
+        builder = GroupBuilder()
+        builder.add(players[anchor])
+        members = [anchor]
+        lower, upper = players[anchor]["min_rating"], players[anchor]["max_rating"]
+        for j in candidates:
+            p = players[j]
+            # 共通許容レンジ（全員の許容レンジの交差）が空にならないこと
+            new_lower, new_upper = max(lower, p["min_rating"]), min(upper, p["max_rating"])
+            if new_lower > new_upper or not builder.try_add(p):
+                continue
+            members.append(j)
+            lower, upper = new_lower, new_upper
+            if len(builder) == GROUP_SIZE:
+                return members
+        return None
+
+    heap = [(-scores[i], i) for i in range(len(players))]
+    heapq.heapify(heap)
+    used = [False] * len(players)
+    groups = []
+    while heap:
+        _, anchor = heapq.heappop(heap)
+        if used[anchor]:
+            continue
+        p = players[anchor]
+        # レートの近い未使用プレイヤー左右 PRIORITY_CANDIDATES 人のうち、許容レンジがアンカーと重なる人を候補にする
+        position = bisect_left(remaining, (p["rate"], anchor))
+        candidates = [
+            i for _, i in remaining[max(0, position - PRIORITY_CANDIDATES):position + PRIORITY_CANDIDATES + 1]
+            if i != anchor and players[i]["min_rating"] <= p["max_rating"] and p["min_rating"] <= players[i]["max_rating"]
+        ]
+        if len(candidates) < GROUP_SIZE - 1:
+            continue
+        group = build(anchor, sorted(candidates, key=lambda j: -scores[j]))
+        if group is None:
+            group = build(anchor, sorted(candidates, key=lambda j: abs(players[j]["rate"] - p["rate"])))
+        if group is None:
+            continue
+        for i in group:
+            used[i] = True
+            del remaining[bisect_left(remaining, (players[i]["rate"], i))]
+        groups.append(sorted((players[i] for i in group), key=lambda q: q["rate"], reverse=True))
+    return groups
+
+
+# --- パーティ（一緒にインキューしたプレイヤー） ---
+# 同じ party_id を持つプレイヤーは、同じグループ・同じチームにまとめて入れる。
+
+# パーティのアンカーから見て、レートの近い左右何ユニット（ソロまたはパーティ）を候補にするか
+PARTY_CANDIDATES = 20
+
+
+def party_split_feasible(sizes):
+    """パーティの人数 sizes を、どのパーティも分けずに5人ずつの2チームに振り分けられるか"""
+    total = sum(sizes)
+    reachable = {0}
+    for size in sizes:
+        reachable |= {s + size for s in reachable if s + size <= TEAM_SIZE}
+    return any(total - s <= TEAM_SIZE for s in reachable)
+
+
+def form_party_groups(players):
+    """
+    パーティを1つの単位（ユニット）として扱い、パーティを含むグループを先に形成する。
+
+    パーティのレートはメンバーの平均、許容レンジは平均 ± メンバーの許容レンジの幅の最小値とし、
+    メンバー全員の min_rating / max_rating をこの共通レンジに書き換える。
+    待ち時間の長いパーティから順にアンカーとし、レートの近い未使用ユニット（左右 PARTY_CANDIDATES 個）を
+    メンバーごと GroupBuilder に追加して10人ちょうどにする。パーティ同士は5対5に分けられる組み合わせに限る。
+
+    :param players: プレイヤー辞書のリスト（パーティのメンバーは party_id を持つ）
+    :return: (マッチ成立したグループのリスト, 残りのソロプレイヤーのリスト)。
+             グループを作れなかったパーティのメンバーは今回は見送り、どちらにも含めない
+    """
+    parties = {}
+    solos = []
+    for p in players:
+        if p.get("party_id"):
+            parties.setdefault(p["party_id"], []).append(p)
+        else:
+            solos.append(p)
+    if not parties:
+        return [], players
+
+    # ユニット: (レート, メンバー, パーティか)
+    units = [(p["rate"], [p], False) for p in solos]
+    for members in parties.values():
+        rate = sum(p["rate"] for p in members) / len(members)
+        width = min(p["rate"] - p["min_rating"] for p in members)
+        width = min(width, min(p["max_rating"] - p["rate"] for p in members))
+        for p in members:
+            p["min_rating"], p["max_rating"] = rate - width, rate + width
+        units.append((rate, members, True))
+    remaining = sorted((rate, u) for u, (rate, _, _) in enumerate(units))
+    used = [False] * len(units)
+
+    def try_unit(builder, members):
+        for k, p in enumerate(members):
+            if not builder.try_add(p):
+                for _ in range(k):
+                    builder.pop()
+                return False
+        return True
+
+    def build(anchor, candidates):
+        builder = GroupBuilder()
+        members = units[anchor][1]
+        if len(members) > GROUP_SIZE or not try_unit(builder, members):
+            return None
+        chosen = [anchor]
+        sizes = [len(members)]
+        lower, upper = members[0]["min_rating"], members[0]["max_rating"]
+        for u in candidates:
+            _, unit_members, is_party = units[u]
+            if len(builder) + len(unit_members) > GROUP_SIZE:
+                continue
+            if is_party and not party_split_feasible(sizes + [len(unit_members)]):
+                continue
+            new_lower = max([lower] + [p["min_rating"] for p in unit_members])
+            new_upper = min([upper] + [p["max_rating"] for p in unit_members])
+            if new_lower > new_upper or not try_unit(builder, unit_members):
+                continue
+            chosen.append(u)
+            if is_party:
+                sizes.append(len(unit_members))
+            lower, upper = new_lower, new_upper
+            if len(builder) == GROUP_SIZE:
+                return chosen
+        return None
+
+    groups = []
+    # 待ち時間の長い（インキューの早い）パーティから
+    anchors = sorted(
+        (u for u, (_, _, is_party) in enumerate(units) if is_party),
+        key=lambda u: min(p.get("inqueued_unixtime", 0) for p in units[u][1]),
+    )
+    for anchor in anchors:
+        if used[anchor]:
+            continue
+        rate, members, _ = units[anchor]
+        position = bisect_left(remaining, (rate, anchor))
+        candidates = [
+            u for _, u in remaining[max(0, position - PARTY_CANDIDATES):position + PARTY_CANDIDATES + 1]
+            if u != anchor
+            and units[u][1][0]["min_rating"] <= members[0]["max_rating"]
+            and members[0]["min_rating"] <= units[u][1][0]["max_rating"]
+        ]
+        chosen = build(anchor, sorted(candidates, key=lambda u: abs(units[u][0] - rate)))
+        if chosen is None:
+            continue
+        for u in chosen:
+            used[u] = True
+            del remaining[bisect_left(remaining, (units[u][0], u))]
+        group = [p for u in chosen for p in units[u][1]]
+        groups.append(sorted(group, key=lambda q: q["rate"], reverse=True))
+
+    rest = [units[u][1][0] for u in range(len(units)) if not used[u] and not units[u][2]]
+    return groups, rest
+
+
+def candidate_counts(rates, windows):
+    """
+    各プレイヤーの許容レンジ [下端, 上端] に、自分以外のプレイヤーが何人入っているかを返す。
+    レートをソートした配列に対してレンジの両端を bisect するので O(n log n)。
+    :param rates: レートのリスト
+    :param windows: rates と同じ並びの許容レンジ (下端, 上端) のリスト
+    :return: rates と同じ並びの人数のリスト
+    """
+    ordered = sorted(rates)
+    return [
+        bisect_right(ordered, high) - bisect_left(ordered, low) - (low <= rate <= high)
+        for rate, (low, high) in zip(rates, windows)
+    ]
+
+
+# 待ち時間の集計に使うレート帯の幅
+WAIT_STATS_BAND_WIDTH = 100
+
+
+def wait_time_stats(samples, band_width=WAIT_STATS_BAND_WIDTH):
+    """
+    (レート, 待ち時間) の組から、レート帯ごとの待ち時間の p50 / p95 / p99 と件数を求める。
+    :return: {レート帯の下端: {"count", "p50", "p95", "p99"}}
+    """
+    bands = {}
+    for rate, wait in samples:
+        bands.setdefault(int(rate) // band_width * band_width, []).append(wait)
+    stats = {}
+    for band, waits in sorted(bands.items()):
+        waits.sort()
+        stats[band] = {
+            "count": len(waits),
+            "p50": waits[min(len(waits) - 1, len(waits) * 50 // 100)],
+            "p95": waits[min(len(waits) - 1, len(waits) * 95 // 100)],
+            "p99": waits[min(len(waits) - 1, len(waits) * 99 // 100)],
+        }
+    return stats
+
+
+# レート帯ごとのマッチ成立人数の履歴を指数減衰させる時定数（秒）
+THROUGHPUT_DECAY_SECONDS = 1800
+# 減衰してこの値を下回ったレート帯は履歴から落とす
+THROUGHPUT_MIN_COUNT = 0.01
+
+
+def decay_throughput(throughput, updated_at, matched_rates, now,
+                     band_width=WAIT_STATS_BAND_WIDTH, decay_seconds=THROUGHPUT_DECAY_SECONDS):
+    """
+    レート帯ごとの成立人数の指数減衰付き累計を、前回の更新時刻 updated_at から now まで減衰させ、
+    今回成立したプレイヤーのレート matched_rates を加える。
+    累計 / decay_seconds が、直近 decay_seconds 秒程度を重視したレート帯ごとのスループット（人/秒）になる。
+    :return: {レート帯の下端: 減衰付きの成立人数}
+    """
+    factor = math.exp(-max(0, now - updated_at) / decay_seconds) if updated_at else 1.0
+    bands = {int(band): float(count) * factor for band, count in throughput.items()}
+    for rate in matched_rates:
+        band = int(rate) // band_width * band_width
+        bands[band] = bands.get(band, 0.0) + 1
+    return {band: count for band, count in sorted(bands.items()) if count >= THROUGHPUT_MIN_COUNT}
+
+
+# 待ち時間のヒストグラムの区間の上端（秒）。最後の区間はそれより長い待ち時間すべて
+WAIT_HISTOGRAM_EDGES = (15, 30, 45, 60, 90, 120, 180, 240, 300, 450, 600, 900, 1200, 1800, 3600)
+
+
+def decay_wait_histogram(histogram, updated_at, samples, now,
+                         band_width=WAIT_STATS_BAND_WIDTH, decay_seconds=THROUGHPUT_DECAY_SECONDS):
+    """
+    レート帯ごとの待ち時間のヒストグラム（区間は WAIT_HISTOGRAM_EDGES、件数は指数減衰付き）を
+    decay_throughput と同じく updated_at から now まで減衰させ、今回成立したプレイヤーの (レート, 待ち時間) samples を加える。
+    成立のないティックでも減衰させるだけで直近の分布が残るので、ティックごとの少ない件数に左右されない。
+    :return: {レート帯の下端: 区間ごとの減衰付きの件数のリスト}
+    """
+    factor = math.exp(-max(0, now - updated_at) / decay_seconds) if updated_at is not None else 1.0
+    bands = {int(band): [float(count) * factor for count in counts] for band, counts in histogram.items()}
+    for rate, wait in samples:
+        counts = bands.setdefault(int(rate) // band_width * band_width, [0.0] * (len(WAIT_HISTOGRAM_EDGES) + 1))
+        counts[bisect_left(WAIT_HISTOGRAM_EDGES, wait)] += 1
+    return {band: counts for band, counts in sorted(bands.items()) if sum(counts) >= THROUGHPUT_MIN_COUNT}
+
+
+def histogram_wait_stats(histogram):
+    """
+    decay_wait_histogram のヒストグラムから、wait_time_stats と同じ形式のレート帯ごとの統計を求める。
+    パーセンタイルはその順位が入る区間の上端（最後の区間は WAIT_HISTOGRAM_EDGES の最大値）で近似し、
+    count は減衰付きの件数を丸めたもの。
+    :return: {レート帯の下端: {"count", "p50", "p95", "p99"}}
+    """
+    def quantile(counts, total, q):
+        cumulative = 0.0
+        for k, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= total * q:
+                return WAIT_HISTOGRAM_EDGES[min(k, len(WAIT_HISTOGRAM_EDGES) - 1)]
+        return WAIT_HISTOGRAM_EDGES[-1]
+
+    stats = {}
+    for band, counts in sorted(histogram.items()):
+        total = sum(counts)
+        stats[band] = {
+            "count": int(round(total)),
+            "p50": quantile(counts, total, 0.50),
+            "p95": quantile(counts, total, 0.95),
+            "p99": quantile(counts, total, 0.99),
+        }
+    return stats
+
+
+def eta_table(throughput, waiting_rates, band_width=WAIT_STATS_BAND_WIDTH, decay_seconds=THROUGHPUT_DECAY_SECONDS):
+    """
+    レート帯ごとの予想待ち時間（秒）を求める。
+    今からインキューしたプレイヤーは、同じレート帯で既に待っている人数 + 1 人分がマッチするまで待つとみなし、
+    (待ち人数 + 1) / スループット とする。成立の履歴がないレート帯は None（予測不能）。
+    :return: {レート帯の下端: 予想待ち時間 or None}
+    """
+    waiting = {}
+    for rate in waiting_rates:
+        band = int(rate) // band_width * band_width
+        waiting[band] = waiting.get(band, 0) + 1
+    table = {}
+    for band in sorted(set(throughput) | set(waiting)):
+        per_second = throughput.get(band, 0) / decay_seconds
+        table[band] = int(math.ceil((waiting.get(band, 0) + 1) / per_second)) if per_second > 0 else None
+    return table
+
+
+def balance_teams(group, tolerance=0, rng=random):
+    """
+    10人グループを、チームのレート合計の差が最小になるように5対5に分ける。
+
+    TEAM_SPLITS の126通りのうち両チームとも5ロールを割り当てられる分け方だけを評価し、
+    差が (最小値 + tolerance) 以内の分け方からランダムに1つを選ぶ（tolerance=0 なら最小差の中から選ぶ）。
+    同じ party_id を持つメンバーは同じチームに入る分け方に限る。
+    チームA/Bの入れ替えもランダム。各チームはレート降順に並べて返すため、
+    team_A[i] と team_B[i] は同程度のレート帯になる。
+
+    :param group: 10人のプレイヤー辞書のリスト
+    :param tolerance: 最小差からどこまでを同等とみなすか（レート合計の差）
+    :return: (team_a, team_b)
+    """
+    rates = [p["rate"] for p in group]
+    masks = [p.get("role_mask", ALL_ROLES) for p in group]
+    total = sum(rates)
+    splits = TEAM_SPLITS
+    # 全ロール可のメンバーは残りのロールを埋められるので、ロールを絞っているメンバーだけ判定すればよい
+    restricted = sum(1 << i for i, mask in enumerate(masks) if mask != ALL_ROLES)
+    if restricted:
+        feasible = {}
+
+        def team_feasible(team_bits):
+            key = team_bits & restricted
+            if key not in feasible:
+                team_masks = tuple(sorted(masks[i] for i in range(GROUP_SIZE) if key >> i & 1))
+                feasible[key] = _assign_roles(team_masks) is not None
+            return feasible[key]
+
+        splits = [
+            split for split, (bits_a, bits_b) in zip(TEAM_SPLITS, TEAM_SPLIT_BITS)
+            if team_feasible(bits_a) and team_feasible(bits_b)
+        ]
+    if not splits:
+        # ロール制約を満たす分け方がない場合（GroupBuilder を通していないグループ）はレート差のみで選ぶ
+        splits = TEAM_SPLITS
+    # パーティは同じチームにする（ロール制約と両立しなければパーティを優先する）
+    party_bits = {}
+    for i, p in enumerate(group):
+        if p.get("party_id"):
+            party_bits[p["party_id"]] = party_bits.get(p["party_id"], 0) | 1 << i
+    if party_bits:
+        def keeps_parties(bits_a):
+            return all(bits & bits_a in (0, bits) for bits in party_bits.values())
+
+        split_bits = dict(zip(TEAM_SPLITS, TEAM_SPLIT_BITS))
+        together = [split for split in splits if keeps_parties(split_bits[split][0])]
+        if not together:
+            together = [split for split, (bits_a, _) in split_bits.items() if keeps_parties(bits_a)]
+        splits = together or splits
+    gaps = [abs(2 * (rates[a] + rates[b] + rates[c] + rates[d] + rates[e]) - total)
+            for (a, b, c, d, e), _ in splits]
+    limit = min(gaps) + tolerance
+    team_a, team_b = rng.choice([split for split, gap in zip(splits, gaps) if gap <= limit])
+    if rng.random() < 0.5:
+        team_a, team_b = team_b, team_a
+    return (
+        sorted((group[i] for i in team_a), key=lambda p: p["rate"], reverse=True),
+        sorted((group[i] for i in team_b), key=lambda p: p["rate"], reverse=True),
+    )
+
+
+# --- レート帯ごとの分割実行 ---
+# レート降順のプールを一部重なりのあるレート帯に分け、帯ごとのグループ形成を並列に実行する。
+# ワーカー（別プロセス・別Lambda）との受け渡しはJSONにできるコンパクトなレコードで行う。
+
+# 1つのレート帯に含めるプレイヤー数（重なり部分を除く）
+BAND_SIZE = 1000
+# 隣接するレート帯と共有するプレイヤー数（片側）
+BAND_OVERLAP = 100
+
+BAND_MATCHERS = {
+    "sweep": sweep_form_groups,
+    "optimal": optimal_form_groups,
+    "dfs": find_valid_groups,
+}
+
+
+def split_bands(n, band_size=BAND_SIZE):
+    """0..n-1 のインデックスを band_size 人ずつの重ならないレート帯 (lo, hi) に分ける"""
+    return [(lo, min(n, lo + band_size)) for lo in range(0, n, band_size)]
+
+
+def encode_band(players):
+    """ワーカーに渡すレコード [user_id, rate, min_rating, max_rating, role_mask, blocking] のリスト（無制限は None）"""
+    return [
+        [
+            p["user_id"],
+            p["rate"],
+            None if math.isinf(p["min_rating"]) else p["min_rating"],
+            None if math.isinf(p["max_rating"]) else p["max_rating"],
+            p.get("role_mask", ALL_ROLES),
+            p.get("blocking", ""),
+        ]
+        for p in players
+    ]
+
+
+def form_band_groups(records, matcher_name="sweep"):
+    """
+    ワーカー側の処理。encode_band のレコードからグループを形成し、各グループの user_id のリストを返す。
+    ブロックのビットはこの帯の中だけで振り直す。
+    """
+    players = [
+        {
+            "user_id": user_id,
+            "rate": rate,
+            "min_rating": -math.inf if min_rating is None else min_rating,
+            "max_rating": math.inf if max_rating is None else max_rating,
+            "role_mask": role_mask,
+            "blocking": blocking,
+        }
+        for user_id, rate, min_rating, max_rating, role_mask, blocking in records
+    ]
+    build_conflict_masks(players)
+    matcher = BAND_MATCHERS.get(matcher_name, sweep_form_groups)
+    return [[p["user_id"] for p in group] for group in matcher(players)]
+
+
+def sharded_form_groups(players, matcher_name="sweep", band_size=BAND_SIZE, overlap=BAND_OVERLAP, map_fn=map):
+    """
+    players（レート降順）をレート帯に分けてグループ形成を行い、結果を決定的に統合する。
+
+    1. 重ならないレート帯ごとのグループ形成を map_fn(form_band_groups, 帯のレコード, matcher名) で実行する
+       （map_fn にプロセスプールやLambda呼び出しの map を渡すと並列に実行される）
+    2. 各境界の前後 overlap 人（隣接する帯にまたがる重なり部分）のうち、1で残ったプレイヤーだけで
+       もう一度グループ形成を行う。重なり部分同士も互いに重ならないので、これも並列に実行できる
+    どちらの段階でも各プレイヤーは1つの範囲にしか属さないため、同じプレイヤーが2つのマッチに入ることはなく、
+    結果は実行順によらず一定になる。
+
+    :return: マッチ成立したグループのリスト（各グループは10人のリスト、レート降順）
+    """
+    if len(players) <= band_size:
+        return BAND_MATCHERS.get(matcher_name, sweep_form_groups)(players)
+    # 重なり部分が隣の境界の重なり部分とぶつからないようにする
+    overlap = min(overlap, band_size // 2)
+
+    index = {p["user_id"]: i for i, p in enumerate(players)}
+    used = [False] * len(players)
+    groups = []
+
+    def run(ranges):
+        parts = [[players[i] for i in range(lo, hi) if not used[i]] for lo, hi in ranges]
+        results = map_fn(form_band_groups, [encode_band(part) for part in parts], [matcher_name] * len(parts))
+        for band_groups in results:
+            for member_ids in band_groups:
+                members = [index[user_id] for user_id in member_ids]
+                for i in members:
+                    used[i] = True
+                groups.append(sorted((players[i] for i in members), key=lambda p: p["rate"], reverse=True))
+
+    bands = split_bands(len(players), band_size)
+    run(bands)
+    run([(lo - overlap, min(len(players), lo + overlap)) for lo, _ in bands[1:]])
+    return groups
+
+
+def total_rating_spread(groups):
+    """各グループのレート幅（最高-最低）の合計"""
+    return sum(max(p["rate"] for p in g) - min(p["rate"] for p in g) for g in groups)
+
+
+def make_benchmark_players(n, seed=0):
+    """ベンチマーク用に、実運用に近いレート・待ち回数分布のプレイヤーをn人生成する"""
+    rng = random.Random(seed)
+    players = []
+    for k in range(n):
+        rate = int(rng.gauss(1550, 120))
+        spread_count = rng.randint(0, RANGE_SPREAD_LIMIT)
+        spread_speed = rng.choice([10, 20, 30])
+        base = range_width(spread_speed, spread_count)
+        min_rating, max_rating = rate - base, rate + base
+        # 3割程度のプレイヤーは担当したいロールを1〜2個に絞っている
+        desired_role = ",".join(rng.sample(ROLES, rng.randint(1, 2))) if rng.random() < 0.3 else ""
+        players.append({
+            "user_id": f"bench-{k}",
+            "inqueued_unixtime": int(time.time()) - spread_count * RANGE_SPREAD_INTERVAL - rng.randrange(RANGE_SPREAD_INTERVAL),
+            "rate": rate,
+            "best": rate,
+            "min_rating": min_rating,
+            "max_rating": max_rating,
+            "role_mask": parse_role_mask(desired_role),
+            # 1割程度のプレイヤーは誰かをブロックしている
+            "blocking": f"bench-{rng.randrange(n)}" if rng.random() < 0.1 else "",
+        })
+    return build_conflict_masks(players)
+
+
+# --- ベンチマーク ---
+# python -m src.match_engine で実行する
+if __name__ == "__main__":
+    for n in (500, 2000, 5000, 20000):
+        players = make_benchmark_players(n)
+        for matcher in (sweep_form_groups, optimal_form_groups, find_valid_groups, priority_form_groups):
+            start = time.perf_counter()
+            groups = matcher(players)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{matcher.__name__}: players={n} groups={len(groups)} "
+                f"spread={total_rating_spread(groups)} per_group={total_rating_spread(groups) / max(len(groups), 1):.1f} "
+                f"elapsed={elapsed * 1000:.1f}ms"
+            )
+
+        # ロール・ブロック制約なしでのレート幅を form_matches_from_pool（レート降順のグリーディ）と比べる
+        unconstrained = [dict(p, role_mask=ALL_ROLES, conflict_mask=0, block_bit=0) for p in players]
+        by_rate = sorted(unconstrained, key=lambda p: p["rate"], reverse=True)
+        for name, matcher in (("greedy", form_matches_from_pool), ("sweep", sweep_form_groups)):
+            start = time.perf_counter()
+            groups = matcher(by_rate)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name} (no roles/blocks): players={n} groups={len(groups)} "
+                f"per_group={total_rating_spread(groups) / max(len(groups), 1):.1f} elapsed={elapsed * 1000:.1f}ms"
+            )
+
+        # レート帯に分けてプロセスプールで並列実行
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor() as executor:
+            for matcher_name in ("sweep", "optimal"):
+                start = time.perf_counter()
+                groups = sharded_form_groups(players, matcher_name, map_fn=executor.map)
+                elapsed = time.perf_counter() - start
+                print(
+                    f"sharded({matcher_name}): players={n} groups={len(groups)} "
+                    f"spread={total_rating_spread(groups)} elapsed={elapsed * 1000:.1f}ms"
+                )
+
+    group = make_benchmark_players(GROUP_SIZE)
+    rounds = 10000
+    start = time.perf_counter()
+    for _ in range(rounds):
+        balance_teams(group)
+    elapsed = time.perf_counter() - start
+    print(f"balance_teams: {elapsed / rounds * 1e6:.1f}us per match")
@@ -1,14 +1,14 @@
 import os
 import boto3
-import requests
 from time import sleep
-from requests.exceptions import RequestException
 import time
 from datetime import datetime, timezone
 import json
 import uuid
 
 from .match_queue import is_locked
+from .http_client import post_json, run_all
+from .allocator import release_vc
 
 MATCH_TABLE = os.environ["MATCH_TABLE"]
 USER_TABLE = os.environ["USER_TABLE"]
@@ -186,28 +186,20 @@ def judge_timeout(event, context):
                     update_player_data(teamA[i][0], rate_delta_a, result == "A-win", match_id, started_date, pokeA)
                     update_player_data(teamB[i][0], rate_delta_b, result == "B-win", match_id, started_date, pokeB)
 
-            # 通報が多いユーザーのペナルティ判定
-            for k,v in viodict.items():
-                if v > 3:
-                    try:
-                        print("penalty for user", k)
-                        penalty(k)
-                    except Exception as e:
-                        print("error at penalty: ", e)
+            # 通報が多いユーザーのペナルティ判定（Bubbleへの問い合わせはまとめて並行実行）
+            penalty_users = [k for k, v in viodict.items() if v > 3]
+            if penalty_users:
+                try:
+                    print("penalty for users", penalty_users)
+                    apply_penalties(penalty_users)
+                except Exception as e:
+                    print("error at penalty: ", e)
 
             vc_a = match_item.get("vc_A")  # or "vc_a" など実際のキー名に合わせる
             if vc_a is not None:
-                # queue_tableの#META# アイテムに対して、UnusedVCリストに vc_a を追加
-                queue_table.update_item(
-                    Key={"namespace": "default", "user_id": "#META#"},
-                    UpdateExpression="SET #unused_vc = list_append(if_not_exists(#unused_vc, :emptyList), :vcValue)",
-                    ExpressionAttributeNames={"#unused_vc": "UnusedVC"},
-                    ExpressionAttributeValues={
-                        ":emptyList": [],
-                        ":vcValue": [vc_a]
-                    }
-                )
-                print(f"Returned VC {vc_a} to UnusedVC list.")
+                # このマッチが確保していたVCを空きに戻す
+                if release_vc(queue_table, vc_a, match_id):
+                    print(f"Returned VC {vc_a} to the VC pool.")
 
 
             
@@ -357,55 +349,74 @@ def update_player_data(user_id, rate_delta, win, match_id, started_date, pokemon
         
 
 def penalty(user_id):
+    """単一ユーザーのペナルティ処理（apply_penalties のラッパー）"""
+    apply_penalties([user_id])
+
+
+async def fetch_penalty(user_id, correction):
     """
-    ペナルティを算出して Bubble API に送信し、
-    Bubble 側から返される user_penalty をもとに DynamoDB 上のユーザーデータを更新。
-    ペナルティが 1 以上の場合、レートを (ペナルティ * 4) 分だけ減算する。
+    Bubble API にペナルティ算出を依頼し、返された user_penalty を返す。
+    失敗時は None を返す。
     """
-    # 1) ユーザーデータを取得
-    response = user_table.get_item(
-        Key={
-            "namespace": "default",
-            "user_id": user_id,
-        },
-    )
-    if "Item" not in response:
-        # ユーザーが存在しない場合は処理しない
-        print(f"[INFO] penalty(): user {user_id} not found.")
-        return
-
-    user_item = response["Item"]
-    current_rate = user_item.get("rate", 1500)
-    
-    # 2) ペナルティ軽減値 (試合数 / 50) を計算
-    correction = user_item.get("unitemate_num_record", 0) // 50
-    
-    # 3) Bubble API にリクエストを送信し、レスポンスを取得
     json_data = {
         "player": user_id,
         "penaltycorrction": int(correction)
     }
     try:
-        bubble_response = requests.request(
-            method="POST",
-            url=BUBBLE_PENALTY,
-            headers=headers,
-            json=json_data
-        )
-        bubble_response.raise_for_status()  # 200系以外の場合は例外を投げる
+        status, text = await post_json(BUBBLE_PENALTY, json_data, headers)
     except Exception as e:
         print(f"[ERROR] penalty(): Failed to call Bubble API for user {user_id}. {e}")
-        return
+        return None
+    if status >= 300:
+        print(f"[ERROR] penalty(): Failed to call Bubble API for user {user_id}. status={status}")
+        return None
 
-    # 4) Bubble 側から返されたペナルティ値を取得
+    # Bubble が "user_penalty" というキーで返す想定
     try:
-        data = bubble_response.json()
-        # Bubble が "user_penalty" というキーで返す想定
-        user_penalty = data.get("user_penalty", 0)
+        return json.loads(text).get("user_penalty", 0)
     except ValueError:
-        print(f"[ERROR] penalty(): Could not parse JSON from Bubble for user {user_id}. Response: {bubble_response.text}")
-        return
+        print(f"[ERROR] penalty(): Could not parse JSON from Bubble for user {user_id}. Response: {text}")
+        return None
+
+
+def apply_penalties(user_ids):
+    """
+    ペナルティを算出して Bubble API に送信し、
+    Bubble 側から返される user_penalty をもとに DynamoDB 上のユーザーデータを更新。
+    ペナルティが 1 以上の場合、レートを (ペナルティ * 4) 分だけ減算する。
+    Bubble への問い合わせは共有HTTPクライアントで全ユーザー分を並行して行う。
+    """
+    # 1) ユーザーデータを取得
+    user_items = {}
+    for user_id in user_ids:
+        response = user_table.get_item(
+            Key={
+                "namespace": "default",
+                "user_id": user_id,
+            },
+        )
+        if "Item" not in response:
+            # ユーザーが存在しない場合は処理しない
+            print(f"[INFO] penalty(): user {user_id} not found.")
+            continue
+        user_items[user_id] = response["Item"]
+
+    # 2) ペナルティ軽減値 (試合数 / 50) を計算し、3) Bubble API へまとめて問い合わせる
+    targets = list(user_items)
+    results = run_all(
+        fetch_penalty(user_id, user_items[user_id].get("unitemate_num_record", 0) // 50)
+        for user_id in targets
+    )
+
+    for user_id, user_penalty in zip(targets, results):
+        if user_penalty is None or isinstance(user_penalty, Exception):
+            continue
+        current_rate = user_items[user_id].get("rate", 1500)
+        update_penalty(user_id, current_rate, user_penalty)
+
 
+def update_penalty(user_id, current_rate, user_penalty):
+    """4) Bubble 側から返されたペナルティ値を DynamoDB に反映する"""
     print(f"[INFO] penalty(): user {user_id} => user_penalty={user_penalty}")
 
     # 5) ペナルティを DynamoDB 上に保存するためのアップデート
@@ -1,25 +1,54 @@
 import os
 import random
-from datetime import datetime, timedelta, timezone
+import asyncio
+import decimal
 import json
 import time
+import uuid
 
-from requests.exceptions import RequestException
 import boto3
-import requests
-from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from .ws_helper import broadcast_queue_count
-import asyncio
-import math
-import aiohttp
-JST = timezone(timedelta(hours=+9), "JST")
+from .http_client import post_json, run_all
+from .queue_pool import load_pool, match_record_item, save_pool
+from .match_queue import evict_stale_entries
+from .queue_meta import META_LIST_REMOVE, META_LIST_SET, meta_list_values
+from .allocator import list_free_vcs, reserve_match_ids, vc_claim_item
+from .match_engine import (
+    BAND_MATCHERS,
+    BASE_RANGE,
+    assign_roles,
+    balance_teams,
+    build_conflict_masks,
+    decay_throughput,
+    decay_wait_histogram,
+    density_adaptive_ranges,
+    eta_table,
+    find_valid_groups,
+    form_matches_from_pool,
+    form_party_groups,
+    optimal_form_groups,
+    parse_role_mask,
+    priority_form_groups,
+    range_spread_count,
+    range_width,
+    form_band_groups,
+    histogram_wait_stats,
+    sharded_form_groups,
+    sweep_form_groups,
+)
 
 dynamodb = boto3.resource("dynamodb")
 queue_table = dynamodb.Table(os.environ["MATCH_QUEUE"])
 matches_table = dynamodb.Table(os.environ["MATCH_TABLE"])
 user_table = dynamodb.Table(os.environ["USER_TABLE"])
 connection_table = dynamodb.Table(os.environ["CONNECTION_TABLE"])
+# TransactWriteItems はリソースに無いためクライアントAPI（スレッドセーフ）を使う
+# リソース経由のクライアントなので、値はPythonの型のまま渡せる
+dynamodb_client = dynamodb.meta.client
+lambda_client = boto3.client("lambda")
 
 
 # TODO webhookURLはパラメータに移行したい
@@ -32,60 +61,222 @@ headers = {
         "Authorization": f"Bearer {BUBBLE_API_KEY}"
     }
 
-def acquire_lock():
+# 同時にコミットするマッチ数の上限
+FINALIZE_CONCURRENCY = 8
+# マッチのトランザクションが他の書き込みと衝突（TransactionConflict）した時の再試行回数と、待ち時間（秒）の基準・上限
+FINALIZE_RETRIES = 4
+FINALIZE_BACKOFF_BASE = 0.05
+FINALIZE_BACKOFF_CAP = 1.0
+
+# チーム分けで最小差と同等とみなすレート合計差（この範囲内の分け方からランダムに選ぶ）
+TEAM_BALANCE_TOLERANCE = 10
+
+# グループ形成アルゴリズム。event の "matcher" か環境変数 MATCHER で切り替える
+DEFAULT_MATCHER = os.environ.get("MATCHER", "sweep")
+
+# プールのレート分布に応じて許容レンジを絞るか（周囲に10人入る幅を待ち時間による幅の上限にする）
+DENSITY_ADAPTIVE_RANGE = os.environ.get("DENSITY_ADAPTIVE_RANGE", "true") == "true"
+
+# レート帯に分けた並列グループ形成。off: 分割しない / local: プロセスプール / lambda: 帯ごとにLambdaを同時実行
+# （Lambda 上では /dev/shm が無く multiprocessing のプールが使えないため、本番は lambda を使う）
+MATCH_SHARD_MODE = os.environ.get("MATCH_SHARD_MODE", "off")
+MATCH_BAND_FUNCTION = os.environ.get("MATCH_BAND_FUNCTION", "")
+# 同時に実行するレート帯の数の上限
+BAND_CONCURRENCY = 8
+
+# コミット処理のリースの有効期間（秒）。処理中に Lambda が落ちてもこの時間で自動的に失効する
+LEASE_SECONDS = 15
+
+# コンテナ内で保持する待ちプール（前回のティックで保存したスナップショットと同じ内容）
+pool_cache = None
+
+
+def select_matcher(event):
+    """event / 環境変数で指定されたグループ形成関数を返す。不明な指定はデフォルトにフォールバック"""
+    matchers = {
+        "greedy": form_matches_from_pool,
+        "sweep": sweep_form_groups,
+        "optimal": optimal_form_groups,
+        "dfs": find_valid_groups,
+        "priority": priority_form_groups,
+    }
+    name = (event or {}).get("matcher", DEFAULT_MATCHER)
+    if name not in matchers:
+        print(f"unknown matcher: {name}. fallback to {DEFAULT_MATCHER}")
+        name = DEFAULT_MATCHER
+    return matchers[name]
+
+def invoke_band(records, matcher_name):
+    """レート帯1つ分のグループ形成を band_handler のLambdaで実行する"""
+    response = lambda_client.invoke(
+        FunctionName=MATCH_BAND_FUNCTION,
+        Payload=json.dumps({"players": records, "matcher": matcher_name}),
+    )
+    return json.loads(response["Payload"].read())["groups"]
+
+
+def form_groups(event, players):
+    """設定に応じて、プール全体またはレート帯ごとの並列実行でグループを形成する"""
+    matcher = select_matcher(event)
+    mode = (event or {}).get("shard_mode", MATCH_SHARD_MODE)
+    if mode == "off" or matcher not in BAND_MATCHERS.values():
+        print("matcher:", matcher.__name__)
+        return matcher(players)
+
+    matcher_name = next(name for name, fn in BAND_MATCHERS.items() if fn is matcher)
+    print("matcher:", matcher.__name__, "shard mode:", mode)
+    if mode == "lambda":
+        with ThreadPoolExecutor(max_workers=BAND_CONCURRENCY) as executor:
+            return sharded_form_groups(players, matcher_name, map_fn=lambda fn, *args: list(executor.map(invoke_band, *args)))
+    with ProcessPoolExecutor(max_workers=BAND_CONCURRENCY) as executor:
+        return sharded_form_groups(players, matcher_name, map_fn=executor.map)
+
+
+def band_handler(event, context):
+    """レート帯ワーカーのエントリポイント。event は {"players": encode_band のレコード, "matcher": 名前}"""
+    return {"groups": form_band_groups(event["players"], event.get("matcher", "sweep"))}
+
+def acquire_lease(owner):
     """
-    lock フィールドを無条件に 1 に更新する。
-    すでに lock=1 でも上書きされるのでご注意ください。
+    コミット処理用のリースを #META# に条件付き書き込みで取得し、フェンストークンを返す。
+    リースが有効期限内で他の owner が保持している場合は None を返す。
+    取得のたびに fence_token を +1 するので、期限切れ後に処理を続けた古い保持者の書き込みは
+    トークンの不一致で失敗する（finalize_match・META・プールの書き込みで確認する）。
     """
+    now = int(time.time())
     try:
-        queue_table.update_item(
+        response = queue_table.update_item(
             Key={"namespace": "default", "user_id": "#META#"},
-            UpdateExpression="SET #lk = :locked",
-            ExpressionAttributeNames={"#lk": "lock"},
-            ExpressionAttributeValues={":locked": 1},
+            UpdateExpression="SET lease_owner = :owner, lease_expires_at = :expires ADD fence_token :one",
+            ConditionExpression="attribute_not_exists(lease_expires_at) OR lease_expires_at < :now OR lease_owner = :owner",
+            ExpressionAttributeValues={
+                ":owner": owner,
+                ":expires": now + LEASE_SECONDS,
+                ":now": now,
+                ":one": 1,
+            },
+            ReturnValues="UPDATED_NEW",
         )
-        print("ロックを(強制的に)セットしました (lock=1)")
-    except Exception as e:
-        print(f"ロック設定エラー: {e}")
-
-def release_lock():
-    """
-    lock を無条件に 0 に更新する。
-    """
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            print("リースは他のマッチメイク処理が保持しています")
+        else:
+            print(f"リース取得エラー: {e}")
+        return None
+    fence_token = int(response["Attributes"]["fence_token"])
+    print(f"リースを取得しました (fence_token={fence_token})")
+    return fence_token
+
+def release_lease(owner, fence_token):
+    """自分が保持しているリースだけを解放する（期限切れ後に他者が取得していれば何もしない）"""
     try:
         queue_table.update_item(
             Key={"namespace": "default", "user_id": "#META#"},
-            UpdateExpression="SET #lk = :unlock",
-            ExpressionAttributeNames={"#lk": "lock"},
-            ExpressionAttributeValues={":unlock": 0},
+            UpdateExpression="SET lease_expires_at = :zero",
+            ConditionExpression="lease_owner = :owner AND fence_token = :t",
+            ExpressionAttributeValues={":zero": 0, ":owner": owner, ":t": fence_token},
         )
-        print("ロックを解放しました (lock=0)")
-    except Exception as e:
-        print(f"ロック解放エラー: {e}")
+        print(f"リースを解放しました (fence_token={fence_token})")
+    except ClientError as e:
+        print(f"リース解放エラー: {e}")
 
-def update_queue_meta(players):
+def update_queue_meta(players, tick_unixtime):
+    """
+    METAアイテムの待ちプレイヤー一覧（queue_meta の形式）と、許容レンジの基準時刻 tick_unixtime を更新する。
+    一覧を書くのはティックだけ（インキュー・デキューは書き換えない）なので、間にインキュー・デキューがあっても書き込む。
+    並行して動いた後のティック（tick_unixtime が新しい）が先に書き込んでいれば、古いプールで上書きしない。
+    """
     try:
         new_rate_list = []
         new_range_list = []
-        print("update_queue_meta p:",players)
+        new_window_list = []
         for player in players:
-            rating = player["rate"] 
-            spread_count = player["range_spread_count"]
-            spread_speed = player["range_spread_speed"]
-            new_rate_list.append(rating)
-            new_range_list.append(50 + spread_speed * spread_count)
+            new_rate_list.append(player["rate"])
+            new_range_list.append(BASE_RANGE + player["range_spread_speed"] * player["range_spread_count"])
+            # 密度・パーティで絞った後の、今回のグループ形成で実際に使った許容レンジ
+            new_window_list.append((player["min_rating"], player["max_rating"]))
 
-        # METAデータに rate_list, range_list を一度に更新
+        # METAデータに一覧と tick_unixtime を一度に更新（旧形式の一覧と、差分更新に使っていた meta_version は消す）
         queue_table.update_item(
             Key={"namespace": "default", "user_id": "#META#"},
-            UpdateExpression="SET rate_list = :rl, range_list = :rnl",
+            UpdateExpression=f"SET {META_LIST_SET}, tick_unixtime = :t REMOVE {META_LIST_REMOVE}, meta_version",
+            ConditionExpression="attribute_not_exists(tick_unixtime) OR tick_unixtime <= :t",
             ExpressionAttributeValues={
-                ":rl": new_rate_list,
-                ":rnl": new_range_list,
+                **meta_list_values(new_rate_list, new_range_list, new_window_list),
+                ":t": tick_unixtime,
             })
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        print("queue meta was rewritten by a newer tick. skip rewriting the lists")
     except Exception as e:
         print("error at update_queue_meta", e)
-        
+
+
+def subtract_queue_count(count):
+    """
+    #META# の queue_count（待ち人数）から、このティックでマッチが確定した count 人をまとめて引く。
+    失敗してもずれは reconcile_queue_count の数え直しで補正される。
+    """
+    if not count:
+        return
+    try:
+        queue_table.update_item(
+            Key={"namespace": "default", "user_id": "#META#"},
+            UpdateExpression="ADD queue_count :n",
+            ExpressionAttributeValues={":n": -count},
+        )
+    except Exception as e:
+        print("error at subtract_queue_count", e)
+
+
+def update_eta_table(meta_item, matched, players, tick_unixtime):
+    """
+    METAアイテムのレート帯ごとの成立人数と待ち時間のヒストグラムの履歴（指数減衰）に、
+    今回成立したプレイヤーの (レート, 待ち時間) matched を加え、予想待ち時間の表と待ち時間の統計（wait_stats）を作り直す。
+    get_eta・get_info はこれらを読むだけなので、マッチテーブルを集計せずに1回の読み取りで応答できる。
+    履歴は読み込み時点の band_throughput_updated_at を条件に書き込み、並行するティックの成立分を上書きしない
+    （条件が合わなければ今回は更新を見送り、次のティックで減衰・加算し直す）。
+    """
+    updated_at = meta_item.get("band_throughput_updated_at")
+    try:
+        previous = int(updated_at) if updated_at is not None else None
+        throughput = decay_throughput(
+            meta_item.get("band_throughput", {}),
+            previous,
+            [rate for rate, _ in matched],
+            tick_unixtime,
+        )
+        histogram = decay_wait_histogram(meta_item.get("wait_histogram", {}), previous, matched, tick_unixtime)
+        table = eta_table(throughput, [p["rate"] for p in players])
+        if updated_at is None:
+            condition = "attribute_not_exists(band_throughput_updated_at)"
+            values = {}
+        else:
+            condition = "band_throughput_updated_at = :prev"
+            values = {":prev": updated_at}
+        queue_table.update_item(
+            Key={"namespace": "default", "user_id": "#META#"},
+            UpdateExpression=(
+                "SET band_throughput = :tp, band_throughput_updated_at = :t, eta_table = :eta, "
+                "wait_histogram = :wh, wait_stats = :ws"
+            ),
+            ConditionExpression=condition,
+            ExpressionAttributeValues={
+                # DynamoDB には float を書き込めず、マップのキーは文字列にする
+                ":tp": {str(band): decimal.Decimal(f"{count:.4f}") for band, count in throughput.items()},
+                ":t": tick_unixtime,
+                ":eta": {str(band): eta for band, eta in table.items()},
+                ":wh": {
+                    str(band): [decimal.Decimal(f"{count:.4f}") for count in counts]
+                    for band, counts in histogram.items()
+                },
+                ":ws": {str(band): stats for band, stats in histogram_wait_stats(histogram).items()},
+                **values,
+            },
+        )
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        print("throughput was updated by another process. skip updating the ETA table")
+    except Exception as e:
+        print("error at update_eta_table", e)
 
 def update_bubble_queue_via_ws():
     # 接続している全ユーザーの connection_id を取得
@@ -98,142 +289,209 @@ def update_bubble_queue_via_ws():
     except Exception as e:
         print("error at update_bubble_queue_via_ws", e)
 
-# 20秒毎に呼ばれるマッチメイク処理のエントリポイント
+# マッチメイク処理のエントリポイント
+# インキューで待ち人数が揃った時（event["trigger"] == "inqueue"）と、フォールバックの20秒タイマーから呼ばれる
 def handle(event, context):
     """
-    1. QueueTableからプレイヤーを取得し、
-       ユーザーごとの最新レートと許容レンジを計算する。
-    2. プレイヤーをレートの高い順にソートし、上からグループ形成の試行を行う。
-    3. 10人グループが形成できたらマッチ成立とし、グループに入らなかったプレイヤーは
-       次回のためにrange_spread_countをインクリメントする。
+    1. 前回のスナップショットにインキュー・デキューの差分とマッチ成立の記録を適用して待ちプールを復元し、
+       ユーザーごとの最新レートと、インキューからの待ち時間に応じた許容レンジを計算する。
+    2. プレイヤーをレートの高い順にソートし、グループ形成の試行を行う。
+    3. 10人グループが形成できたらマッチ成立とする。グループに入らなかったプレイヤーは
+       次回のティックで待ち時間が伸びた分だけ許容レンジが広がる（キューへの書き込みは不要）。
+    グループ形成まではロックなしで行い、マッチの確定（コミット）の間だけリースを保持する。
+    通知の送信と META の更新はリースを解放してから行う。
     """
-    acquire_lock()
-    print("start match making process")
+    global pool_cache
+    print("start match making process", (event or {}).get("trigger", "timer"))
+    # 許容レンジの基準時刻。今回のティックでは全員をこの時刻時点の待ち時間で評価する
+    tick_unixtime = int(time.time())
+    pool = None
+    lease_owner = uuid.uuid4().hex
+    fence_token = None
+    observed_fence_token = None
     try:
-        waiting_users = get_waiting_users(queue_table)
-        print(waiting_users)
-        if len(waiting_users) < 10:
-            print("users in the queue is not enough. End the match making with increment the range.")
-            for p in waiting_users:
-                
-                increment_range_spread_count(p["user_id"])
-            update_queue_meta(waiting_users)
+        # ハートビートが途絶えたプレイヤー（サイトを閉じたなど）をキューから外す。
+        # デキューと同じく差分として記録されるので、この後復元するプールには生きているプレイヤーだけが残る
+        evict_stale_entries(tick_unixtime)
+        # 待ちプールを復元（読み込み量はキューの人数ではなく前回からの出入りの数に比例する）
+        meta_item = queue_table.get_item(Key={"namespace": "default", "user_id": "#META#"}, ConsistentRead=True).get("Item", {})
+        pool = load_pool(queue_table, meta_item, pool_cache)
+        # マッチを確定させない場合は、読み込み時点から他の処理がコミットしていないことを条件にプールを保存する
+        observed_fence_token = int(meta_item.get("fence_token", 0))
+        # 許容レンジの基準時刻は #META# の tick_unixtime（前回のティック）より戻さない。
+        # 時計のずれたコンテナがティックを実行しても許容レンジが狭まらず、一覧の書き込みも見送られない
+        tick_unixtime = max(tick_unixtime, int(meta_item.get("tick_unixtime", 0)))
+
+        # 各プレイヤーの最新レートと許容レンジを計算（プールは既にレートの降順）
+        players = [to_player(entry, tick_unixtime) for entry in pool.entries()]
+
+        if len(players) < 10:
+            print("users in the queue is not enough. End the match making.")
+            update_queue_meta(players, tick_unixtime)
+            update_eta_table(meta_item, [], players, tick_unixtime)
             # update_bubble_queue_via_ws()
             return {
                 "statusCode": 200,
-                "body": "No matches found. Incremented range_spread_count for all waiting players."
+                "body": "No matches found."
             }
-        
-        # 各プレイヤーの最新レートと許容レンジを計算
-        players = []
-        for user in waiting_users:
-            user_id = user["user_id"]
-            # ★ 将来拡張: blocking, role を利用した処理をここに挿入可能
-            rating = user["rate"] #get_user_rating(user_id)
-            best = user["best"] #get_user_rating(user_id)
-            spread_count = user["range_spread_count"]
-            spread_speed = user["range_spread_speed"]
-            
-            if spread_count >= 5:
-                min_rating = -math.inf
-                max_rating = math.inf
-            else:
-                base = 50 + spread_speed * spread_count
-                min_rating = rating - base
-                max_rating = rating + base
-            
-            players.append({
-                "user_id": user_id,
-                "rate": rating,
-                "best": best,
-                "min_rating": min_rating,
-                "max_rating": max_rating,
-                "range_spread_speed": spread_speed,
-                "range_spread_count": spread_count,
-                "inqueued_unixtime": user["inqueued_unixtime"],
-                "discord_id": user["discord_id"] # キュー情報に含む
-            })
-        
-        # 降順（高い順）にソート
-        players.sort(key=lambda x: x["rate"], reverse=True)
+
+        if DENSITY_ADAPTIVE_RANGE:
+            density_adaptive_ranges(players)
+
+        # blocking を解析し、同じグループに入れてはいけない組み合わせをビットセットにする
+        build_conflict_masks(players)
         
         # インキューした時間順（古い順＝先に入った順）にソート
         #players.sort(key=lambda x: x["inqueued_unixtime"])
         
         # グループ形成：できるだけ多くの10人グループを形成する
-        matched_groups = form_matches_from_pool(players)
-
-        # BFSを採用したメソッドを使用
-        #matched_groups = find_valid_groups(players)
+        # sweep: O(n log n)のスイープ / optimal: DP とスイープの良い方を1人単位の入れ替えで改善
+        # dfs: 枝刈り付きバックトラッキング / greedy: 旧実装
+        # priority: 待ち時間とレートの偏りから求めた優先度の高いプレイヤーを先にアンカーにする
+        # MATCH_SHARD_MODE を指定するとレート帯ごとに並列実行する
+        # パーティを含むグループを先に作り、残りのソロプレイヤーで通常のグループ形成を行う
+        party_groups, solo_players = form_party_groups(players)
+        matched_groups = party_groups + form_groups(event, solo_players)
         
         if matched_groups:
 
             print("match group made")
-            # METAアイテムから最新のマッチIDを取得（なければ初期値0）  
-            meta_item = queue_table.get_item(Key={"namespace": "default", "user_id": "#META#"}).get("Item")
-            match_id_base = int(meta_item.get("LatestMatchID", 0))
-            unused_vc = meta_item.get("UnusedVC", list(range(1, 100, 2)))
-            
-            # 各グループに対して連番のマッチIDを割り当て、マッチレコードを作成＆通知
-            for i, group in enumerate(matched_groups):
-                current_match_id = match_id_base + i + 1
-                # VCの割り当て：UnusedVCから先頭の奇数をpop（チームAのVC）、チームBはその値+1
-                if len(unused_vc) < 1:
-                    raise Exception("UnusedVCが不足しています。")
-                vc_a = unused_vc.pop(0)
-                vc_b = vc_a + 1
-                finalize_match(group, current_match_id, vc_a, vc_b)
-           
-            # METAアイテムの更新：LatestMatchID と UnusedVC を１回の update_item で更新
-            new_match_id_base = match_id_base + len(matched_groups)
-            print("idbase, new, unusedvc",match_id_base, new_match_id_base, unused_vc)
-            queue_table.update_item(
-                Key={"namespace": "default", "user_id": "#META#"},
-                UpdateExpression="SET LatestMatchID = :newID, UnusedVC = :vcList",
-                ExpressionAttributeValues={":newID": new_match_id_base, ":vcList": unused_vc}
-            )
-            
-            # 形成できなかったプレイヤーはrate_spread_countをインクリメント
+            # ここからコミット処理。取得できなければ他の処理がコミット中なので、今回は見送る
+            fence_token = acquire_lease(lease_owner)
+            if fence_token is None:
+                pool = None
+                return {
+                    "statusCode": 200,
+                    "body": "Another match making process is committing."
+                }
+            # 空きVCを確保できる数だけマッチを確定させる
+            # （コミットはリースを持つ1つの処理だけが行うので、VCは小さい番号から順に使う）
+            free_vcs = list_free_vcs(queue_table)
+            if len(free_vcs) < len(matched_groups):
+                print(f"空きVCが不足しています。{len(matched_groups) - len(free_vcs)}グループは次回以降に持ち越します")
+                matched_groups = matched_groups[:len(free_vcs)]
+            # マッチIDはまとめて予約する（確定できなかったマッチのIDは欠番になる）
+            match_ids = reserve_match_ids(queue_table, len(matched_groups))
+            assignments = [
+                (group, match_id, vc_a, vc_a + 1)
+                for group, match_id, vc_a in zip(matched_groups, match_ids, free_vcs)
+            ]
+
+            # マッチ毎に1トランザクションで確定させる。独立したマッチは並行してコミットする
+            # （1つのマッチの例外で、確定済みの他のマッチの通知・集計を飛ばさないよう、結果はマッチ毎に受け取る）
+            with ThreadPoolExecutor(max_workers=FINALIZE_CONCURRENCY) as executor:
+                futures = [executor.submit(finalize_match, *a, fence_token=fence_token) for a in assignments]
+            results = []
+            for (group, current_match_id, vc_a, vc_b), future in zip(assignments, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    print(f"match {current_match_id} could not be finalized: {e}")
+                    results.append(None)
+
+            committed_groups = []
+            notifications = []
+            for (group, current_match_id, vc_a, vc_b), teams in zip(assignments, results):
+                if teams is None:
+                    # 確定できなかったマッチはVCも確保されていない。メンバーは次回以降に持ち越す
+                    continue
+                committed_groups.append(group)
+                pool.apply_match(match_record_item(current_match_id, group))
+                team_a_players, team_b_players = teams
+                notifications.extend(notify_match(current_match_id, vc_a, vc_b, team_a_players, team_b_players))
+            matched_groups = committed_groups
+            subtract_queue_count(sum(len(group) for group in matched_groups))
+            # リースはコミットの間だけ保持する。外部への通知や META の更新の前にプールを保存して解放する
+            finish_commit(pool, lease_owner, fence_token, observed_fence_token)
+            pool = fence_token = None
+
+            # このtickで確定した全マッチの通知を共有セッションでまとめて送信する
+            for result in run_all(notifications):
+                if isinstance(result, Exception):
+                    print(f"通知の送信に失敗しました: {result}")
+
+            # 形成できなかったプレイヤーの許容レンジは待ち時間から求まるので、個別の書き込みは不要
             used_ids = {p["user_id"] for group in matched_groups for p in group}
-            remined_user = []
-            for p in players:
-                if p["user_id"] not in used_ids:
-                    increment_range_spread_count(p["user_id"])
-                    remined_user.append(p)
-            update_queue_meta(remined_user)
+            remined_user = [p for p in players if p["user_id"] not in used_ids]
+            update_queue_meta(remined_user, tick_unixtime)
+            # レート帯ごとの待ち時間（裾野の待ち時間が縮んでいるかの確認用）も履歴に加える
+            update_eta_table(
+                meta_item,
+                [(p["rate"], tick_unixtime - p["inqueued_unixtime"]) for group in matched_groups for p in group],
+                remined_user,
+                tick_unixtime,
+            )
             # update_bubble_queue_via_ws()
             return {
                 "statusCode": 200,
-                "body": f"Matched {len(matched_groups)} groups. Match IDs assigned from {match_id_base+1} to {new_match_id_base}."
+                "body": f"Matched {len(matched_groups)} groups. Match IDs reserved: {match_ids}."
             }
         else:
-            # 1件もマッチ成立しなかった場合は、全員のrange_spread_countをインクリメント
-            for p in players:
-                increment_range_spread_count(p["user_id"])
-
-            update_queue_meta(players)
+            update_queue_meta(players, tick_unixtime)
+            update_eta_table(meta_item, [], players, tick_unixtime)
             # update_bubble_queue_via_ws()
             return {
                 "statusCode": 200,
-                "body": "No matches found. Incremented range_spread_count for all waiting players."
+                "body": "No matches found."
             }
         
         
     except Exception as e:
-        print("ERROR: ", e) 
+        print("ERROR: ", e)
+        return {
+            "statusCode": 500,
+            "body": f"Match making failed: {e}"
+        }
     finally:
-        
-        release_lock()
-
-def get_waiting_users(queue):
-    """マッチキューからマッチング待ちのユーザを取得"""
-    response = queue.query(
-        IndexName="rate_index",
-        KeyConditionExpression=Key("namespace").eq("default"),
-        FilterExpression=Attr("user_id").ne("#META#"),  # user_id != "#META#"
-        ProjectionExpression="user_id, rate, best, blocking, desired_role, range_spread_speed, range_spread_count, discord_id, inqueued_unixtime"
-    )
-    return response["Items"]
+        if pool is not None or fence_token is not None:
+            # マッチを確定させなかった（または途中で例外になった）ティック
+            finish_commit(pool, lease_owner, fence_token, observed_fence_token)
+
+def finish_commit(pool, lease_owner, fence_token, observed_fence_token):
+    """
+    待ちプールを保存して次のティック用にキャッシュし、リースを保持していれば解放する。
+    fence_token はこのティックで取得したリースのトークン（取得していなければ None）。
+    """
+    global pool_cache
+    if fence_token is not None and fence_token != observed_fence_token + 1:
+        # プールの読み込みからリースの取得までに他の処理がマッチを確定させている。
+        # そのマッチ成立はこのプールに入っていないので、保存もキャッシュもせず次のティックで読み直す
+        print(f"fence_token advanced from {observed_fence_token} to {fence_token}. drop the pool")
+        pool = None
+        pool_cache = None
+    if pool is not None:
+        # マッチ成立は #MATCHED# の記録から復元できるので、スナップショットは記録がたまった時だけ書き直す
+        try:
+            if pool.needs_snapshot():
+                save_pool(queue_table, pool, fence_token if fence_token is not None else observed_fence_token)
+            pool_cache = pool
+        except Exception as e:
+            print("error at save_pool", e)
+            pool_cache = None
+    if fence_token is not None:
+        release_lease(lease_owner, fence_token)
+
+def to_player(entry, tick_unixtime):
+    """待ちプールのレコード（queue_pool.PoolEntry）から、グループ形成に使うプレイヤー辞書を作る"""
+    rating = entry.rate
+    spread_speed = entry.range_spread_speed
+    # 許容レンジはインキューからの待ち時間で決まる（range_spread_count をキューに書き戻す必要はない）
+    spread_count = range_spread_count(entry.inqueued_unixtime, tick_unixtime)
+    width = range_width(spread_speed, spread_count)
+    return {
+        "user_id": entry.user_id,
+        "rate": rating,
+        "best": entry.best,
+        "min_rating": rating - width,
+        "max_rating": rating + width,
+        "range_spread_speed": spread_speed,
+        "range_spread_count": spread_count,
+        "inqueued_unixtime": entry.inqueued_unixtime,
+        "discord_id": entry.discord_id, # キュー情報に含む
+        "role_mask": parse_role_mask(entry.desired_role), # 担当可能なロールのビットマスク
+        "blocking": entry.blocking,
+        "party_id": entry.party_id, # 一緒にインキューしたパーティ（ソロは空文字）
+    }
 
 def get_user_rating(user_id):
     """UserTableから最新のレートを取得する"""
@@ -242,141 +500,156 @@ def get_user_rating(user_id):
         return resp["Item"].get("rate", 1500)
     return 1500
 
-def form_matches_from_pool(pool):
+def finalize_match(group, match_id, vc_a, vc_b, fence_token=None):
     """
-    pool: 降順（レートが高い順）にソートされたプレイヤーのリスト
-    戻り値: マッチ成立したグループのリスト（各グループは10人のリスト）
-    
-    各アンカーからグループ形成を試み、グループ形成が成功したら
-    そのメンバーをpoolから除外して、以降は未マッチのプレイヤーのみで再試行する。
+    マッチ成立した10人グループに対して、以下を1つの TransactWriteItems で書き込む。
+    途中で失敗した場合は何も書き込まれない（キューから抜けたプレイヤーがいた場合なども含む）。
+      1. QueueTableから各プレイヤーのエントリを削除する（プールを読んだ時と同じインキューのまま残っていることを条件とする）。
+      2. UserTableの各プレイヤーの assigned_match_id を match_id に更新する。
+      3. MatchesTableへマッチレコードを作成（match_idは引数で与えられる連番）。
+         チームAのVC番号は vc_a、チームBのVC番号は vc_b とする。
+      4. VC vc_a を match_id で確保する（空いていることを条件とする）。
+      5. 待ちプールから外すための、マッチ成立の記録（#MATCHED#）を作成する。
+    fence_token を指定した場合は、#META# の fence_token が一致すること（リースを失っていないこと）も条件とする。
+    #META# はインキュー・デキューのたびに書き込まれるので、トランザクションでは書き込まずに条件の確認だけにする
+    （queue_count はコミット後に subtract_queue_count でまとめて減らす）。
+    それでも条件の確認が並行する書き込みと衝突して取り消されることがあるので、その場合だけ FINALIZE_RETRIES 回まで再試行する。
+    チーム分けは、チームのレート合計の差が最小になるようにチームA・Bに分ける。
+
+    通信エラーなどで書き込まれたか分からない場合は、マッチレコードの有無で確定したかどうかを判断する。
+
+    戻り値: 成功時は (team_a_players, team_b_players)、トランザクションが失敗した場合は None
     """
-    matched_groups = []
-    used_ids = set()  # すでにマッチに採用されたプレイヤーのID
-    
-    # pool内の各プレイヤーについて、未マッチならアンカーとしてグループ形成を試行
-    for player in pool:
-        if player["user_id"] in used_ids:
-            continue
-        group = try_form_group(player, pool, used_ids)
-        if group and len(group) == 10:
-            matched_groups.append(group)
-            # マッチに採用されたプレイヤーのIDを記録
-            for p in group:
-                used_ids.add(p["user_id"])
-    return matched_groups
-
-def try_form_group(anchor, pool, used_ids):
-    """
-    アンカーからグループ形成をグリーディに試みる。
-    ・初期グループは [anchor] とし、交差区間 I を anchor の許容レンジで初期化する。
-    ・pool内（かつ未採用のプレイヤー）を降順で走査し、各候補について
-      新たな交差区間 I' = intersection(I, candidateのレンジ) を計算する。
-      もし I' が空でなければ、候補をグループに追加し、I を I' に更新する。
-    ・グループのサイズが10になれば成功とする。
-    戻り値: 形成されたグループ（サイズ10のリスト）または None
-    """
-    group = [anchor]
-    # 現在の交差区間 I = [current_min, current_max]
-    current_min = anchor["min_rating"]
-    current_max = anchor["max_rating"]
-    
-    # pool内で、かつ既にマッチに採用されていないプレイヤーを対象に（アンカーを除く）
-    # ※すでに採用済みのものは除外
-    for candidate in pool:
-        if candidate["user_id"] in used_ids:
-            continue
-        if candidate["user_id"] == anchor["user_id"]:
-            continue
-        # 新たな交差区間を計算
-        new_min = max(current_min, candidate["min_rating"])
-        new_max = min(current_max, candidate["max_rating"])
-        if new_min <= new_max:
-            # candidateをグループに追加できる
-            group.append(candidate)
-            current_min, current_max = new_min, new_max
-            if len(group) == 10:
-                return group
-    # 10人に満たなければ失敗
-    return None
-
-
-def finalize_match(group, match_id, vc_a, vc_b):
-    """
-    マッチ成立した10人グループに対して：
-      1. QueueTableから各プレイヤーのエントリを削除する。
-      2. MatchesTableへマッチレコードを作成（match_idは引数で与えられる連番）。
-      3. METAアイテムからUnusedVC（奇数のみのリスト）を取得し、先頭の奇数をpopし、
-         チームAのVC番号とし、チームBのVC番号はそのVC+1とする。METAアイテムは更新する。
-      4. 10人グループはレート順にペア化し、各ペア内でランダムに割り当ててチームA・Bを決定する。
-      5. notify_discord()を呼び出してDiscordへマッチ通知を送信する。
-    """
-    user_ids = [p["user_id"] for p in group]
-
     # ★ グループをレート順（降順：レートが高い順）にソートする
     group.sort(key=lambda x: x["rate"], reverse=True)
-    
-    # ① QueueTableから各プレイヤーのエントリを削除
-    for uid in user_ids:
-        queue_table.delete_item(Key={"namespace": "default", "user_id": uid})
 
-    update_assigned_match_ids(user_ids, match_id)
-    
-    
-    # ④ チーム分け：グループは既にレート順になっている前提で、隣り合わせのペアを作り、各ペア内でランダムに割り振る
-    pairs = []
-    for i in range(0, len(group), 2):
-        pair = group[i:i+2]
-        if len(pair) < 2:
-            continue
-        random.shuffle(pair)
-        pairs.append(pair)
-    team_a_players = [pair[0] for pair in pairs]
-    team_b_players = [pair[1] for pair in pairs]
-    team_a_discord = [p.get("discord_id", "") for p in team_a_players]
-    team_b_discord = [p.get("discord_id", "") for p in team_b_players]
+    # チーム分け：126通りの5対5の分け方からチームのレート合計の差が最小のものを選ぶ
+    team_a_players, team_b_players = balance_teams(group, tolerance=TEAM_BALANCE_TOLERANCE)
+
+    match_item = {
+        "namespace":"default",
+        "match_id": int(match_id),  # match_idはint型
+        "team_A": [[p["user_id"], int(p["rate"]), int(p["best"])] for p in team_a_players],
+        "team_B": [[p["user_id"], int(p["rate"]), int(p["best"])] for p in team_b_players],
+        "matched_unix_time": int(time.time()),
+        "status": "matched",
+        "user_reports": [],
+        "penalty_player": [],
+        "judge_timeout_count": 0,
+        "vc_A": int(vc_a),
+        "vc_B": int(vc_b),
+        # team_A / team_B と同じ並びで、desired_role を満たすロールの割り当て
+        "role_A": assign_roles(team_a_players) or [],
+        "role_B": assign_roles(team_b_players) or [],
+    }
 
-    # ② MatchesTableへマッチレコードを作成
-    matches_table.put_item(
-        Item={
-            "namespace":"default",
-            "match_id": int(match_id),  # match_idはint型
-            "team_A": [[p["user_id"], int(p["rate"]), int(p["best"])] for p in team_a_players],
-            "team_B": [[p["user_id"], int(p["rate"]), int(p["best"])] for p in team_b_players],
-            "matched_unix_time": int(time.time()),
-            "status": "matched",
-            "user_reports": [],
-            "penalty_player": [],
-            "judge_timeout_count": 0,
-            "vc_A": int(vc_a),
-            "vc_B": int(vc_a + 1)
+    transact_items = []
+    for p in group:
+        # ① QueueTableから各プレイヤーのエントリを削除
+        transact_items.append({
+            "Delete": {
+                "TableName": queue_table.name,
+                "Key": {"namespace": "default", "user_id": p["user_id"]},
+                # 入り直したプレイヤーは別のインキューとして扱う（マッチ成立の記録と対応させるため）
+                "ConditionExpression": "inqueued_unixtime = :t",
+                "ExpressionAttributeValues": {":t": int(p["inqueued_unixtime"])},
+            }
+        })
+        # ② 各プレイヤーの assigned_match_id を更新
+        transact_items.append({
+            "Update": {
+                "TableName": user_table.name,
+                "Key": {"namespace": "default", "user_id": p["user_id"]},
+                "UpdateExpression": "SET assigned_match_id = :m",
+                "ExpressionAttributeValues": {":m": int(match_id)},
+            }
+        })
+    # ③ MatchesTableへマッチレコードを作成
+    transact_items.append({
+        "Put": {
+            "TableName": matches_table.name,
+            "Item": match_item,
+            "ConditionExpression": "attribute_not_exists(match_id)",
         }
-    )
-    asyncio.run(notify_bubble([p["user_id"]for p in team_a_players]+[p["user_id"]for p in team_b_players], match_id))
-    
-    # ⑤ Discordへ通知送信
-    asyncio.run(notify_discord(match_id, vc_a, vc_b, team_a_discord, team_b_discord))
+    })
+    # ④ VCの確保
+    transact_items.append(vc_claim_item(queue_table, vc_a, match_id))
+    # ⑤ マッチ成立の記録
+    transact_items.append({
+        "Put": {
+            "TableName": queue_table.name,
+            "Item": match_record_item(match_id, group),
+            "ConditionExpression": "attribute_not_exists(user_id)",
+        }
+    })
+
+    # リースを指定した場合は、保持していることを条件にする
+    if fence_token is not None:
+        transact_items.append({
+            "ConditionCheck": {
+                "TableName": queue_table.name,
+                "Key": {"namespace": "default", "user_id": "#META#"},
+                "ConditionExpression": "fence_token = :t",
+                "ExpressionAttributeValues": {":t": fence_token},
+            }
+        })
+
+    for attempt in range(FINALIZE_RETRIES + 1):
+        try:
+            dynamodb_client.transact_write_items(TransactItems=transact_items)
+            return team_a_players, team_b_players
+        except ClientError as e:
+            # 条件を満たさなかった場合（抜けたプレイヤー・確保済みのVC・リースの喪失）は再試行しても成功しない。
+            # 同じアイテムへの並行した書き込みとの衝突だけ、ランダムな待ち時間をおいて書き直す
+            if attempt == FINALIZE_RETRIES or not is_transaction_conflict(e):
+                print(f"match {match_id} could not be committed: {e}")
+                return None
+            print(f"match {match_id} conflicted with another write. retry ({attempt + 1}/{FINALIZE_RETRIES})")
+            time.sleep(random.uniform(0, min(FINALIZE_BACKOFF_CAP, FINALIZE_BACKOFF_BASE * 2 ** attempt)))
+        except Exception as e:
+            # タイムアウト・接続エラーなど。トランザクションが反映されている可能性があるので、
+            # 確定していれば通知・集計の対象にする（メンバーは既にキューから外れている）
+            print(f"match {match_id} transaction failed with unknown outcome: {e}")
+            if match_committed(match_id):
+                return team_a_players, team_b_players
+            return None
+
+
+def match_committed(match_id):
+    """match_id のマッチレコードが書き込まれているか（確定したトランザクションにだけ含まれる）"""
+    try:
+        item = matches_table.get_item(
+            Key={"namespace": "default", "match_id": int(match_id)},
+            ProjectionExpression="match_id",
+            ConsistentRead=True,
+        ).get("Item")
+    except Exception as e:
+        print(f"error at match_committed ({match_id}): {e}")
+        return False
+    return item is not None
 
 
+def is_transaction_conflict(error):
+    """
+    TransactWriteItems の失敗が、条件の不成立を含まない他の書き込みとの衝突だけによるものか。
+    """
+    reasons = {reason.get("Code") for reason in error.response.get("CancellationReasons", [])}
+    return "TransactionConflict" in reasons and "ConditionalCheckFailed" not in reasons
 
 
-def increment_range_spread_count(user_id):
-    """マッチに入らなかったプレイヤーのrange_spread_countをインクリメントする"""
-    queue_table.update_item(
-        Key={"namespace": "default", "user_id": user_id},
-        UpdateExpression="SET #c = #c + :inc",
-        ExpressionAttributeNames={"#c": "range_spread_count"},
-        ExpressionAttributeValues={":inc": 1}
-    )
-    print(user_id, "count has been incremented")
-
-# 各プレイヤーの assigned_match_id を新しい match_id に更新する処理
-def update_assigned_match_ids(user_ids, match_id):
-    for uid in user_ids:
-        user_table.update_item(
-            Key={"namespace": "default","user_id": uid},
-            UpdateExpression="SET assigned_match_id = :m",
-            ExpressionAttributeValues={":m": match_id}
-        )
+def notify_match(match_id, vc_a, vc_b, team_a_players, team_b_players):
+    """
+    確定したマッチのBubble・Discord通知のコルーチンを返す。
+    送信は呼び出し側で1tick分をまとめて http_client.run_all で並行実行する。
+    """
+    team_a_discord = [p.get("discord_id", "") for p in team_a_players]
+    team_b_discord = [p.get("discord_id", "") for p in team_b_players]
+    return [
+        notify_bubble([p["user_id"]for p in team_a_players]+[p["user_id"]for p in team_b_players], match_id),
+        # Discordへ通知送信
+        notify_discord(match_id, vc_a, vc_b, team_a_discord, team_b_discord),
+    ]
+
 
 async def notify_discord(match_id, vc_a, vc_b, team_a, team_b):
 
@@ -396,15 +669,12 @@ async def notify_discord(match_id, vc_a, vc_b, team_a, team_b):
     )
     
     payload = {"content": content}
-    headers = {"Content-Type": "application/json"}
-    async with aiohttp.ClientSession() as session:
-        async with session.post(WEBHOOK_URL, json=payload, headers=headers) as response:
-            if response.status == 204:
-                print("Discord通知送信成功")
-            else:
-                text = await response.text()
-                print(f"Discord通知送信失敗: {response.status}")
-                print("レスポンス:", text)
+    status, text = await post_json(WEBHOOK_URL, payload, {"Content-Type": "application/json"})
+    if status == 204:
+        print("Discord通知送信成功")
+    else:
+        print(f"Discord通知送信失敗: {status}")
+        print("レスポンス:", text)
 
     
     
@@ -415,66 +685,6 @@ async def notify_bubble(players, match_id):
         "match_id": int(match_id)
     }
 
-    requests.request(method="POST", url=BUBBLE_ASSIGN_MATCH_URL, headers=headers, json=json)
-    
-
-def dfs_group(players, start_index, current_group, current_min, current_max):
-    """
-    深さ優先探索／バックトラッキングで、現在の共通許容レンジ [current_min, current_max]
-    を満たしながら、候補プレイヤーを追加して10人グループを構築する。
-    
-    :param players: 各要素が辞書 {"user_id", "rate", "min_rating", "max_rating", ...} のリスト
-    :param start_index: この段階での探索開始インデックス
-    :param current_group: これまでに選ばれたプレイヤーのリスト
-    :param current_min: 現在の共通許容レンジの下限
-    :param current_max: 現在の共通許容レンジの上限
-    :return: もし有効な10人グループが見つかればそのリストを返す。見つからなければ None
-    """
-    if len(current_group) == 10:
-        return current_group
-
-    for i in range(start_index, len(players)):
-        candidate = players[i]
-        # 候補プレイヤーの実際のレートが、現在の共通許容レンジに含まれているかチェック
-        if not (current_min <= candidate["rate"] <= current_max):
-            continue
-
-        # 候補の許容レンジとの交差を計算
-        new_min = max(current_min, candidate["min_rating"])
-        new_max = min(current_max, candidate["max_rating"])
-        if new_min > new_max:
-            continue
-
-        # 候補をグループに追加して再帰的に探索
-        new_group = current_group + [candidate]
-        result = dfs_group(players, i + 1, new_group, new_min, new_max)
-        if result is not None:
-            return result
-
-    return None
-
-def find_valid_groups(players):
-    """
-    プレイヤーリストからDFS／バックトラッキングで条件を満たす10人グループを
-    重複なく全て見つける。例えば、30人の候補から3グループが見つかれば、
-    [group1, group2, group3] のリストを返す。
-    
-    :param players: 各要素が辞書 {"user_id", "rate", "min_rating", "max_rating", ...} のリスト
-    :return: 有効なグループ（各グループは10人のリスト）のリスト。グループが見つからなければ空リスト
-    """
-    groups = []
-    # candidates をコピー。なお、プレイヤーリストはあらかじめ希望の順（例えば、降順やインキュー順）にソートしておく
-    remaining_players = players[:]
-    
-    while len(remaining_players) >= 10:
-        # 初期の共通レンジは (-∞, +∞)
-        group = dfs_group(remaining_players, 0, [], -math.inf, math.inf)
-        if group is None:
-            break  # 残りからは10人グループが作れない
-        
-        groups.append(group)
-        # グループに含まれるプレイヤーの user_id を除外
-        used_ids = set(p["user_id"] for p in group)
-        remaining_players = [p for p in remaining_players if p["user_id"] not in used_ids]
-    
-    return groups
\ No newline at end of file
+    status, text = await post_json(BUBBLE_ASSIGN_MATCH_URL, json, headers)
+    if status >= 300:
+        print(f"Bubble通知送信失敗 (match {match_id}): {status} {text}")
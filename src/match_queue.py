@@ -1,15 +1,23 @@
 import json, decimal
 import os
+import random
+import time
+import uuid
 
 import boto3
 from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 
 from datetime import datetime
+from typing import List
 from zoneinfo import ZoneInfo
 
-from pydantic import BaseModel, ValidationError, field_serializer
+from pydantic import BaseModel, Field, ValidationError, field_serializer, field_validator
 import asyncio
 
+from .match_engine import TEAM_SIZE, WAIT_STATS_BAND_WIDTH, candidate_counts
+from .queue_pool import delta_item
+from .queue_meta import META_SUMMARY_PROJECTION, RATE_HISTOGRAM_WIDTH, read_lists
 from .ws_helper import broadcast_queue_count
 
 dynamodb = boto3.resource("dynamodb")
@@ -17,6 +25,24 @@ queue = dynamodb.Table(os.environ["MATCH_QUEUE"])
 user_table = dynamodb.Table(os.environ["USER_TABLE"])
 table = dynamodb.Table(os.environ["MATCH_TABLE"])
 connection_table = dynamodb.Table(os.environ["CONNECTION_TABLE"])
+sqs = boto3.client("sqs")
+QUEUE_URL = os.environ["AGGREGATION_QUEUE"]
+
+# インキューを契機にマッチメイクを起動するか（無効時は Step Functions の20秒タイマーのみ）
+MATCHMAKE_ON_INQUEUE = os.environ.get("MATCHMAKE_ON_INQUEUE", "true") == "true"
+# 待ち人数がこの数以上になったらマッチメイクを起動する
+MATCHMAKE_TRIGGER_SIZE = 10
+# 連続したインキューで何度も起動しないよう、この秒数内の再起動要求はまとめる
+MATCHMAKE_DEBOUNCE_SECONDS = 3
+# #META# の pool_version の更新が競合したときの再試行回数と、再試行までの待ち時間（秒）の基準・上限
+# インキュー・デキューは待ちプールの差分の番号（pool_version）で直列化されるので、同時に来た要求は待ち時間をずらして順に通す
+# （#META# の一覧はマッチメイクのティックが待ちプールから書き直すので、インキュー・デキューでは書き換えない）
+META_UPDATE_RETRIES = 8
+META_BACKOFF_BASE = 0.02
+META_BACKOFF_CAP = 0.5
+# この秒数ハートビートが途絶えたプレイヤーは match_make がキューから外す（0 なら外さない）
+# クライアントが queue_heartbeat を送るようになるまでは 0 にしておく（送らないと全員がインキューから90秒ほどで外される）
+HEARTBEAT_TIMEOUT_SECONDS = int(os.environ.get("HEARTBEAT_TIMEOUT_SECONDS", "0"))
 
 class DecimalEncoder(json.JSONEncoder):
     def default(self, o):
@@ -27,8 +53,8 @@ class DecimalEncoder(json.JSONEncoder):
     
 def is_locked():
     """
-    #META# アイテムを取得して、lock が 1 なら True を返す。
-    なければロックなしとみなす (False)。
+    #META# アイテムを取得して、マッチメイクのコミット用リースが有効期限内なら True を返す。
+    なければロックなしとみなす (False)。期限切れのリースはロックとみなさない。
     """
     try:
         resp = queue.get_item(
@@ -38,7 +64,7 @@ def is_locked():
         if not item:
             # #META# アイテムが存在しない場合はロックなしとみなす
             return False
-        return item.get("lock", 0) == 1
+        return item.get("lease_expires_at", 0) >= int(time.time())
     except Exception as e:
         print(f"is_locked() エラー: {e}")
         return False
@@ -51,8 +77,9 @@ class InqueueModel(BaseModel):
     range_spread_speed: int
     range_spread_count: int
     discord_id: str
-    inqueued_unixtime: datetime = datetime.now(ZoneInfo("Asia/Tokyo")).replace(
-        microsecond=0
+    # 許容レンジの拡大はこの時刻からの経過時間で決まるため、リクエスト毎に現在時刻を入れる
+    inqueued_unixtime: datetime = Field(
+        default_factory=lambda: datetime.now(ZoneInfo("Asia/Tokyo")).replace(microsecond=0)
     )
 
 
@@ -61,47 +88,104 @@ class InqueueModel(BaseModel):
         return int(inqueued_unixtime.timestamp())
 
 
+class PartyInqueueModel(BaseModel):
+    # 1チームに収まる人数まで
+    members: List[InqueueModel] = Field(min_length=2, max_length=TEAM_SIZE)
+    inqueued_unixtime: datetime = Field(
+        default_factory=lambda: datetime.now(ZoneInfo("Asia/Tokyo")).replace(microsecond=0)
+    )
+
+    @field_validator("members")
+    @classmethod
+    def unique_members(cls, members):
+        if len({m.user_id for m in members}) != len(members):
+            raise ValueError("party members must be unique")
+        return members
+
+
 class DequeueModel(BaseModel):
     namespace: str = "default"
     user_id: str
 
 
 def get_queue_count():
-    # マッチキューの待ち人数を取得
-    response1 = queue.query(
-        Select="COUNT",
-        KeyConditionExpression=Key("namespace").eq("default"),
-    )
-    return response1["Count"] - 1
+    """
+    マッチキューの待ち人数を取得する。
+    #META# の queue_count はキューへの追加・削除に合わせて ADD しているので、アイテム1件の読み取りで済む。
+    """
+    item = queue.get_item(
+        Key={"namespace": "default", "user_id": "#META#"},
+        ProjectionExpression="queue_count",
+    ).get("Item", {})
+    return int(item.get("queue_count", 0))
+
 
-def update_queue_meta():
+def reconcile_queue_count(event, _):
+    """
+    #META# の queue_count のずれを補正する定期ジョブ。
+    rate_index を COUNT で数え直し、数え始めから queue_count が変わっていなければ書き換える
+    （変わっていれば数えている間に出入りがあったので、次回に持ち越す）。
+    """
+    observed = get_queue_count()
+    kwargs = {
+        "IndexName": "rate_index",
+        "Select": "COUNT",
+        "KeyConditionExpression": Key("namespace").eq("default"),
+    }
+    actual = 0
+    while True:
+        response = queue.query(**kwargs)
+        actual += response["Count"]
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    if actual == observed:
+        return {"statusCode": 200, "body": f"queue_count is consistent ({actual})"}
     try:
-        response = queue.query(
-        IndexName="rate_index",
-        KeyConditionExpression=Key("namespace").eq("default"),
-        ScanIndexForward=False,
-        ProjectionExpression=" rate, range_spread_speed, range_spread_count",)
-        
-        players = response["Items"]
-        new_rate_list = []
-        new_range_list = []
-        for player in players:
-            rating = player["rate"] 
-            spread_count = player["range_spread_count"]
-            spread_speed = player["range_spread_speed"]
-            new_rate_list.append(rating)
-            new_range_list.append(50 + spread_speed * spread_count)
-
-        # METAデータ rate_list, range_list を更新
         queue.update_item(
             Key={"namespace": "default", "user_id": "#META#"},
-            UpdateExpression="SET rate_list = :rl, range_list = :rnl",
-            ExpressionAttributeValues={
-                ":rl": new_rate_list,
-                ":rnl": new_range_list,
-            })
+            UpdateExpression="SET queue_count = :actual",
+            ConditionExpression="attribute_not_exists(queue_count) OR queue_count = :observed",
+            ExpressionAttributeValues={":actual": actual, ":observed": observed},
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            print("queue changed while counting. retry at the next run")
+            return {"statusCode": 200, "body": "skipped"}
+        raise
+    print(f"queue_count corrected: {observed} -> {actual}")
+    return {"statusCode": 200, "body": f"queue_count corrected ({observed} -> {actual})"}
+
+
+def should_request_matchmake(meta, queue_size, now):
+    """
+    待ち人数が閾値を超えていて、直近 MATCHMAKE_DEBOUNCE_SECONDS 秒以内に起動要求が出ていなければ True。
+    呼び出し側は matchmake_requested_at の更新を pool_version を条件にした書き込みに含めるので、
+    同時に大量のインキューがあっても起動要求は MATCHMAKE_DEBOUNCE_SECONDS に１回にまとまる。
+    """
+    if not MATCHMAKE_ON_INQUEUE or queue_size < MATCHMAKE_TRIGGER_SIZE:
+        return False
+    requested_at = meta.get("matchmake_requested_at")
+    return requested_at is None or requested_at <= now - MATCHMAKE_DEBOUNCE_SECONDS
+
+
+def send_matchmake_request(queue_size):
+    """
+    タイマーを待たずにマッチメイクを起動する。
+    （SQSは FIFO のため、先に積まれたインキューを処理し終えてからマッチメイクが走る）
+    """
+    try:
+        sqs.send_message(
+            QueueUrl=QUEUE_URL,
+            MessageBody=json.dumps({"action": "match_make", "payload": {"trigger": "inqueue"}}),
+            MessageGroupId="ProcessQueue",
+            MessageDeduplicationId=str(uuid.uuid4()),
+        )
+        print(f"match make requested by inqueue (queue size: {queue_size})")
+        return True
     except Exception as e:
-        print("error at update_queue_meta", e)
+        print("error at send_matchmake_request", e)
+        return False
 
 def update_queue_count():
     # 接続している全ユーザーの connection_id を取得　現状未使用
@@ -115,30 +199,10 @@ def update_queue_count():
     except Exception as e:
         print("error at update_queue_count: ", e)
 
-def get_user_rating(user_id):
-    """
-    UserTableから指定された user_id の最新のレートを取得する関数。
-    アイテムが存在しない場合、または rating が設定されていない場合は、デフォルト値1500を返す。
-    """
-    try:
-        resp = user_table.get_item(Key={"namespace":"default", "user_id": user_id})
-        item = resp.get("Item")
-        if item and "rate" in item:
-            notinmatch = True
-            if "assigned_match_id" in item:
-                notinmatch = item["assigned_match_id"] == 0
-            return [item["rate"], item["unitemate_max_rate"], notinmatch]
-        else:
-            return [1500,1500,True]
-    except Exception as e:
-        print(f"Error retrieving rating for user {user_id}: {e}")
-        return [1500,1500,True]
-
 def inqueue(event, _):
-    # ロック中の場合は待機またはエラー応答
-    if is_locked():
-        return {"statusCode": 423, "body": "Match making in progress, please retry later."}
-    
+    # マッチの確定はキューに残っていることを条件とするトランザクションで行うため、
+    # マッチメイク中でもインキューを受け付ける
+    # 読み込みは BatchGetItem 1回、書き込みは TransactWriteItems 1回（競合した場合のみ再試行）
     try:
         # イベントのbodyからInqueueModelのインスタンスを生成
         model = InqueueModel(**json.loads(event["body"]))
@@ -147,63 +211,483 @@ def inqueue(event, _):
         return {"statusCode": 422, "body": e.json()}
     
     # モデルの辞書を取得
-    model_data = model.model_dump()
-    
-    # user_idを使ってUserTableから最新のrateを取得
-    ratinginfo = get_user_rating(model_data["user_id"])
-    if ratinginfo[2]:
-        # 取得したrateをモデルデータに追加
-        model_data["rate"] = ratinginfo[0]
-        model_data["best"] = ratinginfo[1]
-        # モデルデータをキューに登録
-        queue.put_item(Item=model_data)
-        update_queue_meta()
-        
+    return inqueue_members([model.model_dump()])
+
+
+def party_inqueue(event, _):
+    """
+    パーティ（2〜5人）をまとめてインキューするAPI。
+    全員を同じ party_id・同じインキュー時刻で1つのトランザクションに書き込み、
+    誰か1人でもマッチにアサインされていれば誰もインキューしない。
+    match_make はパーティを1つの単位として、同じグループ・同じチームに入れる。
+    """
+    try:
+        model = PartyInqueueModel(**json.loads(event["body"]))
+    except ValidationError as e:
+        print("Validation error:", e)
+        return {"statusCode": 422, "body": e.json()}
+
+    party_id = uuid.uuid4().hex
+    inqueued_unixtime = int(model.inqueued_unixtime.timestamp())
+    members = []
+    for member in model.members:
+        member_data = member.model_dump()
+        member_data["party_id"] = party_id
+        member_data["inqueued_unixtime"] = inqueued_unixtime
+        members.append(member_data)
+    return inqueue_members(members)
+
+
+def wait_before_retry(attempt):
+    """attempt 回目の競合の後、上限つき指数バックオフの範囲からランダムな時間だけ待つ（フルジッター）"""
+    time.sleep(random.uniform(0, min(META_BACKOFF_CAP, META_BACKOFF_BASE * 2 ** attempt)))
+
+
+def inqueue_members(members):
+    """members（キューアイテムの辞書のリスト）を1つのトランザクションでインキューする"""
+    user_ids = [m["user_id"] for m in members]
+    for attempt in range(META_UPDATE_RETRIES):
+        if attempt:
+            wait_before_retry(attempt - 1)
+        users, meta, old_items = read_inqueue_state(user_ids)
+        if any(users.get(user_id, {}).get("assigned_match_id", 0) != 0 for user_id in user_ids):
+            print("user already assigned to another match")
+            return {"statusCode": 200, "body": None}
+        # match_judge がユーザー行に書き込んだ最新のレート・最高レートをそのまま使う
+        now = int(time.time())
+        for member in members:
+            user = users.get(member["user_id"], {})
+            member["rate"] = user.get("rate", 1500)
+            member["best"] = user.get("unitemate_max_rate", 1500)
+            member["heartbeat_at"] = now
+        try:
+            queue_size, requested = commit_inqueue(members, users, meta, old_items)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "TransactionCanceledException":
+                # 読み込み後にマッチへのアサイン・レートの更新や、他のインキュー・デキュー・マッチメイクがあった。
+                # 読み直して判定し直す
+                continue
+            print("error at inqueue", e)
+            return {"statusCode": 500, "body": None}
+        if requested:
+            # 人数が揃ったらタイマーを待たずにマッチメイクを起動する
+            send_matchmake_request(queue_size)
         return {"statusCode": 200, "body": None}
+
+    print("inqueue: too many conflicts")
+    return {"statusCode": 503, "body": None}
+
+
+# キューテーブルから #META# を読む際の取得項目（トランザクションの条件と待ち人数に使う値）
+META_STATE_PROJECTION = "user_id, rate, pool_version, queue_count, matchmake_requested_at"
+
+
+def batch_get(request):
+    """BatchGetItem を未処理のキーが無くなるまで繰り返し、テーブル名ごとのアイテムのリストを返す"""
+    items = {name: [] for name in request}
+    while request:
+        response = dynamodb.batch_get_item(RequestItems=request)
+        for name, found in response["Responses"].items():
+            items[name].extend(found)
+        request = response.get("UnprocessedKeys")
+    return items
+
+
+def queue_state_request(user_ids):
+    """#META# と user_ids のキューアイテムを読む BatchGetItem のリクエスト"""
+    return {
+        "Keys": [{"namespace": "default", "user_id": "#META#"}]
+        + [{"namespace": "default", "user_id": user_id} for user_id in user_ids],
+        "ProjectionExpression": META_STATE_PROJECTION,
+        "ConsistentRead": True,
+    }
+
+
+def split_queue_state(items):
+    """queue_state_request の結果を (#META#, {user_id: キューアイテム}) に分ける"""
+    by_key = {item["user_id"]: item for item in items}
+    return by_key.pop("#META#", {}), by_key
+
+
+def read_inqueue_state(user_ids):
+    """
+    インキューに必要なユーザー行（レート・アサイン状況）、#META#、既存のキューアイテムを1回の BatchGetItem で読む。
+    :return: ({user_id: ユーザー行}, #META#, {user_id: 既存のキューアイテム})。存在しないものは含めない
+    """
+    items = batch_get({
+        user_table.name: {
+            "Keys": [{"namespace": "default", "user_id": user_id} for user_id in user_ids],
+            "ProjectionExpression": "user_id, rate, unitemate_max_rate, assigned_match_id",
+        },
+        queue.name: queue_state_request(user_ids),
+    })
+    users = {item["user_id"]: item for item in items[user_table.name]}
+    return (users, *split_queue_state(items[queue.name]))
+
+
+def read_dequeue_state(user_id):
+    """デキューに必要な #META# と既存のキューアイテムを1回の BatchGetItem で読む"""
+    items = batch_get({queue.name: queue_state_request([user_id])})
+    meta, old_items = split_queue_state(items[queue.name])
+    return meta, old_items.get(user_id)
+
+
+def meta_delta_item(meta, count_delta, version_delta=1, extra_set="", extra_values=None):
+    """
+    インキュー・デキューのトランザクションに含める #META# の Update。
+    pool_version を version_delta（差分アイテムの数）進め、queue_count に count_delta を ADD する。
+    読み込み時の pool_version を条件にするので、間に他のインキュー・デキューがあればトランザクション全体が取り消される。
+    待ちプレイヤーの一覧（queue_rates など）は書き換えないので、書き込む大きさはキューの人数によらない。
+    """
+    values = {":versions": version_delta, ":count": count_delta, **(extra_values or {})}
+    if "pool_version" in meta:
+        condition = "pool_version = :pool_version"
+        values[":pool_version"] = meta["pool_version"]
     else:
-        print("user already assigned to another match")
-        return  {"statusCode": 200, "body": None}
+        condition = "attribute_not_exists(pool_version)"
+    update_expression = "ADD pool_version :versions, queue_count :count"
+    if extra_set:
+        update_expression = f"SET {extra_set} {update_expression}"
+    return {
+        "Update": {
+            "TableName": queue.name,
+            "Key": {"namespace": "default", "user_id": "#META#"},
+            "UpdateExpression": update_expression,
+            "ConditionExpression": condition,
+            "ExpressionAttributeValues": values,
+        }
+    }
+
+
+def commit_inqueue(members, users, meta, old_items):
+    """
+    インキュー（パーティなら全員分）を1つの TransactWriteItems で書き込む。
+      1. 各ユーザー行: マッチにアサインされておらず、レートが読み込み時から変わっていないこと
+      2. 各キューアイテムの登録（読み込み時から他のインキュー・デキューで変わっていないこと）
+      3. #META# の pool_version・queue_count の更新（必要ならマッチメイクの起動要求時刻も）
+      4. 待ちプールの差分アイテム（1人1件）
+    いずれかの条件が合わなければ全体が取り消される。
+    :return: (インキュー後の待ち人数, マッチメイクを起動するか)
+    """
+    now = int(time.time())
+    # 再インキューは人数が変わらない
+    added = sum(1 for member in members if member["user_id"] not in old_items)
+    queue_size = int(meta.get("queue_count", 0)) + added
+    requested = should_request_matchmake(meta, queue_size, now)
+
+    pool_version = int(meta.get("pool_version", 0))
+    extra_set, extra_values = "", {}
+    if requested:
+        extra_set, extra_values = "matchmake_requested_at = :now", {":now": now}
+
+    transact_items = []
+    for version, member in enumerate(members, pool_version + 1):
+        user = users.get(member["user_id"], {})
+        if "rate" in user:
+            user_condition = "(attribute_not_exists(assigned_match_id) OR assigned_match_id = :zero) AND rate = :rate"
+            user_values = {":zero": 0, ":rate": user["rate"]}
+        else:
+            user_condition = "(attribute_not_exists(assigned_match_id) OR assigned_match_id = :zero) AND attribute_not_exists(rate)"
+            user_values = {":zero": 0}
+
+        old_item = old_items.get(member["user_id"])
+        if old_item:
+            queue_condition = "rate = :old"
+            queue_values = {":old": old_item["rate"]}
+        else:
+            queue_condition = "attribute_not_exists(user_id)"
+            queue_values = {}
+
+        transact_items.extend([
+            {
+                "ConditionCheck": {
+                    "TableName": user_table.name,
+                    "Key": {"namespace": "default", "user_id": member["user_id"]},
+                    "ConditionExpression": user_condition,
+                    "ExpressionAttributeValues": user_values,
+                }
+            },
+            {
+                "Put": {
+                    "TableName": queue.name,
+                    "Item": member,
+                    "ConditionExpression": queue_condition,
+                    **({"ExpressionAttributeValues": queue_values} if queue_values else {}),
+                }
+            },
+            {
+                "Put": {
+                    "TableName": queue.name,
+                    "Item": delta_item(version, "inqueue", member),
+                    "ConditionExpression": "attribute_not_exists(user_id)",
+                }
+            },
+        ])
+    transact_items.append(meta_delta_item(meta, added, len(members), extra_set, extra_values))
+    dynamodb.meta.client.transact_write_items(TransactItems=transact_items)
+    return queue_size, requested
 
 def dequeue(event, _):
-    if is_locked():
-        # ロック中の場合は待機 or エラー応答
-        return {"statusCode": 423, "body": "Match making in progress, please retry later."}
+    # マッチ確定前に抜けたプレイヤーを含むマッチはトランザクションの条件で失敗するので、ロックは不要
+    try:
+        model = DequeueModel(**json.loads(event["body"]))
+    except ValidationError as e:
+        return {"statusCode": 422, "body": e.json()}
+
+    return {"statusCode": dequeue_user(model.user_id), "body": None}
+
+
+def dequeue_user(user_id, stale_before=None):
+    """
+    user_id をキューから外し、ステータスコードを返す。
+    stale_before を指定した場合は、ハートビートがその時刻より前のまま途絶えている場合に限り外す。
+    """
+    for attempt in range(META_UPDATE_RETRIES):
+        if attempt:
+            wait_before_retry(attempt - 1)
+        meta, old_item = read_dequeue_state(user_id)
+        if old_item is None:
+            # 既にキューにいない（マッチ成立済み・二重のデキュー）
+            return 200
+        try:
+            commit_dequeue(user_id, meta, old_item, stale_before)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "TransactionCanceledException":
+                if stale_before is not None and (read_heartbeat(user_id) or 0) >= stale_before:
+                    # 読み込み後にハートビートが届いた
+                    return 200
+                # 他のインキュー・デキュー・マッチメイクと競合した。読み直して判定し直す
+                continue
+            print("error at dequeue", e)
+            return 500
+        return 200
+
+    print("dequeue: too many conflicts")
+    return 503
+
+
+def commit_dequeue(user_id, meta, old_item, stale_before=None):
+    """
+    デキューを1つの TransactWriteItems で書き込む。
+      1. キューアイテムの削除（読み込み時から変わっていないこと。stale_before を指定した場合は
+         ハートビートがその時刻より前であることも条件にする）
+      2. #META# の pool_version・queue_count の更新
+      3. 待ちプールの差分アイテム
+    """
+    condition = "rate = :old"
+    values = {":old": old_item["rate"]}
+    if stale_before is not None:
+        condition += " AND heartbeat_at < :cutoff"
+        values[":cutoff"] = stale_before
+    pool_version = int(meta.get("pool_version", 0))
+    dynamodb.meta.client.transact_write_items(TransactItems=[
+        {
+            "Delete": {
+                "TableName": queue.name,
+                "Key": {"namespace": "default", "user_id": user_id},
+                "ConditionExpression": condition,
+                "ExpressionAttributeValues": values,
+            }
+        },
+        meta_delta_item(meta, -1),
+        {
+            "Put": {
+                "TableName": queue.name,
+                "Item": delta_item(pool_version + 1, "dequeue", {"user_id": user_id}),
+                "ConditionExpression": "attribute_not_exists(user_id)",
+            }
+        },
+    ])
+
+
+def refresh_heartbeat(user_id, now=None):
+    """
+    キューにいるプレイヤーのハートビート時刻を更新し、キューにいれば True を返す。
+    待ちプールの差分や #META# は書き換えないので、頻繁に呼んでもインキュー・マッチメイクと競合しない。
+    """
+    if now is None:
+        now = int(time.time())
+    try:
+        queue.update_item(
+            Key={"namespace": "default", "user_id": user_id},
+            UpdateExpression="SET heartbeat_at = :now",
+            # rate を持つのはプレイヤーのアイテムだけ（#META# などの管理用アイテムや、キューにいない場合は更新しない）
+            ConditionExpression="attribute_exists(rate)",
+            ExpressionAttributeValues={":now": now},
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            print("error at refresh_heartbeat", e)
+        return False
+
+
+def heartbeat(event, _):
+    """キューで待っているプレイヤーのハートビートを受け付けるAPI"""
     try:
         model = DequeueModel(**json.loads(event["body"]))
     except ValidationError as e:
         return {"statusCode": 422, "body": e.json()}
+    queued = refresh_heartbeat(model.user_id)
+    return {"statusCode": 200, "body": json.dumps({"queued": queued})}
+
 
-    queue.delete_item(Key=model.model_dump())
-    update_queue_meta()
-    return {"statusCode": 200, "body": None}
+def read_heartbeat(user_id):
+    """キューにいるプレイヤーの最後のハートビート時刻を返す（キューにいなければ None）"""
+    item = queue.get_item(
+        Key={"namespace": "default", "user_id": user_id},
+        ProjectionExpression="heartbeat_at",
+        ConsistentRead=True,
+    ).get("Item")
+    if item is None:
+        return None
+    return int(item.get("heartbeat_at", 0))
+
+
+def evict_stale_entries(now=None):
+    """
+    ハートビートが HEARTBEAT_TIMEOUT_SECONDS 以上途絶えたプレイヤーをキューから外し、外した user_id のリストを返す。
+    heartbeat_index（heartbeat_at を持つプレイヤーだけのスパースインデックス）を途絶えた範囲だけ読むので、
+    読み取り量はキューの人数ではなく外す人数に比例する。外す処理は dequeue と同じトランザクションで、
+    待ちプールの差分・queue_count も一緒に更新する。
+    """
+    if HEARTBEAT_TIMEOUT_SECONDS <= 0:
+        return []
+    if now is None:
+        now = int(time.time())
+    cutoff = now - HEARTBEAT_TIMEOUT_SECONDS
+    kwargs = {
+        "IndexName": "heartbeat_index",
+        "KeyConditionExpression": Key("namespace").eq("default") & Key("heartbeat_at").lt(cutoff),
+        "ProjectionExpression": "user_id",
+    }
+    evicted = []
+    try:
+        while True:
+            response = queue.query(**kwargs)
+            for item in response["Items"]:
+                user_id = item["user_id"]
+                if dequeue_user(user_id, stale_before=cutoff) == 200 and read_heartbeat(user_id) is None:
+                    evicted.append(user_id)
+            if "LastEvaluatedKey" not in response:
+                break
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    except Exception as e:
+        print("error at evict_stale_entries", e)
+    if evicted:
+        print(f"evicted {len(evicted)} stale entries: {evicted}")
+    return evicted
 
 
 def get_info(event, _):
-    """マッチキューの情報を取得するAPI"""
+    """
+    マッチキューの情報を取得するAPI。
+    クエリパラメータ format=compact を指定すると、プレイヤーごとの一覧の代わりにレート帯ごとの人数と
+    許容レンジのパーセンタイルを返す（応答の大きさがキューの人数によらず一定になる）。
+    一覧は直近のマッチメイクのティック時点のもので、許容レンジを求めた基準時刻を tick_unixtime として返す。
+    """
+    params = (event or {}).get("queryStringParameters") or {}
+    if params.get("format") == "compact":
+        return get_info_compact()
     try:
         # 前回マッチ時刻と前回キュー人数を取得
         response = queue.get_item(Key={"namespace": "default", "user_id": "#META#"})
         if "Item" in response:
-            rate_list = response["Item"]["rate_list"]
-            range_list = response["Item"]["range_list"]
+            rate_list, range_list, window_list = read_lists(response["Item"])
             ongoing = response["Item"].get("ongoing_matches", 0)
             #ongoing = sum(response["Item"]["match_counter"])
+            # 直近30分ほど（指数減衰）に成立したプレイヤーの、レート帯ごとの待ち時間
+            wait_stats = response["Item"].get("wait_stats", {})
+            tick_unixtime = response["Item"].get("tick_unixtime")
         else:
             rate_list = []
             range_list = []
+            window_list = []
             ongoing = 0
             #ongoing = 0
+            wait_stats = {}
+            tick_unixtime = None
 
         response_body = {
             "rate_list": rate_list,
             "range_list": range_list,
+            # 各プレイヤーの実際の許容レンジに入っている他のプレイヤーの人数（rate_list と同じ並び）
+            "candidate_list": candidate_counts(rate_list, window_list),
             "ongoing": ongoing,
+            "wait_stats": wait_stats,
+            "tick_unixtime": tick_unixtime,
         }
     except:
         response_body = {
             "rate_list": [],
             "range_list": [],
+            "candidate_list": [],
             "ongoing": 0,
+            "wait_stats": {},
+            "tick_unixtime": None,
         }
 
     return {"statusCode": 200, "body": json.dumps(response_body, cls=DecimalEncoder)}
+
+
+def get_info_compact():
+    """get_info の format=compact。#META# の集計値だけを読み、一覧のバイナリは読まない"""
+    try:
+        item = queue.get_item(
+            Key={"namespace": "default", "user_id": "#META#"},
+            ProjectionExpression=META_SUMMARY_PROJECTION,
+        ).get("Item", {})
+        response_body = {
+            "count": item.get("queue_count", 0),
+            "histogram_width": RATE_HISTOGRAM_WIDTH,
+            "rate_histogram": item.get("rate_histogram", {}),
+            "range_percentiles": item.get("range_percentiles", {}),
+            "ongoing": item.get("ongoing_matches", 0),
+            "wait_stats": item.get("wait_stats", {}),
+            "tick_unixtime": item.get("tick_unixtime"),
+        }
+    except Exception as e:
+        print("error at get_info_compact", e)
+        response_body = {
+            "count": 0,
+            "histogram_width": RATE_HISTOGRAM_WIDTH,
+            "rate_histogram": {},
+            "range_percentiles": {},
+            "ongoing": 0,
+            "wait_stats": {},
+            "tick_unixtime": None,
+        }
+
+    return {"statusCode": 200, "body": json.dumps(response_body, cls=DecimalEncoder)}
+
+
+def get_eta(event, _):
+    """
+    レート帯ごとの予想待ち時間を返すAPI。
+    match_make がティック毎に #META# に書き込んだ表（eta_table）を読むだけなので、読み取りは1回で済む。
+    クエリパラメータ rate を指定すると、そのレートが属するレート帯の予想待ち時間も estimate として返す。
+    """
+    params = (event or {}).get("queryStringParameters") or {}
+    try:
+        rate = int(params["rate"]) if params.get("rate") is not None else None
+    except ValueError:
+        return {"statusCode": 422, "body": "rate must be an integer"}
+    try:
+        response = queue.get_item(
+            Key={"namespace": "default", "user_id": "#META#"},
+            ProjectionExpression="eta_table, band_throughput_updated_at",
+        )
+        item = response.get("Item", {})
+        eta = item.get("eta_table", {})
+        response_body = {
+            "band_width": WAIT_STATS_BAND_WIDTH,
+            "eta": eta,
+            "updated_at": item.get("band_throughput_updated_at"),
+        }
+        if rate is not None:
+            response_body["estimate"] = eta.get(str(rate // WAIT_STATS_BAND_WIDTH * WAIT_STATS_BAND_WIDTH))
+    except Exception as e:
+        print("error at get_eta", e)
+        response_body = {"band_width": WAIT_STATS_BAND_WIDTH, "eta": {}, "updated_at": None}
+
+    return {"statusCode": 200, "body": json.dumps(response_body, cls=DecimalEncoder)}
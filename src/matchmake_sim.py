@@ -0,0 +1,250 @@
+import contextlib
+import heapq
+import io
+import os
+import random
+import sys
+import time
+
+from . import match_engine
+from .match_engine import wait_time_stats
+
+# マッチメイク起動方式のローカルシミュレーション
+# 20秒タイマーのみ（従来）と、インキュー契機＋タイマー（フォールバック）の待ち時間を比較する。
+# 本番と同じ match_queue.inqueue_members と match_make.handle を、moto のメモリ上の DynamoDB に対して動かす
+# （デバウンス・起動判定・プールの復元・コミットも本番のコードのまま）。AWS 環境は不要だが moto が必要。
+# 時刻は各モジュールの time を SimClock に差し替えて進め、SQS・通知・VCの解放はイベントとして模擬する。
+# グループ形成の方式（sweep / priority）や許容レンジの決め方によるレート帯ごとの待ち時間の違いも比較する。
+# python -m src.matchmake_sim [到着人数/分] [シミュレーション秒数（既定 1200）] で実行する
+# （DynamoDB の呼び出しを moto で処理するので、既定の設定で数分かかる）
+
+# Step Functions の待機間隔（秒）
+TIMER_INTERVAL = 20
+# SQS を経由してマッチメイクが走り始めるまでの遅延（秒）
+SQS_LATENCY = 1.0
+# 試合が終わってVCが空くまでの時間（秒）
+MATCH_SECONDS = 600
+# シミュレーション開始時刻（unixtime）
+SIM_START = 1_700_000_000
+
+# match_queue / match_make が読み込み時に参照する環境変数（シミュレーション用のテーブル名）
+SIM_ENV = {
+    "AWS_DEFAULT_REGION": "ap-northeast-1",
+    "AWS_ACCESS_KEY_ID": "sim",
+    "AWS_SECRET_ACCESS_KEY": "sim",
+    "MATCH_QUEUE": "sim-match-queue",
+    "MATCH_TABLE": "sim-matches",
+    "USER_TABLE": "sim-users",
+    "CONNECTION_TABLE": "sim-connections",
+    "RECORD_TABLE": "sim-records",
+    "AGGREGATION_QUEUE": "https://sqs.ap-northeast-1.amazonaws.com/000000000000/sim-aggregation.fifo",
+    "BUBBLE_ASSIGN_MATCH_URL": "http://localhost/sim",
+    "BUBBLE_PENALTY": "http://localhost/sim",
+    "AWS_STAGE": "sim",
+    "WEBSOCKET_API_ID": "sim",
+}
+
+
+class SimClock:
+    """time モジュールの代わりに match_queue / match_make / match_engine に差し込む仮想時計"""
+
+    def __init__(self, now=SIM_START):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # 競合時のバックオフ。仮想時間を進めるだけで実際には待たない
+        self.now += seconds
+
+    @staticmethod
+    def perf_counter():
+        return time.perf_counter()
+
+
+def start_backend():
+    """
+    moto のメモリ上の DynamoDB を起動して本番のモジュールを読み込み、(match_queue, match_make, allocator) を返す。
+    モジュールは読み込み時に環境変数のテーブル名で boto3 のテーブルを作るので、先に環境変数と moto を用意する。
+    """
+    for key, value in SIM_ENV.items():
+        os.environ.setdefault(key, value)
+    from moto import mock_aws
+
+    mock_aws().start()
+    from . import allocator, match_make, match_queue
+
+    return match_queue, match_make, allocator
+
+
+def create_tables(match_queue, match_make):
+    """シミュレーションで使うテーブルを空の状態で作り直す（キー・インデックスは serverless.yml と同じ）"""
+    client = match_make.dynamodb_client
+
+    def key_schema(hash_key, range_key):
+        return [{"AttributeName": hash_key, "KeyType": "HASH"}, {"AttributeName": range_key, "KeyType": "RANGE"}]
+
+    tables = {
+        match_make.queue_table.name: dict(
+            KeySchema=key_schema("namespace", "user_id"),
+            AttributeDefinitions=[
+                {"AttributeName": "namespace", "AttributeType": "S"},
+                {"AttributeName": "user_id", "AttributeType": "S"},
+                {"AttributeName": "rate", "AttributeType": "N"},
+                {"AttributeName": "heartbeat_at", "AttributeType": "N"},
+            ],
+            LocalSecondaryIndexes=[{
+                "IndexName": "rate_index",
+                "KeySchema": key_schema("namespace", "rate"),
+                "Projection": {"ProjectionType": "ALL"},
+            }],
+            GlobalSecondaryIndexes=[{
+                "IndexName": "heartbeat_index",
+                "KeySchema": key_schema("namespace", "heartbeat_at"),
+                "Projection": {"ProjectionType": "KEYS_ONLY"},
+            }],
+        ),
+        match_make.matches_table.name: dict(
+            KeySchema=key_schema("namespace", "match_id"),
+            AttributeDefinitions=[
+                {"AttributeName": "namespace", "AttributeType": "S"},
+                {"AttributeName": "match_id", "AttributeType": "N"},
+            ],
+        ),
+        match_make.user_table.name: dict(
+            KeySchema=key_schema("namespace", "user_id"),
+            AttributeDefinitions=[
+                {"AttributeName": "namespace", "AttributeType": "S"},
+                {"AttributeName": "user_id", "AttributeType": "S"},
+            ],
+        ),
+    }
+    existing = set(client.list_tables()["TableNames"])
+    for name, definition in tables.items():
+        if name in existing:
+            client.delete_table(TableName=name)
+        client.create_table(TableName=name, BillingMode="PAY_PER_REQUEST", **definition)
+    match_queue.queue.put_item(Item={"namespace": "default", "user_id": "#META#", "LatestMatchID": 0})
+    match_make.pool_cache = None
+
+
+def simulate(per_minute, duration, on_inqueue, matcher="sweep", seed=0, adaptive=False, backend=None):
+    """
+    到着人数 per_minute 人/分で duration 秒シミュレーションし、成立したプレイヤーの (レート, 待ち時間) のリストと
+    マッチメイクの実行回数とグループのレート幅のリストを返す。on_inqueue が True ならインキュー契機でもマッチメイクを起動する。
+    matcher は match_make の event に渡すグループ形成の方式名。
+    adaptive が True なら許容レンジをレート分布に応じて絞る（density_adaptive_ranges）。
+    backend には start_backend の戻り値を渡す（省略時はここで起動する）。
+    """
+    match_queue, match_make, allocator = backend or start_backend()
+    create_tables(match_queue, match_make)
+    rng = random.Random(seed)
+    clock = SimClock()
+    events = []
+    seq = 0
+
+    def push(at, kind, data=None):
+        nonlocal seq
+        heapq.heappush(events, (at, seq, kind, data))
+        seq += 1
+
+    t = float(SIM_START)
+    while t < SIM_START + duration:
+        t += rng.expovariate(per_minute / 60)
+        push(t, "inqueue", len(events))
+    for k in range(int(duration // TIMER_INTERVAL) + 1):
+        push(SIM_START + k * TIMER_INTERVAL + SQS_LATENCY, "match_make")
+
+    waits = []
+    spreads = []
+
+    def notify_match(match_id, vc_a, vc_b, team_a_players, team_b_players):
+        group = team_a_players + team_b_players
+        spreads.append(max(p["rate"] for p in group) - min(p["rate"] for p in group))
+        waits.extend((p["rate"], clock.now - p["inqueued_unixtime"]) for p in group)
+        push(clock.now + MATCH_SECONDS, "release_vc", (vc_a, match_id))
+        return []
+
+    patches = {
+        (match_queue, "time"): clock,
+        (match_make, "time"): clock,
+        (match_engine, "time"): clock,
+        (match_queue, "MATCHMAKE_ON_INQUEUE"): on_inqueue,
+        (match_queue, "send_matchmake_request"): lambda queue_size: push(clock.now + SQS_LATENCY, "match_make"),
+        (match_make, "notify_match"): notify_match,
+        (match_make, "DENSITY_ADAPTIVE_RANGE"): adaptive,
+        # moto はトランザクションの並行実行に対応していないので1件ずつコミットする
+        (match_make, "FINALIZE_CONCURRENCY"): 1,
+    }
+    originals = {target: getattr(*target) for target in patches}
+    for (module, name), value in patches.items():
+        setattr(module, name, value)
+    runs = 0
+    try:
+        while events:
+            clock.now, _, kind, data = heapq.heappop(events)
+            # 本番のコードのログは出さない
+            with contextlib.redirect_stdout(io.StringIO()):
+                if kind == "inqueue":
+                    user_id = f"sim-{data}"
+                    desired_role = ",".join(rng.sample(["top", "jungle", "bottom"], 1)) if rng.random() < 0.3 else ""
+                    rate = int(rng.gauss(1550, 120))
+                    match_make.user_table.put_item(Item={
+                        "namespace": "default", "user_id": user_id, "rate": rate,
+                        "unitemate_max_rate": rate, "assigned_match_id": 0,
+                    })
+                    match_queue.inqueue_members([{
+                        "namespace": "default",
+                        "user_id": user_id,
+                        "blocking": "",
+                        "desired_role": desired_role,
+                        "range_spread_speed": rng.choice([10, 20, 30]),
+                        "range_spread_count": 0,
+                        "discord_id": "",
+                        "inqueued_unixtime": int(clock.now),
+                    }])
+                elif kind == "release_vc":
+                    allocator.release_vc(match_make.queue_table, *data)
+                elif clock.now <= SIM_START + duration:
+                    runs += 1
+                    response = match_make.handle({"matcher": matcher, "trigger": "sim"}, None)
+                    # 失敗したティックを黙って数えると、待ち時間の比較が意味をなさなくなる
+                    if response is None or response["statusCode"] != 200:
+                        raise RuntimeError(f"match_make.handle failed at {clock.now}: {response}")
+    finally:
+        for (module, name), value in originals.items():
+            setattr(module, name, value)
+    return waits, runs, spreads
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+if __name__ == "__main__":
+    per_minute = float(sys.argv[1]) if len(sys.argv) > 1 else 30
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 1200
+    backend = start_backend()
+    for label, on_inqueue, matcher, adaptive in (
+        ("timer only", False, "sweep", False),
+        ("inqueue + timer", True, "sweep", False),
+        ("inqueue/priority", True, "priority", False),
+        ("inqueue/density", True, "sweep", True),
+    ):
+        samples, runs, spreads = simulate(per_minute, duration, on_inqueue, matcher, adaptive=adaptive, backend=backend)
+        waits = [wait for _, wait in samples]
+        print(
+            f"{label:16s} runs={runs:5d} matched={len(waits):5d} "
+            f"mean={sum(waits) / max(1, len(waits)):6.1f}s "
+            f"p50={percentile(waits, 0.5):6.1f}s p95={percentile(waits, 0.95):6.1f}s "
+            f"spread={sum(spreads) / max(1, len(spreads)):5.0f}"
+        )
+        for band, stats in wait_time_stats(samples).items():
+            print(
+                f"    {band:5d}- n={stats['count']:5d} "
+                f"p50={stats['p50']:6.1f}s p95={stats['p95']:6.1f}s p99={stats['p99']:6.1f}s"
+            )
@@ -0,0 +1,97 @@
+import struct
+
+# #META# に保存する待ちプレイヤーの一覧（get_info 用）
+#
+# 以前は rate_list / range_list を DynamoDB の数値リストで持っていたが、人数に比例して大きくなり
+# キューが伸びる前にアイテムの上限（400KB）に達するため、次の形式で保存する。
+#   queue_rates / queue_ranges : レートの降順に並べたレートと許容レンジを、符号なし16bit（ビッグエンディアン）で詰めたバイナリ
+#   queue_windows              : 同じ並びで、マッチメイクが実際に使った許容レンジの下端・上端を交互に詰めたバイナリ
+#                                （拡大上限での無制限・密度による絞り込み・パーティの共通レンジを反映したもの。無制限は 0 / PACK_MAX）
+#   rate_histogram             : RATE_HISTOGRAM_WIDTH ごとのレート帯の人数（キーはレート帯の下端）
+#   range_percentiles          : 許容レンジの p50 / p90 / max
+#   tick_unixtime              : 一覧を書いたティックの基準時刻（許容レンジはこの時刻時点の待ち時間から求めたもの）
+# 1人あたり8バイトなので数万人でも上限に収まり、ヒストグラム以降は人数によらず一定の大きさになる。
+# 一覧はマッチメイクのティックごとに待ちプールから書き直す（インキュー・デキューは一覧を書き換えないので、
+# 直近のインキューは次のティックで一覧に現れる。待ち人数 queue_count はインキュー・デキューと同時に更新している）。
+
+RATE_HISTOGRAM_WIDTH = 50
+# 16bit に収まらない値（長時間待ちの許容レンジなど）はこの値に丸める
+PACK_MAX = 0xFFFF
+
+# #META# の一覧を書き換える UpdateExpression（SET 句）。値は meta_list_values で作る
+META_LIST_SET = (
+    "queue_rates = :qr, queue_ranges = :qg, queue_windows = :qw, rate_histogram = :rh, range_percentiles = :rp"
+)
+# 旧形式の属性を削除する REMOVE 句
+META_LIST_REMOVE = "rate_list, range_list"
+# 集計値だけを読む（バイナリを読まない）ときの取得項目
+# queue_count（待ち人数）はインキュー・デキューと同じ書き込みで ADD し、マッチ確定分はティックの最後にまとめて引いている
+META_SUMMARY_PROJECTION = "rate_histogram, range_percentiles, queue_count, ongoing_matches, wait_stats, tick_unixtime"
+
+
+def pack_values(values):
+    # 無制限の許容レンジ（±inf）は範囲内に丸めてから整数にする
+    return struct.pack(f">{len(values)}H", *(int(min(PACK_MAX, max(0, v))) for v in values))
+
+
+def unpack_values(data):
+    if data is None:
+        return []
+    # boto3 は Binary 型で返す
+    data = bytes(getattr(data, "value", data))
+    return list(struct.unpack(f">{len(data) // 2}H", data))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def summarize(rates, ranges):
+    """ヒストグラムと許容レンジのパーセンタイルを求める"""
+    histogram = {}
+    for rate in rates:
+        band = int(rate) // RATE_HISTOGRAM_WIDTH * RATE_HISTOGRAM_WIDTH
+        histogram[band] = histogram.get(band, 0) + 1
+    return {
+        "rate_histogram": {str(band): count for band, count in sorted(histogram.items())},
+        "range_percentiles": {
+            "p50": int(percentile(ranges, 0.5)),
+            "p90": int(percentile(ranges, 0.9)),
+            "max": int(max(ranges, default=0)),
+        },
+    }
+
+
+def meta_list_values(rates, ranges, windows):
+    """
+    レートの降順に並んだ rates / ranges / windows（(下端, 上端) のリスト）から、
+    META_LIST_SET の ExpressionAttributeValues を作る
+    """
+    summary = summarize(rates, ranges)
+    return {
+        ":qr": pack_values(rates),
+        ":qg": pack_values(ranges),
+        ":qw": pack_values([bound for window in windows for bound in window]),
+        ":rh": summary["rate_histogram"],
+        ":rp": summary["range_percentiles"],
+    }
+
+
+def read_lists(item):
+    """
+    #META# アイテムからレート・許容レンジ・実際の許容レンジ（(下端, 上端)）のリストを取り出す。
+    queue_windows の無い旧形式（rate_list / range_list を含む）は rate ± range を実際の許容レンジとみなす。
+    """
+    if "queue_rates" in item:
+        rates, ranges = unpack_values(item["queue_rates"]), unpack_values(item.get("queue_ranges"))
+    else:
+        rates, ranges = [int(v) for v in item.get("rate_list", [])], [int(v) for v in item.get("range_list", [])]
+    bounds = unpack_values(item.get("queue_windows"))
+    if len(bounds) == 2 * len(rates):
+        windows = list(zip(bounds[0::2], bounds[1::2]))
+    else:
+        windows = [(rate - width, rate + width) for rate, width in zip(rates, ranges)]
+    return rates, ranges, windows
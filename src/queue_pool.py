@@ -0,0 +1,404 @@
+import uuid
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.dynamodb.conditions import Key
+
+# マッチキューの待ちプール（ティック間でインクリメンタルに更新する）
+#
+# キューテーブル上の構成（すべて namespace="default"）
+#   #META#                 : pool_version（インキュー・デキュー毎に +1）, pool_snapshot_id
+#   #POOL#<id>#<n>         : スナップショット（snapshot_id, version と records のコンパクトな配列）の n 番目のチャンク
+#   #DELTA#<version>       : そのバージョンで行われたインキュー / デキュー
+#   #MATCHED#<match_id>    : マッチ成立でキューから外れたプレイヤー（finalize_match と同じトランザクションで書く）
+# いずれも rate 属性を持たないため rate_index（プレイヤーのみのスパースインデックス）には現れない。
+#
+# ティックはスナップショットに差分とマッチ成立の記録だけを適用してプールを復元し、
+# 差分が欠けている（バージョンが食い違う）場合のみキュー全体を読み直す。
+# マッチ成立の記録はキューに入った時刻（inqueued_unixtime）が一致するエントリだけを外すので、
+# 差分との適用順によらず同じ結果になり、同じ記録を何度適用してもよい。
+# スナップショットは記録が SNAPSHOT_LOG_LIMIT 件たまったときだけ書き直すので、
+# ティックごとの書き込み量はキューの人数ではなく出入りの数に比例する。
+
+POOL_PREFIX = "#POOL#"
+DELTA_PREFIX = "#DELTA#"
+MATCHED_PREFIX = "#MATCHED#"
+# 1チャンクに詰めるレコードの大きさの目安（DynamoDB のアイテム上限 400KB に余裕を持たせる）
+POOL_CHUNK_BYTES = 300 * 1024
+# スナップショット以降の差分・マッチ成立の記録がこの件数を超えたらスナップショットを書き直す
+SNAPSHOT_LOG_LIMIT = 200
+
+# スナップショットの1レコードに格納するフィールド（順序がそのままレコードの並びになる）
+RECORD_FIELDS = (
+    "user_id",
+    "rate",
+    "best",
+    "range_spread_speed",
+    "inqueued_unixtime",
+    "discord_id",
+    "desired_role",
+    "blocking",
+    # 末尾に追加したフィールド（古いスナップショットのレコードには無いので既定値で補う）
+    "party_id",
+)
+
+
+def delta_key(version):
+    # 辞書順とバージョン順が一致するようにゼロ埋めする
+    return f"{DELTA_PREFIX}{int(version):012d}"
+
+
+def matched_key(match_id):
+    return f"{MATCHED_PREFIX}{int(match_id):012d}"
+
+
+def snapshot_key(snapshot_id, chunk):
+    return f"{POOL_PREFIX}{snapshot_id}#{int(chunk):04d}"
+
+
+class PoolEntry:
+    """プール内のプレイヤー1人分のレコード"""
+
+    __slots__ = RECORD_FIELDS
+
+    def __init__(self, user_id, rate, best, range_spread_speed, inqueued_unixtime,
+                 discord_id="", desired_role="", blocking="", party_id=""):
+        self.user_id = user_id
+        self.rate = int(rate)
+        self.best = int(best)
+        self.range_spread_speed = int(range_spread_speed)
+        self.inqueued_unixtime = int(inqueued_unixtime)
+        self.discord_id = discord_id or ""
+        self.desired_role = desired_role or ""
+        self.blocking = blocking or ""
+        self.party_id = party_id or ""
+
+    @classmethod
+    def from_item(cls, item):
+        """キューテーブルのアイテム（または差分アイテムの record）から作る"""
+        return cls(
+            item["user_id"],
+            item["rate"],
+            item.get("best", item["rate"]),
+            item["range_spread_speed"],
+            item["inqueued_unixtime"],
+            item.get("discord_id", ""),
+            item.get("desired_role", ""),
+            item.get("blocking", ""),
+            item.get("party_id", ""),
+        )
+
+    def to_record(self):
+        return [getattr(self, name) for name in RECORD_FIELDS]
+
+    def to_item(self):
+        return {name: getattr(self, name) for name in RECORD_FIELDS}
+
+
+class QueuePool:
+    """
+    レートの降順に並べた待ちプール。
+    _keys（(-rate, user_id) の昇順）と _entries を同じ並びの配列で持ち、bisect で挿入・削除する。
+    version はこのプールに適用済みの差分の最終バージョン。
+    snapshot_id / snapshot_version は元にしたスナップショット（キュー全体を読み直した場合は None）、
+    matches はスナップショット以降に適用したマッチ成立の記録のキー。
+    """
+
+    def __init__(self, version=0, snapshot_id=None):
+        self.version = version
+        self.snapshot_id = snapshot_id
+        self.snapshot_version = version
+        self.matches = set()
+        self._keys = []
+        self._entries = []
+        self._by_user = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        return user_id in self._by_user
+
+    def add(self, entry):
+        # 再インキューは古いレコードを置き換える
+        self.remove(entry.user_id)
+        key = (-entry.rate, entry.user_id)
+        index = bisect_left(self._keys, key)
+        self._keys.insert(index, key)
+        self._entries.insert(index, entry)
+        self._by_user[entry.user_id] = entry
+
+    def remove(self, user_id):
+        entry = self._by_user.pop(user_id, None)
+        if entry is None:
+            return False
+        index = bisect_left(self._keys, (-entry.rate, entry.user_id))
+        del self._keys[index]
+        del self._entries[index]
+        return True
+
+    def apply(self, delta):
+        """差分アイテム（op = "inqueue" / "dequeue"）を1件適用する"""
+        if delta["op"] == "inqueue":
+            self.add(PoolEntry.from_item(delta["record"]))
+        else:
+            self.remove(delta["record"]["user_id"])
+        self.version = int(delta["version"])
+
+    def apply_match(self, record):
+        """マッチ成立の記録（match_record_item）を適用する。同じ記録を何度適用しても結果は変わらない"""
+        for user_id, inqueued_unixtime in record["members"]:
+            entry = self._by_user.get(user_id)
+            # マッチ後に入り直したプレイヤー（別の inqueued_unixtime）は外さない
+            if entry is not None and entry.inqueued_unixtime == int(inqueued_unixtime):
+                self.remove(user_id)
+        self.matches.add(record["user_id"])
+
+    def log_size(self):
+        """スナップショット以降に適用した差分とマッチ成立の記録の件数"""
+        return self.version - self.snapshot_version + len(self.matches)
+
+    def needs_snapshot(self):
+        return self.snapshot_id is None or self.log_size() >= SNAPSHOT_LOG_LIMIT
+
+    def entries(self):
+        """レートの降順に並んだレコードを返す"""
+        return list(self._entries)
+
+    def to_chunks(self, chunk_bytes=POOL_CHUNK_BYTES):
+        """レコードを、1アイテムに収まる大きさごとのチャンクに分ける（空のプールでも1チャンク）"""
+        chunks = [[]]
+        size = 0
+        for entry in self._entries:
+            record = entry.to_record()
+            record_size = sum(len(str(value)) for value in record) + 3 * len(record)
+            if chunks[-1] and size + record_size > chunk_bytes:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(record)
+            size += record_size
+        return chunks
+
+    @classmethod
+    def from_chunks(cls, snapshot_id, version, chunks):
+        pool = cls(int(version), snapshot_id)
+        # スナップショットは既にレート降順なので、そのまま配列に積む
+        for chunk in chunks:
+            for record in chunk:
+                entry = PoolEntry(*record)
+                pool._keys.append((-entry.rate, entry.user_id))
+                pool._entries.append(entry)
+                pool._by_user[entry.user_id] = entry
+        return pool
+
+    @classmethod
+    def from_items(cls, items, version):
+        pool = cls(version)
+        for item in items:
+            pool.add(PoolEntry.from_item(item))
+        return pool
+
+
+def delta_item(version, op, item):
+    """バージョン version の差分アイテムを作る"""
+    record = PoolEntry.from_item(item).to_item() if op == "inqueue" else {"user_id": item["user_id"]}
+    return {
+        "namespace": "default",
+        "user_id": delta_key(version),
+        "op": op,
+        "version": version,
+        "record": record,
+    }
+
+
+def match_record_item(match_id, players):
+    """マッチ成立でキューから外れるプレイヤーの記録。finalize_match のトランザクションに含める"""
+    return {
+        "namespace": "default",
+        "user_id": matched_key(match_id),
+        "match_id": int(match_id),
+        "members": [[p["user_id"], int(p["inqueued_unixtime"])] for p in players],
+    }
+
+
+def query_items(queue, condition, projection=None):
+    """キー条件 condition に合う管理用アイテムを、LastEvaluatedKey でページングしながらキー順に全て返す"""
+    kwargs = {
+        "KeyConditionExpression": condition,
+        "ConsistentRead": True,
+    }
+    if projection:
+        kwargs["ProjectionExpression"] = projection
+    items = []
+    while True:
+        response = queue.query(**kwargs)
+        items.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            return items
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def query_prefix(queue, prefix, projection=None):
+    """キーが prefix で始まる管理用アイテムをキー順に全て返す"""
+    return query_items(queue, Key("namespace").eq("default") & Key("user_id").begins_with(prefix), projection)
+
+
+def query_deltas(queue, after_version, until_version, projection=None):
+    """after_version より後、until_version までの差分をバージョン順に返す"""
+    return query_items(
+        queue,
+        Key("namespace").eq("default") & Key("user_id").between(delta_key(after_version + 1), delta_key(until_version)),
+        projection,
+    )
+
+
+# キュー全体を読む際の取得項目
+WAITING_USER_PROJECTION = (
+    "user_id, rate, best, blocking, desired_role, range_spread_speed, discord_id, inqueued_unixtime, party_id"
+)
+
+
+def iter_waiting_users(queue, projection=WAITING_USER_PROJECTION, page_size=None):
+    """
+    rate_index を LastEvaluatedKey でページングしながら、待ちユーザーをレートの降順に1件ずつ返す。
+    呼び出し側が現在のページを処理している間に、次のページを別スレッドで先読みする。
+    page_size を指定すると1ページの件数を制限する（未指定なら1MB単位）。
+    rate_index は rate を持つアイテムだけのスパースインデックスなので、
+    #META# などの管理用アイテムは FilterExpression なしで最初から含まれない。
+    強い整合性で読むので、先に読んだ #META# の pool_version までのインキューは必ず含まれる
+    （含まれないまま差分を取り込み済みとして消すと、そのプレイヤーは入り直すまでマッチしない）。
+    """
+    kwargs = {
+        "IndexName": "rate_index",
+        "KeyConditionExpression": Key("namespace").eq("default"),
+        "ScanIndexForward": False,
+        "ProjectionExpression": projection,
+        "ConsistentRead": True,
+    }
+    if page_size is not None:
+        kwargs["Limit"] = page_size
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(queue.query, **kwargs)
+        while True:
+            response = future.result()
+            last_key = response.get("LastEvaluatedKey")
+            if last_key is not None:
+                future = executor.submit(queue.query, ExclusiveStartKey=last_key, **kwargs)
+            yield from response["Items"]
+            if last_key is None:
+                return
+
+
+def read_full_pool(queue, version):
+    """rate_index からキュー全体を読み直してプールを作る"""
+    return QueuePool.from_items(iter_waiting_users(queue), version)
+
+
+def read_snapshot(queue, snapshot_id):
+    """スナップショットのチャンクを読んでプールを作る。チャンクが揃っていなければ None"""
+    items = query_prefix(queue, f"{POOL_PREFIX}{snapshot_id}#")
+    if not items or len(items) != int(items[0]["chunks"]):
+        return None
+    return QueuePool.from_chunks(snapshot_id, items[0]["version"], [item["records"] for item in items])
+
+
+def load_pool(queue, meta, cached=None):
+    """
+    ティック開始時のプールを返す。
+    1. 手元（コンテナ内）のプールが最新のスナップショットから作ったものならそれを使う
+    2. そうでなければ #POOL# のスナップショットを読む
+    3. プールのバージョン以降の差分と、未適用のマッチ成立の記録を適用する。差分が欠けていればキュー全体を読み直す
+    """
+    pool_version = int(meta.get("pool_version", 0))
+    snapshot_id = meta.get("pool_snapshot_id")
+
+    pool = None
+    if cached is not None and snapshot_id is not None and cached.snapshot_id == snapshot_id:
+        pool = cached
+    elif snapshot_id is not None:
+        pool = read_snapshot(queue, snapshot_id)
+
+    if pool is not None and pool.version <= pool_version:
+        deltas = query_deltas(queue, pool.version, pool_version) if pool.version < pool_version else []
+        versions = [int(d["version"]) for d in deltas]
+        if versions == list(range(pool.version + 1, pool_version + 1)):
+            for delta in deltas:
+                pool.apply(delta)
+            matches = apply_match_records(queue, pool)
+            print(f"queue pool: applied {len(deltas)} deltas and {matches} matches (version {pool_version})")
+            return pool
+
+    print(f"queue pool: full re-read (version {pool_version})")
+    pool = read_full_pool(queue, pool_version)
+    # キューのアイテムはマッチ成立と同じトランザクションで消えているので、既存の記録は全て取り込み済みとして扱う
+    apply_match_records(queue, pool)
+    return pool
+
+
+def apply_match_records(queue, pool):
+    """未適用のマッチ成立の記録をプールに適用し、適用した件数を返す"""
+    count = 0
+    for record in query_prefix(queue, MATCHED_PREFIX, "user_id, members"):
+        if record["user_id"] not in pool.matches:
+            pool.apply_match(record)
+            count += 1
+    return count
+
+
+def save_pool(queue, pool, fence_token):
+    """
+    スナップショットをチャンクに分けて保存し、取り込み済みの差分・マッチ成立の記録と古いスナップショットを削除する。
+    新しいチャンクを書き終えてから META の pool_snapshot_id を切り替えるので、途中で失敗しても
+    次のティックは古いスナップショットと（まだ消していない）記録から復元できる。
+    META の fence_token が fence_token（プール読み込み時の値、またはコミット時に取得したリースの値）から
+    変わっていれば、他の処理がマッチを確定させているので古いプールで上書きしない（0 は未発行）。
+    リースの値を渡すのは、読み込み時の値の次のトークンだった（間に他のコミットがなかった）場合だけにすること。
+    """
+    snapshot_id = uuid.uuid4().hex
+    chunks = pool.to_chunks()
+    with queue.batch_writer() as batch:
+        for n, records in enumerate(chunks):
+            batch.put_item(Item={
+                "namespace": "default",
+                "user_id": snapshot_key(snapshot_id, n),
+                "snapshot_id": snapshot_id,
+                "version": pool.version,
+                "chunks": len(chunks),
+                "records": records,
+            })
+    if fence_token:
+        condition = "fence_token = :t"
+        values = {":id": snapshot_id, ":t": fence_token}
+    else:
+        condition = "attribute_not_exists(fence_token)"
+        values = {":id": snapshot_id}
+    try:
+        response = queue.update_item(
+            Key={"namespace": "default", "user_id": "#META#"},
+            UpdateExpression="SET pool_snapshot_id = :id",
+            ConditionExpression=condition,
+            ExpressionAttributeValues=values,
+            ReturnValues="UPDATED_OLD",
+        )
+    except Exception:
+        delete_keys(queue, [snapshot_key(snapshot_id, n) for n in range(len(chunks))])
+        raise
+    previous = response.get("Attributes", {}).get("pool_snapshot_id")
+
+    consumed = [item["user_id"] for item in query_deltas(queue, -1, pool.version, "user_id")]
+    consumed.extend(pool.matches)
+    if previous:
+        consumed.extend(item["user_id"] for item in query_prefix(queue, f"{POOL_PREFIX}{previous}#", "user_id"))
+        # 1アイテムに全件を入れていた旧形式のスナップショット
+        consumed.append(POOL_PREFIX)
+    delete_keys(queue, consumed)
+
+    pool.snapshot_id = snapshot_id
+    pool.snapshot_version = pool.version
+    pool.matches = set()
+
+
+def delete_keys(queue, user_ids):
+    with queue.batch_writer() as batch:
+        for user_id in user_ids:
+            batch.delete_item(Key={"namespace": "default", "user_id": user_id})
@@ -2,7 +2,7 @@ import os
 import json
 import asyncio
 import aioboto3  # 正しくインポート
-from .match_queue import get_info
+from .match_queue import get_info, refresh_heartbeat
 
 async def get_domain_and_stage_async(event):
     """
@@ -30,14 +30,12 @@ async def on_connect_async(event, context):
     if not bubble_user_id:
         return {"statusCode": 400, "body": "Missing user_id"}
 
-    '''現在ConnectionTableは使っていないため、登録機構を一旦コメントアウト
     try:
         # DynamoDB リソースの取得
         async with aioboto3.Session().resource("dynamodb") as dynamodb:
-            user_table = await dynamodb.Table(os.environ["USER_TABLE"])
             connection_table = await dynamodb.Table(os.environ["CONNECTION_TABLE"])
 
-            # ConnectionTableに保存
+            # ConnectionTableに保存（キュー待ちのハートビートは、この接続の user_id に対して行う）
             await connection_table.put_item(
                 Item={
                     "connection_id": connection_id,
@@ -46,6 +44,14 @@ async def on_connect_async(event, context):
                 }
             )
 
+    except Exception as e:
+        print("Error in on_connect:", e)
+
+    '''UserTableのconnection_idsは現在使っていないため、登録機構を一旦コメントアウト
+    try:
+        async with aioboto3.Session().resource("dynamodb") as dynamodb:
+            user_table = await dynamodb.Table(os.environ["USER_TABLE"])
+
             # UserTableにconnection_idを追加
             await user_table.update_item(
                 Key={"namespace": "default", "user_id": bubble_user_id},
@@ -68,7 +74,15 @@ async def on_disconnect_async(event, context):
     connection_id = event["requestContext"]["connectionId"]
     print(f"[OnDisconnect] {connection_id}")
 
-    '''現在ConnectionTableは使っていないため、登録機構を一旦コメントアウト
+    try:
+        # ConnectionTableから削除（以降この接続からのハートビートは受け付けない）
+        async with aioboto3.Session().resource("dynamodb") as dynamodb:
+            connection_table = await dynamodb.Table(os.environ["CONNECTION_TABLE"])
+            await connection_table.delete_item(Key={"connection_id": connection_id})
+    except Exception as e:
+        print("Error in on_disconnect:", e)
+
+    '''UserTableのconnection_idsは現在使っていないため、登録機構を一旦コメントアウト
     try:
         # DynamoDB リソースの取得
         async with aioboto3.Session().resource("dynamodb") as dynamodb:
@@ -122,9 +136,18 @@ async def on_message_async(event, context):
 
     if action == "ping":
         print(f"[Ping] Received ping from {connection_id}")
+        # user_id 付きの ping はキュー待ちのハートビートも兼ねる
+        if data.get("user_id"):
+            await refresh_heartbeat_async(connection_id, data["user_id"])
         await send_websocket_message_async(event, connection_id, {"action": "pong"})
         return {"statusCode": 200, "body": "Pong sent"}
 
+    if action == "heartbeat":
+        # キュー待ちのハートビート。途絶えたプレイヤーは match_make がキューから外す
+        queued = await refresh_heartbeat_async(connection_id, data.get("user_id"))
+        await send_websocket_message_async(event, connection_id, {"action": "heartbeatAck", "queued": queued})
+        return {"statusCode": 200, "body": "Heartbeat received"}
+
     if action == "echo":
         await send_websocket_message_async(event, connection_id, {"msg": "Echo from server", "received": data})
 
@@ -136,6 +159,33 @@ async def on_message_async(event, context):
     return {"statusCode": 200}
 
 
+async def get_connection_user_async(connection_id):
+    """$connect で ConnectionTable に登録した、この接続の user_id を返す（登録がなければ None）"""
+    try:
+        async with aioboto3.Session().resource("dynamodb") as dynamodb:
+            connection_table = await dynamodb.Table(os.environ["CONNECTION_TABLE"])
+            resp = await connection_table.get_item(Key={"connection_id": connection_id})
+    except Exception as e:
+        print("Error in get_connection_user:", e)
+        return None
+    return resp.get("Item", {}).get("user_id")
+
+
+async def refresh_heartbeat_async(connection_id, claimed_user_id=None):
+    """
+    接続元のプレイヤーのキュー待ちのハートビートを更新し、キューにいれば True を返す。
+    user_id はメッセージではなく接続の登録から決める（他人のキュー待ちを延命できないように）。
+    メッセージに別の user_id が書かれていれば更新しない。
+    refresh_heartbeat は同期の boto3 呼び出しなので、イベントループを止めないよう別スレッドで実行する。
+    """
+    user_id = await get_connection_user_async(connection_id)
+    if not user_id or (claimed_user_id and claimed_user_id != user_id):
+        print(f"[Heartbeat] connection {connection_id} is not registered for user {claimed_user_id}")
+        return False
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, refresh_heartbeat, user_id)
+
+
 async def send_websocket_message_async(event, connection_id, message_obj):
     """
     WebSocketに非同期でメッセージを送信する。
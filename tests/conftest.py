@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+from src.matchmake_sim import SIM_ENV, create_tables, start_backend
+
+# match_queue などは読み込み時に環境変数のテーブル名で boto3 のテーブルを作るので、
+# テスト用の値を先に入れておく（AWS への通信は読み込み時には発生しない）
+for key, value in SIM_ENV.items():
+    os.environ.setdefault(key, value)
+
+# moto を先に読み込み、以降に作られる boto3 のクライアントの呼び出しを moto が受けられるようにする
+import moto  # noqa: E402,F401
+
+
+@pytest.fixture(scope="session")
+def backend():
+    """moto のメモリ上の DynamoDB で動く (match_queue, match_make, allocator)"""
+    return start_backend()
+
+
+@pytest.fixture
+def tables(backend):
+    """テストごとに空のテーブルを作り直して backend を返す"""
+    match_queue, match_make, _ = backend
+    create_tables(match_queue, match_make)
+    return backend
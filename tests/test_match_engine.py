@@ -0,0 +1,191 @@
+import itertools
+import random
+
+from src.match_engine import (
+    ALL_ROLES,
+    GROUP_SIZE,
+    GroupBuilder,
+    GroupSearch,
+    balance_teams,
+    build_conflict_masks,
+    find_valid_groups,
+    group_valid,
+    make_benchmark_players,
+    parse_role_mask,
+    party_split_feasible,
+    sweep_form_groups,
+)
+
+
+def make_player(user_id, rate, width=100, desired_role="", party_id=""):
+    return {
+        "user_id": user_id,
+        "rate": rate,
+        "min_rating": rate - width,
+        "max_rating": rate + width,
+        "inqueued_unixtime": 0,
+        "role_mask": parse_role_mask(desired_role),
+        "party_id": party_id,
+    }
+
+
+def assert_disjoint_valid(groups):
+    seen = set()
+    for group in groups:
+        assert len(group) == GROUP_SIZE
+        assert group_valid(group)
+        ids = {p["user_id"] for p in group}
+        assert len(ids) == GROUP_SIZE
+        assert not ids & seen
+        seen |= ids
+
+
+# --- sweep_form_groups ---
+
+def test_sweep_forms_one_group_from_ten_overlapping_players():
+    players = [make_player(f"p{i}", 1500 + i * 5) for i in range(10)]
+    groups = sweep_form_groups(players)
+    assert len(groups) == 1
+    assert_disjoint_valid(groups)
+
+
+def test_sweep_needs_ten_players():
+    players = [make_player(f"p{i}", 1500 + i * 5) for i in range(9)]
+    assert sweep_form_groups(players) == []
+
+
+def test_sweep_does_not_mix_disjoint_rate_clusters():
+    low = [make_player(f"low{i}", 1000 + i) for i in range(10)]
+    high = [make_player(f"high{i}", 2000 + i) for i in range(10)]
+    groups = sweep_form_groups(low + high)
+    assert len(groups) == 2
+    assert_disjoint_valid(groups)
+    for group in groups:
+        assert len({p["user_id"][:3] for p in group}) == 1
+
+
+def test_sweep_groups_are_valid_on_benchmark_pool():
+    players = make_benchmark_players(500, seed=1)
+    groups = sweep_form_groups(players)
+    assert groups
+    assert_disjoint_valid(groups)
+    for group in groups:
+        assert [p["rate"] for p in group] == sorted((p["rate"] for p in group), reverse=True)
+
+
+# --- GroupBuilder（ロール制約のホールの条件・ブロック制約） ---
+
+def test_builder_rejects_third_player_limited_to_one_role():
+    top = parse_role_mask("top")
+    builder = GroupBuilder()
+    assert builder.try_add(make_player("a", 1500, desired_role="top"))
+    assert builder.try_add(make_player("b", 1500, desired_role="top"))
+    assert not builder.accepts_roles(top)
+    assert builder.accepts_roles(ALL_ROLES)
+
+
+def test_builder_applies_hall_condition_to_role_sets():
+    # top のみ2人 + jungle のみ2人がいると、{top, jungle} に収まる5人目は入れられない
+    builder = GroupBuilder()
+    for user_id, role in (("a", "top"), ("b", "top"), ("c", "jungle"), ("d", "jungle")):
+        assert builder.try_add(make_player(user_id, 1500, desired_role=role))
+    assert not builder.accepts_roles(parse_role_mask("top,jungle"))
+    assert builder.accepts_roles(parse_role_mask("top,bottom"))
+    builder.pop()
+    assert builder.accepts_roles(parse_role_mask("top,jungle"))
+
+
+def test_builder_can_complete_counts_candidate_roles():
+    builder = GroupBuilder()
+    assert not builder.can_complete({ALL_ROLES: 9}, GROUP_SIZE)
+    assert builder.can_complete({ALL_ROLES: 10}, GROUP_SIZE)
+    for i in range(6):
+        builder.add(make_player(f"p{i}", 1500))
+    # 残り4人が全員 top のみでは、top 以外の4ロールを8人で担当できない
+    assert not builder.can_complete({parse_role_mask("top"): 4}, 4)
+    assert builder.can_complete({ALL_ROLES: 4}, 4)
+
+
+def test_builder_rejects_blocked_player():
+    players = build_conflict_masks([make_player(f"p{i}", 1500) for i in range(3)])
+    players[0]["blocking"] = "p2"
+    players = build_conflict_masks(players)
+    builder = GroupBuilder()
+    assert builder.try_add(players[0])
+    assert builder.try_add(players[1])
+    assert not builder.try_add(players[2])
+
+
+# --- GroupSearch / find_valid_groups ---
+
+def test_search_finds_no_group_when_roles_cannot_be_filled():
+    players = [make_player(f"p{i}", 1500, desired_role="top" if i < 3 else "") for i in range(10)]
+    assert GroupSearch(players).find() is None
+    assert find_valid_groups(players) == []
+
+
+def test_find_valid_groups_respects_rating_window():
+    players = [make_player(f"p{i}", 1500 + i * 10, width=100) for i in range(20)]
+    groups = find_valid_groups(players)
+    assert len(groups) == 2
+    assert_disjoint_valid(groups)
+    # 許容レンジが狭いと、レート差 90 の10人でも組めない
+    narrow = [make_player(f"p{i}", 1500 + i * 10, width=40) for i in range(10)]
+    assert find_valid_groups(narrow) == []
+
+
+def test_find_valid_groups_takes_players_in_descending_rate_order():
+    players = [make_player(f"p{i}", 1500 + i * 10, width=200) for i in range(11)]
+    groups = find_valid_groups(players)
+    # 旧実装と同じく、レートの高いプレイヤーから順にグループに入れる
+    assert [p["user_id"] for p in groups[0]] == [f"p{i}" for i in range(10, 0, -1)]
+
+
+def test_find_valid_groups_on_benchmark_pool():
+    players = make_benchmark_players(300, seed=2)
+    groups = find_valid_groups(players)
+    assert groups
+    assert_disjoint_valid(groups)
+
+
+# --- balance_teams ---
+
+def test_balance_teams_minimizes_rate_gap():
+    group = [make_player(f"p{i}", 1000 + i * 100) for i in range(10)]
+    total = sum(p["rate"] for p in group)
+    best = min(abs(2 * sum(p["rate"] for p in team) - total) for team in itertools.combinations(group, 5))
+    team_a, team_b = balance_teams(group, rng=random.Random(0))
+    assert len(team_a) == len(team_b) == 5
+    assert {p["user_id"] for p in team_a + team_b} == {p["user_id"] for p in group}
+    assert abs(sum(p["rate"] for p in team_a) - sum(p["rate"] for p in team_b)) == best
+
+
+def test_balance_teams_splits_single_role_players():
+    group = [make_player(f"p{i}", 1500 + i, desired_role="top" if i < 2 else "") for i in range(10)]
+    for seed in range(20):
+        team_a, team_b = balance_teams(group, rng=random.Random(seed))
+        assert sum(p["user_id"] in ("p0", "p1") for p in team_a) == 1
+
+
+def test_balance_teams_keeps_parties_together():
+    group = [make_player(f"p{i}", 1000 + i * 100) for i in range(10)]
+    for i in (0, 9, 4):
+        group[i]["party_id"] = "party-a"
+    group[1]["party_id"] = group[2]["party_id"] = "party-b"
+    for seed in range(20):
+        team_a, team_b = balance_teams(group, rng=random.Random(seed))
+        team_a_ids = {p["user_id"] for p in team_a}
+        for party_id in ("party-a", "party-b"):
+            members = {p["user_id"] for p in group if p["party_id"] == party_id}
+            assert members <= team_a_ids or not members & team_a_ids
+
+
+# --- party_split_feasible ---
+
+def test_party_split_feasible():
+    assert party_split_feasible([5, 5])
+    assert party_split_feasible([4, 4, 1, 1])
+    assert party_split_feasible([1] * 10)
+    assert not party_split_feasible([3, 3, 3, 1])
+    assert not party_split_feasible([4, 3, 3])
+    assert not party_split_feasible([2, 2, 2, 2, 2])
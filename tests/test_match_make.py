@@ -0,0 +1,304 @@
+import json
+
+from botocore.exceptions import EndpointConnectionError
+
+from src.queue_meta import read_lists
+from src.queue_pool import PoolEntry, matched_key
+
+
+def enqueue(backend, count, inqueued_unixtime=1000, prefix="p"):
+    """count 人をユーザーテーブルとキューに直接書き込み、グループ形成に使うプレイヤー辞書を返す"""
+    match_queue, match_make, _ = backend
+    players = []
+    for i in range(count):
+        user_id, rate = f"{prefix}{i}", 1500 + i
+        match_make.user_table.put_item(Item={
+            "namespace": "default", "user_id": user_id, "rate": rate,
+            "unitemate_max_rate": rate, "assigned_match_id": 0,
+        })
+        item = {
+            "namespace": "default", "user_id": user_id, "rate": rate, "best": rate,
+            "range_spread_speed": 20, "inqueued_unixtime": inqueued_unixtime,
+            "discord_id": "", "desired_role": "", "blocking": "",
+        }
+        match_queue.queue.put_item(Item=item)
+        players.append(match_make.to_player(PoolEntry.from_item(item), inqueued_unixtime))
+    return players
+
+
+def read_queue(backend, user_id):
+    return backend[0].queue.get_item(Key={"namespace": "default", "user_id": user_id}).get("Item")
+
+
+def read_match(backend, match_id):
+    return backend[1].matches_table.get_item(Key={"namespace": "default", "match_id": match_id}).get("Item")
+
+
+def assigned_match_id(backend, user_id):
+    item = backend[1].user_table.get_item(Key={"namespace": "default", "user_id": user_id})["Item"]
+    return int(item["assigned_match_id"])
+
+
+def free_vcs(backend):
+    match_queue, _, allocator = backend
+    return allocator.list_free_vcs(match_queue.queue)
+
+
+def test_finalize_match_commits_every_item(tables):
+    _, match_make, _ = tables
+    group = enqueue(tables, 10)
+    vc = free_vcs(tables)[0]
+    teams = match_make.finalize_match(group, 1, vc, vc + 1)
+    assert teams is not None
+    assert len(teams[0]) == len(teams[1]) == 5
+    assert all(read_queue(tables, p["user_id"]) is None for p in group)
+    assert all(assigned_match_id(tables, p["user_id"]) == 1 for p in group)
+    match = read_match(tables, 1)
+    assert (match["vc_A"], match["vc_B"]) == (vc, vc + 1)
+    assert vc not in free_vcs(tables)
+    assert read_queue(tables, matched_key(1)) is not None
+
+
+def test_finalize_match_writes_nothing_if_a_player_left(tables):
+    match_queue, match_make, _ = tables
+    group = enqueue(tables, 10)
+    match_queue.queue.delete_item(Key={"namespace": "default", "user_id": "p3"})
+    vc = free_vcs(tables)[0]
+    assert match_make.finalize_match(group, 1, vc, vc + 1) is None
+    assert read_queue(tables, "p0") is not None
+    assert assigned_match_id(tables, "p0") == 0
+    assert read_match(tables, 1) is None
+    assert vc in free_vcs(tables)
+
+
+def test_finalize_match_writes_nothing_for_a_requeued_player(tables):
+    _, match_make, _ = tables
+    group = enqueue(tables, 10)
+    # p0 がマッチメイクのプール読み込み後に入り直した
+    enqueue(tables, 1, inqueued_unixtime=2000)
+    vc = free_vcs(tables)[0]
+    assert match_make.finalize_match(group, 1, vc, vc + 1) is None
+    assert read_queue(tables, "p5") is not None
+
+
+def test_finalize_match_requires_the_fence_token(tables):
+    match_queue, match_make, _ = tables
+    group = enqueue(tables, 10)
+    match_queue.queue.update_item(
+        Key={"namespace": "default", "user_id": "#META#"},
+        UpdateExpression="SET fence_token = :t",
+        ExpressionAttributeValues={":t": 2},
+    )
+    vc = free_vcs(tables)[0]
+    assert match_make.finalize_match(group, 1, vc, vc + 1, fence_token=1) is None
+    assert read_match(tables, 1) is None
+    assert match_make.finalize_match(group, 1, vc, vc + 1, fence_token=2) is not None
+
+
+def test_finalize_match_checks_the_outcome_after_an_unknown_error(tables, monkeypatch):
+    _, match_make, _ = tables
+    client = match_make.dynamodb_client
+    transact_write_items = client.transact_write_items
+    group = enqueue(tables, 10)
+    vc = free_vcs(tables)[0]
+
+    def fail_before_commit(**kwargs):
+        raise EndpointConnectionError(endpoint_url="https://dynamodb")
+
+    monkeypatch.setattr(client, "transact_write_items", fail_before_commit)
+    assert match_make.finalize_match(group, 1, vc, vc + 1) is None
+
+    def fail_after_commit(**kwargs):
+        transact_write_items(**kwargs)
+        raise EndpointConnectionError(endpoint_url="https://dynamodb")
+
+    monkeypatch.setattr(client, "transact_write_items", fail_after_commit)
+    assert match_make.finalize_match(group, 1, vc, vc + 1) is not None
+
+
+def test_handle_notifies_matches_committed_next_to_a_failed_one(tables, monkeypatch):
+    match_queue, match_make, _ = tables
+    client = match_make.dynamodb_client
+    transact_write_items = client.transact_write_items
+    enqueue(tables, 20)
+    match_queue.queue.update_item(
+        Key={"namespace": "default", "user_id": "#META#"},
+        UpdateExpression="SET queue_count = :n",
+        ExpressionAttributeValues={":n": 20},
+    )
+    calls = []
+
+    def fail_first_match(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise RuntimeError("unexpected")
+        return transact_write_items(**kwargs)
+
+    notified = []
+    monkeypatch.setattr(client, "transact_write_items", fail_first_match)
+    monkeypatch.setattr(match_make, "notify_match", lambda match_id, *args: notified.append(match_id) or [])
+    # moto はトランザクションの並行実行に対応していないので1件ずつコミットする
+    monkeypatch.setattr(match_make, "FINALIZE_CONCURRENCY", 1)
+    response = match_make.handle({"matcher": "sweep"}, None)
+    assert response["statusCode"] == 200
+    assert len(notified) == 1
+    assert read_match(tables, notified[0]) is not None
+    assert match_queue.get_queue_count() == 10
+
+
+def read_meta(backend):
+    return backend[0].queue.get_item(Key={"namespace": "default", "user_id": "#META#"}, ConsistentRead=True)["Item"]
+
+
+def read_meta_lists(backend):
+    return read_lists(read_meta(backend))
+
+
+def test_lease_is_exclusive_until_it_expires(tables, monkeypatch):
+    _, match_make, _ = tables
+    assert match_make.acquire_lease("a") == 1
+    assert match_make.acquire_lease("b") is None
+    # 同じ保持者は取り直せる（トークンは進む）
+    assert match_make.acquire_lease("a") == 2
+    now = match_make.time.time()
+    monkeypatch.setattr(match_make.time, "time", lambda: now + match_make.LEASE_SECONDS + 1)
+    assert match_make.acquire_lease("b") == 3
+
+
+def test_release_lease_ignores_a_lost_lease(tables):
+    _, match_make, _ = tables
+    assert match_make.acquire_lease("a") == 1
+    # 古いトークンでは解放できない
+    match_make.release_lease("a", 0)
+    assert match_make.acquire_lease("b") is None
+    match_make.release_lease("a", 1)
+    assert match_make.acquire_lease("b") == 2
+
+
+def test_finalize_match_retries_transaction_conflicts_only(tables, monkeypatch):
+    _, match_make, _ = tables
+    client = match_make.dynamodb_client
+    transact_write_items = client.transact_write_items
+    group = enqueue(tables, 10)
+    vc = free_vcs(tables)[0]
+    monkeypatch.setattr(match_make, "FINALIZE_BACKOFF_BASE", 0)
+    calls = []
+
+    def cancelled(code):
+        return client.exceptions.TransactionCanceledException(
+            {"Error": {"Code": "TransactionCanceledException"}, "CancellationReasons": [{"Code": code}]},
+            "TransactWriteItems",
+        )
+
+    def conflict_once(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise cancelled("TransactionConflict")
+        return transact_write_items(**kwargs)
+
+    monkeypatch.setattr(client, "transact_write_items", conflict_once)
+    assert match_make.finalize_match(group, 1, vc, vc + 1) is not None
+    assert len(calls) == 2
+
+    calls.clear()
+
+    def condition_failed(**kwargs):
+        calls.append(kwargs)
+        raise cancelled("ConditionalCheckFailed")
+
+    monkeypatch.setattr(client, "transact_write_items", condition_failed)
+    assert match_make.finalize_match(group, 2, vc + 2, vc + 3) is None
+    assert len(calls) == 1
+
+
+def test_handle_releases_the_lease_before_notifying(tables, monkeypatch):
+    _, match_make, _ = tables
+    enqueue(tables, 10)
+    leases = []
+
+    def run_all(notifications):
+        # 通知を送る時点でリースが解放されていること
+        leases.append(read_meta(tables).get("lease_expires_at"))
+        return []
+
+    monkeypatch.setattr(match_make, "notify_match", lambda *args: [])
+    monkeypatch.setattr(match_make, "run_all", run_all)
+    monkeypatch.setattr(match_make, "FINALIZE_CONCURRENCY", 1)
+    assert match_make.handle({"matcher": "sweep"}, None)["statusCode"] == 200
+    assert leases == [0]
+    assert read_meta(tables)["fence_token"] == 1
+
+
+def test_handle_drops_the_pool_if_another_tick_committed(tables, monkeypatch):
+    match_queue, match_make, _ = tables
+    enqueue(tables, 10)
+    acquire_lease = match_make.acquire_lease
+
+    def acquire_after_another_tick(owner):
+        # プールの読み込み後に、他のティックがリースを取得してマッチを確定させた
+        match_queue.queue.update_item(
+            Key={"namespace": "default", "user_id": "#META#"},
+            UpdateExpression="ADD fence_token :one",
+            ExpressionAttributeValues={":one": 1},
+        )
+        return acquire_lease(owner)
+
+    monkeypatch.setattr(match_make, "acquire_lease", acquire_after_another_tick)
+    monkeypatch.setattr(match_make, "notify_match", lambda *args: [])
+    monkeypatch.setattr(match_make, "FINALIZE_CONCURRENCY", 1)
+    match_make.handle({"matcher": "sweep"}, None)
+    assert match_make.pool_cache is None
+    assert read_meta(tables)["lease_expires_at"] == 0
+
+
+def test_tick_rewrites_the_lists_despite_concurrent_inqueues(tables, monkeypatch):
+    match_queue, match_make, _ = tables
+    monkeypatch.setattr(match_queue, "MATCHMAKE_ON_INQUEUE", False)
+    players = enqueue(tables, 3)
+    # ティックの読み込み後にインキューがあっても、マッチ成立分を外した一覧は書き込まれる
+    match_make.user_table.put_item(Item={"namespace": "default", "user_id": "late", "rate": 1700, "assigned_match_id": 0})
+    match_queue.inqueue_members([{
+        "namespace": "default", "user_id": "late", "blocking": "", "desired_role": "",
+        "range_spread_speed": 20, "range_spread_count": 0, "discord_id": "", "inqueued_unixtime": 1000,
+    }])
+    match_make.update_queue_meta(players[1:], 2000)
+    rates, _, windows = read_meta_lists(tables)
+    assert rates == [p["rate"] for p in players[1:]]
+    assert windows == [(p["min_rating"], p["max_rating"]) for p in players[1:]]
+    # 後のティックが書いた一覧を、古いティックは上書きしない
+    match_make.update_queue_meta(players, 1999)
+    assert read_meta_lists(tables)[0] == [p["rate"] for p in players[1:]]
+    match_make.update_queue_meta(players[2:], 2000)
+    assert read_meta_lists(tables)[0] == [players[2]["rate"]]
+
+
+def test_tick_epoch_never_goes_back(tables, monkeypatch):
+    match_queue, match_make, _ = tables
+    now = int(match_make.time.time())
+    enqueue(tables, 3, inqueued_unixtime=now)
+    # 時計が進んでいるコンテナが前回のティックを実行した
+    ahead = now + 600
+    match_queue.queue.update_item(
+        Key={"namespace": "default", "user_id": "#META#"},
+        UpdateExpression="SET tick_unixtime = :t",
+        ExpressionAttributeValues={":t": ahead},
+    )
+    match_make.handle({"matcher": "sweep"}, None)
+    _, ranges, _ = read_meta_lists(tables)
+    spread_count = match_make.range_spread_count(now, ahead)
+    assert ranges == [match_make.BASE_RANGE + 20 * spread_count] * 3
+    info = json.loads(match_queue.get_info({}, None)["body"])
+    assert info["tick_unixtime"] == ahead
+    assert info["range_list"] == ranges
+
+
+def test_handle_reports_an_error_response(tables, monkeypatch):
+    _, match_make, _ = tables
+
+    def fail(tick_unixtime):
+        raise RuntimeError("unexpected")
+
+    monkeypatch.setattr(match_make, "evict_stale_entries", fail)
+    response = match_make.handle({"matcher": "sweep"}, None)
+    assert response["statusCode"] == 500
+    assert "unexpected" in response["body"]
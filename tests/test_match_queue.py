@@ -0,0 +1,129 @@
+from src.queue_pool import delta_key
+
+
+def add_user(backend, user_id, rate=1500, assigned_match_id=0):
+    backend[1].user_table.put_item(Item={
+        "namespace": "default", "user_id": user_id, "rate": rate,
+        "unitemate_max_rate": rate, "assigned_match_id": assigned_match_id,
+    })
+
+
+def member(user_id, inqueued_unixtime=1000, **extra):
+    return {
+        "namespace": "default", "user_id": user_id, "blocking": "", "desired_role": "",
+        "range_spread_speed": 20, "range_spread_count": 0, "discord_id": "",
+        "inqueued_unixtime": inqueued_unixtime, **extra,
+    }
+
+
+def read_item(backend, user_id):
+    return backend[0].queue.get_item(Key={"namespace": "default", "user_id": user_id}, ConsistentRead=True).get("Item")
+
+
+def test_inqueue_writes_entry_delta_and_counter(tables, monkeypatch):
+    match_queue, _, _ = tables
+    monkeypatch.setattr(match_queue, "MATCHMAKE_ON_INQUEUE", False)
+    add_user(tables, "a", rate=1620)
+    assert match_queue.inqueue_members([member("a")])["statusCode"] == 200
+    assert read_item(tables, "a")["rate"] == 1620
+    delta = read_item(tables, delta_key(1))
+    assert (delta["op"], delta["record"]["user_id"]) == ("inqueue", "a")
+    meta = read_item(tables, "#META#")
+    assert (meta["pool_version"], meta["queue_count"]) == (1, 1)
+    # 待ちプレイヤーの一覧はティックが書き直すので、インキューでは書かない
+    assert "queue_rates" not in meta
+
+
+def test_inqueue_refuses_an_assigned_user(tables):
+    match_queue, _, _ = tables
+    add_user(tables, "a", assigned_match_id=7)
+    assert match_queue.inqueue_members([member("a")])["statusCode"] == 200
+    assert read_item(tables, "a") is None
+    assert "pool_version" not in read_item(tables, "#META#")
+
+
+def test_reinqueue_replaces_the_entry_without_counting_twice(tables, monkeypatch):
+    match_queue, _, _ = tables
+    monkeypatch.setattr(match_queue, "MATCHMAKE_ON_INQUEUE", False)
+    add_user(tables, "a")
+    match_queue.inqueue_members([member("a", inqueued_unixtime=1000)])
+    match_queue.inqueue_members([member("a", inqueued_unixtime=2000)])
+    assert read_item(tables, "a")["inqueued_unixtime"] == 2000
+    meta = read_item(tables, "#META#")
+    assert (meta["pool_version"], meta["queue_count"]) == (2, 1)
+
+
+def test_party_inqueue_is_all_or_nothing(tables, monkeypatch):
+    match_queue, _, _ = tables
+    monkeypatch.setattr(match_queue, "MATCHMAKE_ON_INQUEUE", False)
+    add_user(tables, "a")
+    add_user(tables, "b", assigned_match_id=3)
+    match_queue.inqueue_members([member("a", party_id="x"), member("b", party_id="x")])
+    assert read_item(tables, "a") is None
+    add_user(tables, "b")
+    match_queue.inqueue_members([member("a", party_id="x"), member("b", party_id="x")])
+    assert read_item(tables, "a")["party_id"] == read_item(tables, "b")["party_id"] == "x"
+    meta = read_item(tables, "#META#")
+    assert (meta["pool_version"], meta["queue_count"]) == (2, 2)
+
+
+def test_inqueue_retries_after_a_concurrent_inqueue(tables, monkeypatch):
+    match_queue, _, _ = tables
+    monkeypatch.setattr(match_queue, "MATCHMAKE_ON_INQUEUE", False)
+    monkeypatch.setattr(match_queue, "META_BACKOFF_BASE", 0)
+    add_user(tables, "a")
+    add_user(tables, "b")
+    read_inqueue_state = match_queue.read_inqueue_state
+    reads = []
+
+    def read_then_race(user_ids):
+        state = read_inqueue_state(user_ids)
+        reads.append(user_ids)
+        if len(reads) == 1:
+            # 読み込みの後に、他のプレイヤーのインキューが先にコミットされた
+            users, meta, old_items = read_inqueue_state(["b"])
+            match_queue.commit_inqueue([dict(member("b"), rate=1500, best=1500)], users, meta, old_items)
+        return state
+
+    monkeypatch.setattr(match_queue, "read_inqueue_state", read_then_race)
+    assert match_queue.inqueue_members([member("a")])["statusCode"] == 200
+    assert len(reads) == 2
+    assert read_item(tables, delta_key(1))["record"]["user_id"] == "b"
+    assert read_item(tables, delta_key(2))["record"]["user_id"] == "a"
+    assert read_item(tables, "#META#")["queue_count"] == 2
+
+
+def test_dequeue_removes_the_entry_once(tables, monkeypatch):
+    match_queue, _, _ = tables
+    monkeypatch.setattr(match_queue, "MATCHMAKE_ON_INQUEUE", False)
+    add_user(tables, "a")
+    match_queue.inqueue_members([member("a")])
+    assert match_queue.dequeue_user("a") == 200
+    assert read_item(tables, "a") is None
+    assert read_item(tables, delta_key(2))["op"] == "dequeue"
+    # 二重のデキューは何も書かない
+    assert match_queue.dequeue_user("a") == 200
+    meta = read_item(tables, "#META#")
+    assert (meta["pool_version"], meta["queue_count"]) == (2, 0)
+
+
+def test_stale_dequeue_keeps_a_player_whose_heartbeat_arrived(tables, monkeypatch):
+    match_queue, _, _ = tables
+    monkeypatch.setattr(match_queue, "MATCHMAKE_ON_INQUEUE", False)
+    add_user(tables, "a")
+    match_queue.inqueue_members([member("a")])
+    heartbeat_at = int(read_item(tables, "a")["heartbeat_at"])
+    match_queue.refresh_heartbeat("a", heartbeat_at + 100)
+    assert match_queue.dequeue_user("a", stale_before=heartbeat_at + 50) == 200
+    assert read_item(tables, "a") is not None
+    assert read_item(tables, "#META#")["queue_count"] == 1
+
+
+def test_inqueue_requests_matchmake_once_per_debounce(tables, monkeypatch):
+    match_queue, _, _ = tables
+    requests = []
+    monkeypatch.setattr(match_queue, "send_matchmake_request", requests.append)
+    for i in range(match_queue.MATCHMAKE_TRIGGER_SIZE + 1):
+        add_user(tables, f"u{i}")
+        match_queue.inqueue_members([member(f"u{i}")])
+    assert requests == [match_queue.MATCHMAKE_TRIGGER_SIZE]
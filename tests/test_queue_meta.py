@@ -0,0 +1,23 @@
+import math
+
+from src.queue_meta import PACK_MAX, pack_values, unpack_values
+
+
+def test_pack_round_trip():
+    values = [0, 1, 1500, 2500, PACK_MAX]
+    data = pack_values(values)
+    assert len(data) == 2 * len(values)
+    assert unpack_values(data) == values
+
+
+def test_pack_clamps_out_of_range_values():
+    assert unpack_values(pack_values([-math.inf, -5, math.inf, PACK_MAX + 10])) == [0, 0, PACK_MAX, PACK_MAX]
+
+
+def test_unpack_accepts_boto3_binary_and_missing_attribute():
+    class Binary:
+        def __init__(self, value):
+            self.value = value
+
+    assert unpack_values(Binary(pack_values([1, 2]))) == [1, 2]
+    assert unpack_values(None) == []
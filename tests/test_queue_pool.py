@@ -0,0 +1,189 @@
+import pytest
+
+from src.queue_pool import (
+    DELTA_PREFIX,
+    PoolEntry,
+    QueuePool,
+    delta_item,
+    load_pool,
+    match_record_item,
+    query_prefix,
+    save_pool,
+)
+
+
+def make_item(user_id, rate, inqueued_unixtime=1000, **extra):
+    return dict(
+        user_id=user_id, rate=rate, best=rate, range_spread_speed=20,
+        inqueued_unixtime=inqueued_unixtime, **extra,
+    )
+
+
+def pool_items(pool):
+    return [entry.to_item() for entry in pool.entries()]
+
+
+def test_pool_keeps_rate_descending_order():
+    pool = QueuePool.from_items([make_item("a", 1500), make_item("b", 1700), make_item("c", 1600)], version=3)
+    assert [entry.user_id for entry in pool.entries()] == ["b", "c", "a"]
+    # 再インキューは古いレコードを置き換える
+    pool.add(PoolEntry.from_item(make_item("b", 1400)))
+    assert [entry.user_id for entry in pool.entries()] == ["c", "a", "b"]
+    assert len(pool) == 3
+
+
+def test_snapshot_round_trip_across_chunks():
+    items = [make_item(f"u{i}", 1400 + i * 7 % 300, desired_role="top", party_id="p" if i % 5 == 0 else "")
+             for i in range(50)]
+    pool = QueuePool.from_items(items, version=12)
+    chunks = pool.to_chunks(chunk_bytes=200)
+    assert len(chunks) > 1
+    restored = QueuePool.from_chunks("snap", 12, chunks)
+    assert pool_items(restored) == pool_items(pool)
+    assert restored.version == restored.snapshot_version == 12
+    assert restored.snapshot_id == "snap"
+    # 復元したプールにもそのまま差分を適用できる
+    restored.add(PoolEntry.from_item(make_item("new", 1550)))
+    assert "new" in restored
+
+
+def test_empty_pool_has_one_chunk():
+    pool = QueuePool(version=0)
+    assert pool.to_chunks() == [[]]
+    assert len(QueuePool.from_chunks("snap", 0, [[]])) == 0
+
+
+def test_old_snapshot_records_default_party_id():
+    record = PoolEntry.from_item(make_item("a", 1500)).to_record()[:-1]
+    pool = QueuePool.from_chunks("snap", 1, [[record]])
+    assert pool.entries()[0].party_id == ""
+
+
+def test_snapshot_plus_deltas_matches_full_reload():
+    base = [make_item(f"u{i}", 1500 + i) for i in range(10)]
+    pool = QueuePool.from_chunks("snap", 2, QueuePool.from_items(base, 2).to_chunks())
+    deltas = [
+        delta_item(3, "inqueue", make_item("x", 1650)),
+        delta_item(4, "dequeue", {"user_id": "u3"}),
+        delta_item(5, "inqueue", make_item("u4", 1200, inqueued_unixtime=2000)),
+    ]
+    for delta in deltas:
+        pool.apply(delta)
+    expected = [item for item in base if item["user_id"] not in ("u3", "u4")]
+    expected += [make_item("x", 1650), make_item("u4", 1200, inqueued_unixtime=2000)]
+    assert pool_items(pool) == pool_items(QueuePool.from_items(expected, 5))
+    assert pool.version == 5
+    assert pool.log_size() == 3
+
+
+def test_apply_match_is_idempotent_and_skips_requeued_players():
+    pool = QueuePool.from_items([make_item(f"u{i}", 1500 + i) for i in range(4)], version=1)
+    record = match_record_item(7, [make_item("u0", 1500), make_item("u1", 1501), make_item("u2", 1502)])
+    # u1 はマッチ後に入り直している
+    pool.apply(delta_item(2, "inqueue", make_item("u1", 1501, inqueued_unixtime=5000)))
+    pool.apply_match(record)
+    pool.apply_match(record)
+    assert [entry.user_id for entry in pool.entries()] == ["u3", "u1"]
+    assert pool.matches == {record["user_id"]}
+    assert pool.log_size() == 2
+
+
+# --- load_pool / save_pool（moto） ---
+
+def inqueue(backend, user_id, rate):
+    match_queue, match_make, _ = backend
+    match_make.user_table.put_item(Item={
+        "namespace": "default", "user_id": user_id, "rate": rate, "unitemate_max_rate": rate, "assigned_match_id": 0,
+    })
+    response = match_queue.inqueue_members([{
+        "namespace": "default", "user_id": user_id, "blocking": "", "desired_role": "",
+        "range_spread_speed": 20, "range_spread_count": 0, "discord_id": "", "inqueued_unixtime": 1000,
+    }])
+    assert response["statusCode"] == 200
+
+
+def read_meta(queue):
+    return queue.get_item(Key={"namespace": "default", "user_id": "#META#"}, ConsistentRead=True)["Item"]
+
+
+def user_ids(pool):
+    return [entry.user_id for entry in pool.entries()]
+
+
+def test_load_pool_applies_deltas_on_top_of_the_snapshot(tables, monkeypatch):
+    match_queue, _, _ = tables
+    monkeypatch.setattr(match_queue, "MATCHMAKE_ON_INQUEUE", False)
+    queue = match_queue.queue
+    for i in range(5):
+        inqueue(tables, f"u{i}", 1500 + i)
+    pool = load_pool(queue, read_meta(queue))
+    assert user_ids(pool) == ["u4", "u3", "u2", "u1", "u0"]
+    save_pool(queue, pool, 0)
+    assert query_prefix(queue, DELTA_PREFIX) == []
+
+    inqueue(tables, "u5", 1600)
+    match_queue.dequeue_user("u1")
+    restored = load_pool(queue, read_meta(queue))
+    assert restored.snapshot_id == pool.snapshot_id
+    assert user_ids(restored) == ["u5", "u4", "u3", "u2", "u0"]
+    # 差分が欠けていればキュー全体を読み直す
+    queue.delete_item(Key={"namespace": "default", "user_id": query_prefix(queue, DELTA_PREFIX)[0]["user_id"]})
+    reread = load_pool(queue, read_meta(queue))
+    assert reread.snapshot_id is None
+    assert user_ids(reread) == user_ids(restored)
+
+
+def test_save_pool_deletes_every_consumed_delta_page(tables, monkeypatch):
+    match_queue, _, _ = tables
+    monkeypatch.setattr(match_queue, "MATCHMAKE_ON_INQUEUE", False)
+    queue = match_queue.queue
+    for i in range(7):
+        inqueue(tables, f"u{i}", 1500 + i)
+    pool = load_pool(queue, read_meta(queue))
+    query = queue.query
+    # 1ページを2件にして、LastEvaluatedKey をたどらないと残りの差分が消えないようにする
+    monkeypatch.setattr(queue, "query", lambda **kwargs: query(Limit=2, **kwargs))
+    save_pool(queue, pool, 0)
+    monkeypatch.undo()
+    assert query_prefix(queue, DELTA_PREFIX) == []
+
+
+def test_full_reread_uses_a_consistent_index_query(tables, monkeypatch):
+    match_queue, _, _ = tables
+    monkeypatch.setattr(match_queue, "MATCHMAKE_ON_INQUEUE", False)
+    queue = match_queue.queue
+    inqueue(tables, "u0", 1500)
+    query = queue.query
+    index_queries = []
+
+    def record(**kwargs):
+        if kwargs.get("IndexName") == "rate_index":
+            index_queries.append(kwargs)
+        return query(**kwargs)
+
+    monkeypatch.setattr(queue, "query", record)
+    assert user_ids(load_pool(queue, read_meta(queue))) == ["u0"]
+    assert index_queries and all(kwargs["ConsistentRead"] for kwargs in index_queries)
+
+
+def test_save_pool_keeps_the_snapshot_if_the_fence_moved(tables, monkeypatch):
+    match_queue, _, _ = tables
+    monkeypatch.setattr(match_queue, "MATCHMAKE_ON_INQUEUE", False)
+    queue = match_queue.queue
+    inqueue(tables, "u0", 1500)
+    pool = load_pool(queue, read_meta(queue))
+    save_pool(queue, pool, 0)
+    snapshot_id = read_meta(queue)["pool_snapshot_id"]
+    queue.update_item(
+        Key={"namespace": "default", "user_id": "#META#"},
+        UpdateExpression="SET fence_token = :t",
+        ExpressionAttributeValues={":t": 3},
+    )
+    inqueue(tables, "u1", 1600)
+    stale = load_pool(queue, read_meta(queue))
+    with pytest.raises(queue.meta.client.exceptions.ConditionalCheckFailedException):
+        save_pool(queue, stale, 2)
+    assert read_meta(queue)["pool_snapshot_id"] == snapshot_id
+    # 書きかけのチャンクと、未取り込みの差分は残らない・消えない
+    assert {item["snapshot_id"] for item in query_prefix(queue, "#POOL#", "snapshot_id")} == {snapshot_id}
+    assert len(query_prefix(queue, DELTA_PREFIX)) == 1